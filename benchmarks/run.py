@@ -0,0 +1,423 @@
+"""
+Benchmarks for the filestore, database and HTTP hot paths.
+
+Run from the repo root:
+    $ python -m benchmarks.run --sizes 1K,1M,64M --concurrency 1,4 --cold --out results.json
+    $ python -m benchmarks.run --compare results.json --out new.json
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import functools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+from dataclasses import asdict, dataclass, field
+
+import filedrop.lib.database as f_db
+import filedrop.lib.filestore as f_fs
+import filedrop.lib.models as f_models
+import filedrop.lib.time as f_time
+import filedrop.lib.utils as f_utils
+import filedrop.srv as f_srv
+
+SIZE_SUFFIXES = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+# uploads bigger than this are only benchmarked with the streaming APIs, the bytes APIs would need it all in memory
+MAX_IN_MEMORY_SIZE = 256 * 1024 * 1024
+
+CHUNK_SIZE = f_fs.DEFAULT_CHUNK_SIZE
+
+# starts a server process the way a gunicorn worker does without --preload: imports, config, migrations and the app
+STARTUP_SCRIPT = "import filedrop.srv as f_srv; f_srv.create_app(gunicorn=True)"
+
+# random block that the generated files are built from, so generating them doesn't dominate the timings
+_BLOCK = os.urandom(CHUNK_SIZE)
+
+
+@dataclass
+class Result:
+    """The timings for one benchmark configuration"""
+
+    name: str
+    size: int
+    concurrency: int
+    cache: str
+    seconds: list[float] = field(default_factory=list)
+    wall: float = 0.0
+
+    @property
+    def key(self) -> str:
+        """Identifies the configuration across runs"""
+
+        return f"{self.name}/{self.size}/{self.concurrency}/{self.cache}"
+
+    def summary(self) -> dict:
+        """Get the machine-readable summary of the result"""
+
+        s = sorted(self.seconds)
+        ops = len(s)
+
+        return asdict(self) | {
+            "key": self.key,
+            "ops": ops,
+            "mean": statistics.fmean(s),
+            "p50": s[ops // 2],
+            "p95": s[min(ops - 1, int(ops * 0.95))],
+            "ops_per_sec": ops / self.wall if self.wall else 0.0,
+            "mb_per_sec": ops * self.size / self.wall / 1024**2 if self.wall else 0.0,
+        }
+
+
+def parse_size(s: str) -> int:
+    """Parse a size like 1K, 64M or 2G into bytes"""
+
+    s = s.strip().upper()
+    if s and s[-1] in SIZE_SUFFIXES:
+        return int(float(s[:-1]) * SIZE_SUFFIXES[s[-1]])
+
+    return int(s)
+
+
+def gen_chunks(size: int) -> typing.Iterator[bytes]:
+    """Generate unique file contents (so uploads aren't deduplicated) without holding them in memory"""
+
+    yield os.urandom(min(size, 16))
+
+    remaining = size - min(size, 16)
+    while remaining > 0:
+        chunk = _BLOCK[: min(remaining, CHUNK_SIZE)]
+        remaining -= len(chunk)
+        yield chunk
+
+
+def drop_page_cache(path: str):
+    """Evict a file from the page cache, so the next read has to hit the disk"""
+
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def measure(
+    name: str, size: int, concurrency: int, cache: str, iterations: int, op: typing.Callable[[int], typing.Any]
+) -> Result:
+    """Run op(iteration) iterations times on each of concurrency threads, recording the latency of every call"""
+
+    r = Result(name, size, concurrency, cache)
+
+    def worker(w: int) -> list[float]:
+        times = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            op(w * iterations + i)
+            times.append(time.perf_counter() - start)
+        return times
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for times in pool.map(worker, range(concurrency)):
+            r.seconds += times
+    r.wall = time.perf_counter() - start
+
+    summary = r.summary()
+    print(
+        f"{r.key:<50} mean {summary['mean'] * 1000:10.3f}ms  p95 {summary['p95'] * 1000:10.3f}ms  "
+        f"{summary['ops_per_sec']:10.1f} ops/s  {summary['mb_per_sec']:10.1f} MB/s",
+        file=sys.stderr,
+    )
+
+    return r
+
+
+@contextlib.contextmanager
+def environment(tmpdir: str):
+    """Set up a file-backed database and filestore, tuned like the server"""
+
+    with f_db.Database(os.path.join(tmpdir, "bench.db"), pragmas=f_db.gen_pragmas()) as db:
+        yield (db, f_fs.Filestore(db, os.path.join(tmpdir, "fs")))
+
+
+def read_path(fs: f_fs.Filestore, files: list, iterations: int, cache: str, i: int) -> int:
+    """Stream a file from its path, like the download route does"""
+
+    f = files[i // iterations]
+    if cache == "cold":
+        drop_page_cache(f.path)
+
+    n = 0
+    with open(fs.get_file_path(f), "rb") as fp:  # type: ignore
+        while chunk := fp.read(CHUNK_SIZE):
+            n += len(chunk)
+
+    return n
+
+
+def read_bytes(fs: f_fs.Filestore, files: list, iterations: int, cache: str, i: int) -> bytes | None:
+    """Read a whole file into memory"""
+
+    f = files[i // iterations]
+    if cache == "cold":
+        drop_page_cache(f.path)
+
+    return fs.get_file_bytes(f)
+
+
+def download(client, files: list, iterations: int, cache: str, i: int) -> int:
+    """Download a file through the download route"""
+
+    f = files[i // iterations]
+    if cache == "cold":
+        drop_page_cache(f.path)
+
+    n = 0
+    r = client.get(f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download")
+    for chunk in r.response:
+        n += len(chunk)
+    r.close()
+
+    return n
+
+
+def bench_filestore(
+    fs: f_fs.Filestore, sizes: list[int], concurrencies: list[int], iterations: int, cold: bool
+) -> list[Result]:
+    """Benchmark the filestore uploads and downloads"""
+
+    results = []
+
+    for size in sizes:
+        for n in concurrencies:
+            results.append(
+                measure(
+                    "filestore.save_stream",
+                    size,
+                    n,
+                    "n/a",
+                    iterations,
+                    lambda _, size=size: fs.save_stream("bench.bin", gen_chunks(size), anon_upload=True),  # type: ignore
+                )
+            )
+
+            if size <= MAX_IN_MEMORY_SIZE:
+                results.append(
+                    measure(
+                        "filestore.save_file",
+                        size,
+                        n,
+                        "n/a",
+                        iterations,
+                        lambda _, size=size: fs.save_file("bench.bin", b"".join(gen_chunks(size)), anon_upload=True),  # type: ignore
+                    )
+                )
+
+        # every thread downloads its own file, so the cold runs don't share cached pages
+        files = [fs.save_stream("bench.bin", gen_chunks(size), anon_upload=True) for _ in range(max(concurrencies))]
+
+        for cache in ["warm", "cold"] if cold else ["warm"]:
+            for n in concurrencies:
+                results.append(
+                    measure(
+                        "filestore.get_file_path",
+                        size,
+                        n,
+                        cache,
+                        iterations,
+                        functools.partial(read_path, fs, files, iterations, cache),
+                    )
+                )
+
+                if size <= MAX_IN_MEMORY_SIZE:
+                    results.append(
+                        measure(
+                            "filestore.get_file_bytes",
+                            size,
+                            n,
+                            cache,
+                            iterations,
+                            functools.partial(read_bytes, fs, files, iterations, cache),
+                        )
+                    )
+
+    return results
+
+
+def bench_database(db: f_db.Database, concurrencies: list[int], iterations: int) -> list[Result]:
+    """Benchmark the database lookups and download counting"""
+
+    results = []
+
+    files = []
+    for _ in range(1000):
+        f = f_models.File.new("bench.bin", "/bench", 1, f_utils.hexstr(os.urandom(32)), f_db.ANONYMOUS_USERNAME)
+        db.add_new_file(f)
+        files.append(f)
+
+    for n in concurrencies:
+        # with the file cache, and with every lookup going to sqlite
+        results.append(
+            measure("database.get_file", 0, n, "warm", iterations * 100, lambda i: db.get_file(files[i % 1000].uuid))
+        )
+
+        db.file_cache.clear()
+        results.append(
+            measure(
+                "database.get_file",
+                0,
+                n,
+                "cold",
+                iterations * 100,
+                lambda i: (db.file_cache.clear(), db.get_file(files[i % 1000].uuid)),
+            )
+        )
+
+        results.append(
+            measure(
+                "database.inc_download_count",
+                0,
+                n,
+                "n/a",
+                iterations * 20,
+                lambda i: db.inc_download_count(files[i % 1000].uuid),
+            )
+        )
+
+    return results
+
+
+def bench_http(
+    db: f_db.Database, fs: f_fs.Filestore, sizes: list[int], concurrencies: list[int], iterations: int, cold: bool
+) -> list[Result]:
+    """Benchmark the download route through the flask test client"""
+
+    results = []
+
+    app = f_srv.create_app(testing=True, db=db, fs=fs)
+    app.config.update({"TESTING": True})
+
+    for size in sizes:
+        files = [fs.save_stream("bench.bin", gen_chunks(size), anon_upload=True) for _ in range(max(concurrencies))]
+
+        for cache in ["warm", "cold"] if cold else ["warm"]:
+            for n in concurrencies:
+                op = functools.partial(download, app.test_client(), files, iterations, cache)
+                results.append(measure("http.file_download", size, n, cache, iterations, op))
+
+    return results
+
+
+def bench_startup(tmpdir: str, iterations: int) -> list[Result]:
+    """Benchmark starting a server process in a fresh interpreter, against the (already migrated) database"""
+
+    env = os.environ | {
+        "FD_FS_PATH": os.path.join(tmpdir, "fs"),
+        "FD_DB_PATH": os.path.join(tmpdir, "bench.db"),
+        "FD_REAPER_INTERVAL": "0",
+    }
+
+    def start(_: int):
+        subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env=env, check=True, capture_output=True)
+
+    return [measure("startup.create_app", 0, 1, "n/a", iterations, start)]
+
+
+def git_commit() -> str | None:
+    """Get the commit the benchmarks are running against"""
+
+    try:
+        p = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, timeout=10)
+        return p.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(baseline: dict, results: list[dict], threshold: float) -> bool:
+    """Print the change in mean latency against a baseline run. Returns False if anything regressed past the threshold."""
+
+    old = {r["key"]: r for r in baseline["results"]}
+    ok = True
+
+    print(f"\ncompared to {baseline['meta'].get('commit')}:", file=sys.stderr)
+    for r in results:
+        if r["key"] not in old:
+            continue
+
+        change = (r["mean"] - old[r["key"]]["mean"]) / old[r["key"]]["mean"] * 100
+        regressed = change > threshold
+        ok = ok and not regressed
+
+        print(f"{r['key']:<50} {change:+8.1f}%{'  REGRESSION' if regressed else ''}", file=sys.stderr)
+
+    return ok
+
+
+def main() -> int:
+    """Benchmark entrypoint"""
+
+    p = argparse.ArgumentParser(prog="benchmarks.run", description="Benchmark the filedrop hot paths")
+    p.add_argument("--sizes", default="1K,1M,64M", help="comma separated file sizes (K/M/G suffixes)")
+    p.add_argument("--concurrency", default="1,4", help="comma separated number of concurrent threads")
+    p.add_argument("--iterations", type=int, default=5, help="operations per thread")
+    p.add_argument("--cold", action="store_true", help="also measure reads with a cold page cache")
+    p.add_argument("--only", default="filestore,database,http,startup", help="comma separated benchmark groups to run")
+    p.add_argument("--tmpdir", help="directory to put the database and filestore in (should be on the disk to test)")
+    p.add_argument("--out", help="write the results as JSON to this file (default stdout)")
+    p.add_argument("--compare", help="JSON results from a previous run to compare against")
+    p.add_argument("--threshold", type=float, default=10.0, help="%% slowdown that counts as a regression")
+    args = p.parse_args()
+
+    # configure logging before the app does, since testing mode would turn on debug logging and drown out the results
+    logging.basicConfig(level=logging.WARNING)
+
+    sizes = [parse_size(x) for x in args.sizes.split(",")]
+    concurrencies = [int(x) for x in args.concurrency.split(",")]
+    groups = args.only.split(",")
+
+    results: list[Result] = []
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as tmpdir:
+        with environment(tmpdir) as (db, fs):
+            if "filestore" in groups:
+                results += bench_filestore(fs, sizes, concurrencies, args.iterations, args.cold)
+            if "database" in groups:
+                results += bench_database(db, concurrencies, args.iterations)
+            if "http" in groups:
+                results += bench_http(db, fs, sizes, concurrencies, args.iterations, args.cold)
+            if "startup" in groups:
+                results += bench_startup(tmpdir, args.iterations)
+
+    out: dict[str, typing.Any] = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": f_time.iso8601(f_time.now()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "args": vars(args),
+        },
+        "results": [r.summary() for r in results],
+    }
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2)
+    else:
+        json.dump(out, sys.stdout, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            if not compare(json.load(f), out["results"], args.threshold):
+                return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+"""
+Streaming archives of many files, for downloading them in one request.
+
+The archive is built as it's sent, a piece at a time, so nothing is staged on disk or held in memory. zip archives are
+written with data descriptors (the sizes and CRC follow each file) since the output can't be seeked back into, and
+files aren't compressed again (they're often already compressed, and it would cost CPU on every download).
+"""
+
+import io
+import os
+import tarfile
+import typing
+import zipfile
+
+import filedrop.lib.exc as f_exc
+import filedrop.lib.filestore as f_fs
+import filedrop.lib.models as f_models
+import filedrop.lib.time as f_time
+import filedrop.lib.utils as f_utils
+
+# archive formats, and their mimetypes
+FORMATS = {"zip": "application/zip", "tar": "application/x-tar"}
+
+# how much of a file is read at a time
+READ_SIZE = f_fs.DEFAULT_CHUNK_SIZE
+
+
+class _Progress:
+    """How many of the files have been sent all the way through, so far"""
+
+    def __init__(self):
+        self.files = 0
+
+
+class _Sink(io.RawIOBase):
+    """An unseekable file that collects what's written to it, until it's taken with pop()"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def pop(self) -> bytes:
+        """Take everything written since the last pop()."""
+
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def entry_names(files: list[f_models.File]) -> list[str]:
+    """
+    Get the names to store the files under in an archive.
+
+    Names can't contain paths (so an archive can't write outside of where it's extracted), and duplicates get a number.
+    """
+
+    names = []
+    seen: set[str] = set()
+
+    for f in files:
+        name = f.name.replace("/", "_").replace("\\", "_")
+        if name in ("", ".", ".."):
+            name = f_utils.hexstr(f.uuid)
+
+        (stem, ext) = os.path.splitext(name)
+        i = 1
+        while name in seen:
+            i += 1
+            name = f"{stem} ({i}){ext}"
+
+        seen.add(name)
+        names.append(name)
+
+    return names
+
+
+def _read(fs: f_fs.Filestore, f: f_models.File) -> typing.Iterator[bytes]:
+    """Yield the contents of a file, raising OSError if it isn't as long as it should be."""
+
+    n = 0
+    with fs.open_file(f) as src:
+        while chunk := src.read(READ_SIZE):
+            n += len(chunk)
+            yield chunk
+
+    if n != f.size:
+        raise OSError(f"{f} is {n} bytes on disk, expected {f.size}")
+
+
+def _stream_zip(fs: f_fs.Filestore, files: list[f_models.File], progress: _Progress) -> typing.Iterator[bytes]:
+    sink = _Sink()
+
+    with zipfile.ZipFile(typing.cast(typing.IO[bytes], sink), "w") as zf:
+        for f, name in zip(files, entry_names(files)):
+            zi = zipfile.ZipInfo(name, date_time=(f.uploaded_at or f_time.now()).timetuple()[:6])
+            with zf.open(zi, "w", force_zip64=f.size >= zipfile.ZIP64_LIMIT) as dst:
+                for chunk in _read(fs, f):
+                    dst.write(chunk)
+                    if data := sink.pop():
+                        yield data
+            progress.files += 1
+
+    yield sink.pop()
+
+
+def _stream_tar(fs: f_fs.Filestore, files: list[f_models.File], progress: _Progress) -> typing.Iterator[bytes]:
+    # tarfile can only add a whole file at once, so the headers and padding are written here
+    total = 0
+    for f, name in zip(files, entry_names(files)):
+        ti = tarfile.TarInfo(name)
+        ti.size = f.size
+        ti.mode = 0o644
+        ti.mtime = int((f.uploaded_at or f_time.now()).timestamp())
+
+        header = ti.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        total += len(header)
+        yield header
+
+        for chunk in _read(fs, f):
+            total += len(chunk)
+            yield chunk
+        progress.files += 1
+
+        pad = -f.size % tarfile.BLOCKSIZE
+        total += pad
+        yield b"\0" * pad
+
+    # two empty blocks mark the end, and the archive is padded to a whole record
+    end = 2 * tarfile.BLOCKSIZE
+    end += -(total + end) % tarfile.RECORDSIZE
+    yield b"\0" * end
+
+
+def _stream(
+    archive: typing.Iterator[bytes],
+    files: list[f_models.File],
+    progress: _Progress,
+    on_unsent: typing.Callable[[list[f_models.File]], typing.Any],
+) -> typing.Iterator[bytes]:
+    finished = False
+    try:
+        yield from archive
+        finished = True
+    finally:
+        # closed early (e.g. the client went away) or a file couldn't be read
+        if not finished:
+            on_unsent(files[progress.files :])
+
+
+def stream_archive(
+    fs: f_fs.Filestore,
+    files: list[f_models.File],
+    fmt: str,
+    on_unsent: typing.Callable[[list[f_models.File]], typing.Any] | None = None,
+) -> typing.Iterator[bytes]:
+    """
+    Yield an archive of the files in one of the FORMATS, as it's built. Raises BadArgs for an unknown format.
+
+    The download conditions aren't checked, that's up to the caller. If a file can't be read, OSError is raised part
+    way through the archive. If the archive isn't sent all the way through, on_unsent is called with the files whose
+    contents weren't all sent (a file only counts as sent once the archive is read past it).
+    """
+
+    progress = _Progress()
+
+    if fmt == "zip":
+        archive = _stream_zip(fs, files, progress)
+    elif fmt == "tar":
+        archive = _stream_tar(fs, files, progress)
+    else:
+        raise f_exc.BadArgs(f"unknown archive format: {fmt}")
+
+    if on_unsent is None:
+        return archive
+
+    return _stream(archive, files, progress, on_unsent)
@@ -0,0 +1,307 @@
+"""
+Audit log, written to the log table.
+
+Events are queued by the code that records them, and written by a background thread in batches (one transaction per
+batch), so recording an event never waits on the database. If the queue is full, recording waits up to block_timeout
+for room, and then the event is spilled to a JSON lines file in spill_dir to be written later (or dropped if there
+isn't one). Spilled events are written when the audit log is started again, by whichever process starts first.
+"""
+
+import glob
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import filedrop.lib.database as f_db
+import filedrop.lib.exc as f_exc
+import filedrop.lib.metrics as f_metrics
+import filedrop.lib.models as f_models
+import filedrop.lib.time as f_time
+import filedrop.lib.utils as f_utils
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_INTERVAL = 1.0  # seconds
+DEFAULT_BLOCK_TIMEOUT = 0.01  # seconds
+
+# each process spills to its own file in the spill dir, named by its pid
+SPILL_PREFIX = "audit-spill-"
+SPILL_SUFFIX = ".jsonl"
+
+EVENTS = f_metrics.REGISTRY.counter(
+    "filedrop_audit_events_total", "Audit log events by what happened to them (written, spilled or dropped)"
+)
+
+
+def _to_json(e: f_models.AuditEvent) -> str:
+    return json.dumps(
+        {
+            "action": e.action,
+            "username": e.username,
+            "file_uuid": f_utils.hexstr(e.file_uuid) if e.file_uuid else None,
+            "src_ip": e.src_ip,
+            "message": e.message,
+            "ts": e.ts.isoformat() if e.ts else None,
+        }
+    )
+
+
+def _from_json(line: str) -> f_models.AuditEvent:
+    d = json.loads(line)
+    return f_models.AuditEvent(
+        action=d["action"],
+        username=d["username"],
+        file_uuid=f_utils.unhexstr(d["file_uuid"]) if d["file_uuid"] else None,
+        src_ip=d["src_ip"],
+        message=d["message"],
+        ts=datetime.fromisoformat(d["ts"]) if d["ts"] else None,
+    )
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+class AuditLog:
+    """
+    Batched, asynchronous writer for the audit log.
+
+    Events are recorded with record(), and written in the background after start(), at least every interval seconds
+    or whenever batch_size events are waiting. flush() writes the queued events right away.
+    """
+
+    def __init__(
+        self,
+        db: f_db.Database,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        interval: float = DEFAULT_INTERVAL,
+        block_timeout: float = DEFAULT_BLOCK_TIMEOUT,
+        spill_dir: str | None = None,
+    ):
+        """
+        Set up the audit log.
+
+        - queue_size: max number of events waiting to be written
+        - block_timeout: how long record() waits for room in a full queue before spilling/dropping the event
+        - spill_dir: folder to spill events that don't fit in the queue (or fail to be written) to
+        """
+
+        if queue_size <= 0 or batch_size <= 0 or interval <= 0 or block_timeout < 0:
+            raise f_exc.BadArgs(
+                f"invalid audit log settings, queue_size={queue_size} batch_size={batch_size} interval={interval} block_timeout={block_timeout}"
+            )
+
+        self._db = db
+        # None wakes up the background thread when it's stopped
+        self._queue: queue.Queue[f_models.AuditEvent | None] = queue.Queue(queue_size)
+        self._batch_size = batch_size
+        self._interval = interval
+        self._block_timeout = block_timeout
+        self._spill_dir = spill_dir
+        self._spill_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @property
+    def spill_path(self) -> str | None:
+        """Path of the file this process spills events to, if there's a spill dir."""
+
+        if self._spill_dir is None:
+            return None
+
+        return os.path.join(self._spill_dir, f"{SPILL_PREFIX}{os.getpid()}{SPILL_SUFFIX}")
+
+    def record(
+        self,
+        action: str,
+        username: str | None = None,
+        file_uuid: bytes | None = None,
+        src_ip: str | None = None,
+        message: str | None = None,
+    ) -> bool:
+        """Queue an event to be written. Returns False if it had to be spilled or dropped."""
+
+        e = f_models.AuditEvent(
+            action=action, username=username, file_uuid=file_uuid, src_ip=src_ip, message=message, ts=f_time.now()
+        )
+
+        try:
+            if self._block_timeout > 0:
+                self._queue.put(e, timeout=self._block_timeout)
+            else:
+                self._queue.put_nowait(e)
+        except queue.Full:
+            log.warning("audit log queue is full")
+            self._spill([e])
+            return False
+
+        return True
+
+    def _spill(self, events: list[f_models.AuditEvent]):
+        """Spill events to disk, or drop them if that isn't possible."""
+
+        path = self.spill_path
+        if path is not None:
+            try:
+                with self._spill_lock, open(path, "a", encoding="utf-8") as f:
+                    f.write("".join(_to_json(e) + "\n" for e in events))
+
+                EVENTS.inc(len(events), result="spilled")
+                return
+            except OSError as e:
+                log.error("failed to spill audit events to %s: %s", path, str(e))
+
+        log.error("dropping %d audit events", len(events))
+        EVENTS.inc(len(events), result="dropped")
+
+    def _write(self, events: list[f_models.AuditEvent]) -> int:
+        """Write a batch of events, spilling them if the database fails. Returns the number of events written."""
+
+        if not events:
+            return 0
+
+        try:
+            n = self._db.add_audit_events(events)
+        except (sqlite3.Error, f_exc.InvalidState) as e:
+            # e.g. the database is locked, or no connection freed up in time
+            log.error("failed to write %d audit events: %s", len(events), str(e))
+            self._spill(events)
+            return 0
+
+        EVENTS.inc(n, result="written")
+        return n
+
+    def _get_batch(self, timeout: float | None) -> list[f_models.AuditEvent]:
+        """
+        Take up to batch_size events off the queue.
+
+        If timeout is None, only the events already queued are taken. Otherwise, this waits up to timeout seconds for
+        a full batch.
+        """
+
+        batch: list[f_models.AuditEvent] = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while len(batch) < self._batch_size:
+            try:
+                if deadline is None:
+                    e = self._queue.get_nowait()
+                else:
+                    e = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+
+            if e is not None:
+                batch.append(e)
+            elif deadline is not None:
+                break
+
+        return batch
+
+    def flush(self) -> int:
+        """Write all of the queued events now. Returns the number of events written."""
+
+        total = 0
+        while batch := self._get_batch(None):
+            total += self._write(batch)
+
+        return total
+
+    def replay_spilled(self) -> int:
+        """
+        Write the events spilled by processes that aren't running anymore, and remove their spill files.
+
+        Returns the number of events written.
+        """
+
+        if self._spill_dir is None:
+            return 0
+
+        total = 0
+        for path in glob.glob(os.path.join(glob.escape(self._spill_dir), f"{SPILL_PREFIX}*{SPILL_SUFFIX}")):
+            pid = os.path.basename(path)[len(SPILL_PREFIX) : -len(SPILL_SUFFIX)]
+            if not pid.isdigit() or int(pid) == os.getpid() or _is_running(int(pid)):
+                continue
+
+            # claim the file, so another process starting at the same time doesn't write it too
+            claimed = f"{path}.{os.getpid()}"
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                continue
+
+            with open(claimed, encoding="utf-8") as f:
+                events = []
+                for line in f:
+                    try:
+                        events.append(_from_json(line))
+                    except (ValueError, KeyError, TypeError):
+                        log.error("skipping corrupted audit event in %s: %r", path, line)
+
+            for i in range(0, len(events), self._batch_size):
+                total += self._write(events[i : i + self._batch_size])
+
+            os.unlink(claimed)
+
+        if total > 0:
+            log.info("wrote %d spilled audit events", total)
+
+        return total
+
+    def _run(self):
+        """Background thread entrypoint"""
+
+        while not self._stop.is_set():
+            try:
+                self._write(self._get_batch(self._interval))
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception("failed to write audit events")
+
+        self.flush()
+
+    def start(self):
+        """Start writing events in a background thread."""
+
+        if self._thread is not None:
+            raise f_exc.InvalidState("the audit log is already running")
+
+        try:
+            self.replay_spilled()
+        except OSError as e:
+            log.error("failed to replay spilled audit events: %s", str(e))
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="filedrop-audit", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, waiting for it to write the queued events."""
+
+        if self._thread is None:
+            raise f_exc.InvalidState("the audit log isn't running")
+
+        self._stop.set()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # it isn't waiting for events then
+            pass
+
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,230 @@
+"""
+Authentication with passwords and API keys.
+
+Passwords are hashed with scrypt, which is deliberately slow and memory hungry, so it's too expensive to run on every
+request of a client that sends its password each time. Credentials that were verified are cached for a short time,
+keyed by a HMAC of the credentials with a per-process random key, so the cache never holds them in the clear.
+
+Hashing runs on a small thread pool (scrypt releases the GIL), with a limit on how many hashes can be waiting for it.
+Past that, checking a password raises Overloaded right away, so a burst of logins can't take every request thread (or
+all of the CPU and memory) away from file transfers. The scrypt parameters are stored with each hash, and a password is
+rehashed with the current parameters when it's checked, so changing them upgrades users as they log in.
+
+API keys are random, so they don't need a slow hash to be safe at rest. They're stored as a HMAC (keyed by the server
+secret) and looked up by it with a unique index, which is cheap enough that it doesn't need the cache to be fast.
+"""
+
+import concurrent.futures
+import hashlib
+import hmac
+import logging
+import secrets
+import threading
+import typing
+
+import filedrop.lib.cache as f_cache
+import filedrop.lib.database as f_db
+import filedrop.lib.exc as f_exc
+import filedrop.lib.models as f_models
+import filedrop.lib.utils as f_utils
+
+log = logging.getLogger(__name__)
+
+# API keys start with this, so they're recognizable (e.g. by secret scanners)
+API_KEY_PREFIX = "fd_"
+
+# random bytes in an API key
+API_KEY_BYTES = 32
+
+# how many verified credentials are cached per process, and for how long
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CACHE_TTL = 60  # seconds
+
+# how many passwords are hashed at once per process, and how many more can wait for a turn
+DEFAULT_HASH_WORKERS = 2
+DEFAULT_HASH_QUEUE = 16
+
+T = typing.TypeVar("T")
+
+
+class Authenticator:
+    """
+    Checks the credentials of users, and manages their API keys.
+
+    Changes to a user (password, API key, or being disabled) can take up to cache_ttl seconds to apply to credentials
+    that were already verified in other processes.
+    """
+
+    def __init__(
+        self,
+        db: f_db.Database,
+        secret: str | bytes | None = None,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+        cache_ttl: int = DEFAULT_CACHE_TTL,
+        scrypt_params: f_models.ScryptParams = f_models.DEFAULT_SCRYPT_PARAMS,
+        hash_workers: int = DEFAULT_HASH_WORKERS,
+        hash_queue: int = DEFAULT_HASH_QUEUE,
+        admins: list[str] | None = None,
+    ):
+        """
+        Set up the authenticator.
+
+        - secret: key for the HMAC of the stored API keys. Changing it invalidates every API key.
+        - cache_size: max number of verified credentials to cache (0 disables the cache)
+        - cache_ttl: how long to cache verified credentials for (in seconds, 0 disables the cache)
+        - scrypt_params: scrypt parameters for new password hashes
+        - hash_workers: number of threads to hash passwords on
+        - hash_queue: max number of passwords waiting to be hashed, past that they're rejected with Overloaded
+        - admins: usernames of the users that can use the admin API
+        """
+
+        scrypt_params.validate()
+        if hash_workers <= 0 or hash_queue < 0:
+            raise f_exc.BadArgs(f"invalid password hashing settings, workers={hash_workers} queue={hash_queue}")
+
+        self._db = db
+        self._secret = secret.encode() if isinstance(secret, str) else secret or b""
+
+        self._cache_key = secrets.token_bytes(32)
+        self._cache: f_cache.LRUCache[bytes, f_models.User] = f_cache.LRUCache(cache_size, ttl=cache_ttl)
+
+        self._scrypt_params = scrypt_params
+        self._admins = frozenset(admins or [])
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix="filedrop-hash")
+        self._slots = threading.BoundedSemaphore(hash_workers + hash_queue)
+
+    @property
+    def cache(self) -> f_cache.LRUCache[bytes, f_models.User]:
+        """The cache of verified credentials."""
+
+        return self._cache
+
+    @property
+    def scrypt_params(self) -> f_models.ScryptParams:
+        """The scrypt parameters new password hashes are made with."""
+
+        return self._scrypt_params
+
+    def is_admin(self, user: f_models.User) -> bool:
+        """Check if a user can use the admin API."""
+
+        return user.username in self._admins and not user.is_anon
+
+    def _hash(self, fn: typing.Callable[..., T], *args) -> T:
+        """Run a password hashing function on the pool, raising Overloaded if too many are already waiting."""
+
+        if not self._slots.acquire(blocking=False):  # pylint: disable=consider-using-with
+            raise f_exc.Overloaded("too many passwords are being checked, try again later")
+
+        try:
+            return self._pool.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Stop the hashing threads."""
+
+        self._pool.shutdown(wait=True)
+
+    def _cache_id(self, kind: str, *creds: str) -> bytes:
+        return hmac.digest(self._cache_key, "\0".join((kind,) + creds).encode(), hashlib.sha256)
+
+    def hash_api_key(self, key: str) -> str:
+        """Get the hash of an API key that's stored in the database."""
+
+        return hmac.new(self._secret, key.encode(), hashlib.sha256).hexdigest()
+
+    def new_api_key(self, username: str) -> str | None:
+        """Generate a new API key for a user, replacing their previous one. Returns None if the user doesn't exist."""
+
+        key = API_KEY_PREFIX + secrets.token_urlsafe(API_KEY_BYTES)
+        if not self._db.set_api_key(username, f_utils.gen_uuid(), self.hash_api_key(key)):
+            return None
+
+        # the old key could be cached
+        self._cache.clear()
+
+        return key
+
+    def delete_api_key(self, username: str) -> bool:
+        """Delete the API key of a user. Returns False if they didn't have one."""
+
+        if not self._db.delete_api_key(username):
+            return False
+
+        self._cache.clear()
+
+        return True
+
+    def check_api_key(self, key: str) -> f_models.User | None:
+        """Get the (enabled) user an API key belongs to, or None if it isn't valid."""
+
+        cid = self._cache_id("key", key)
+        user = self._cache.get(cid)
+        if user is not None:
+            return user
+
+        if not key.startswith(API_KEY_PREFIX):
+            return None
+
+        # the key could be changed while it's looked up, and then it can't be cached
+        generation = self._cache.generation
+        user = self._db.get_api_key_user(self.hash_api_key(key))
+        if user is None or not user.enabled:
+            return None
+
+        self._cache.put(cid, user, generation)
+
+        return user
+
+    def check_password(self, username: str, password: str) -> f_models.User | None:
+        """
+        Get the user for a username and password, or None if they don't exist, are disabled, or it's wrong.
+
+        Raises Overloaded if too many passwords are already being checked.
+        """
+
+        cid = self._cache_id("password", username, password)
+        user = self._cache.get(cid)
+        if user is not None:
+            return user
+
+        # the password could be changed while it's checked, and then it can't be cached
+        generation = self._cache.generation
+        user = self._db.get_user(username)
+        if user is None or not user.enabled or user.is_anon or user.password_hash is None:
+            return None
+
+        if not self._hash(user.check_password, password):
+            log.debug("wrong password for %s", user)
+            return None
+
+        # upgrade the hash to the current parameters while the password is at hand
+        if user.scrypt_params != self._scrypt_params:
+            log.info("rehashing the password for %s with %s", user, self._scrypt_params)
+            self._hash(user.update_password, password, self._scrypt_params)
+            if not self._db.update_user_pw(user):
+                log.error("failed to save the rehashed password for %s", user)
+
+        self._cache.put(cid, user, generation)
+
+        return user
+
+    def new_user(self, username: str, password: str) -> f_models.User:
+        """Construct a new user object, hashing the password on the pool with the current parameters."""
+
+        return self._hash(f_models.User.new, username, password, self._scrypt_params)
+
+    def update_password(self, user: f_models.User, password: str) -> bool:
+        """Change the password of a user. Returns False on failure."""
+
+        self._hash(user.update_password, password, self._scrypt_params)
+        del password
+
+        if not self._db.update_user_pw(user):
+            return False
+
+        # the old password could be cached
+        self._cache.clear()
+
+        return True
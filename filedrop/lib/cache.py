@@ -0,0 +1,126 @@
+"""In-process caching helpers"""
+
+import collections
+import threading
+import time
+import typing
+
+import filedrop.lib.exc as f_exc
+
+K = typing.TypeVar("K")
+V = typing.TypeVar("V")
+
+
+class LRUCache(typing.Generic[K, V]):
+    """
+    A thread-safe LRU cache with a bounded number of entries.
+
+    If a ttl (in seconds) is specified, entries older than that are treated as missing.
+    A max_size or ttl of 0 disables the cache.
+
+    To cache a value that was looked up while it could be invalidated, get the generation before looking it up and pass
+    it to put(). The value is dropped if anything was invalidated since, as it could be what was looked up.
+    """
+
+    def __init__(self, max_size: int, ttl: float | None = None):
+        if max_size < 0:
+            raise f_exc.BadArgs(f"invalid cache size: {max_size}")
+
+        if ttl is not None and ttl < 0:
+            raise f_exc.BadArgs(f"invalid cache ttl: {ttl}")
+
+        # nothing would be fresh for long enough to be used
+        if ttl == 0:
+            max_size = 0
+
+        self._max_size = max_size
+        self._ttl = ttl
+
+        # key -> (insertion time, value), ordered from least to most recently used
+        self._entries: collections.OrderedDict[K, tuple[float, V]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._hits = 0
+        self._misses = 0
+
+        # bumped by every invalidation
+        self._generation = 0
+
+    def get(self, key: K) -> V | None:
+        """Get the value for the key, or None if it isn't cached (or has expired)."""
+
+        with self._lock:
+            e = self._entries.get(key)
+            if e is not None and self._ttl is not None and time.monotonic() - e[0] > self._ttl:
+                del self._entries[key]
+                e = None
+
+            if e is None:
+                self._misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._hits += 1
+
+            return e[1]
+
+    @property
+    def generation(self) -> int:
+        """The number of invalidations so far, to pass to put()."""
+
+        return self._generation
+
+    def put(self, key: K, value: V, generation: int | None = None):
+        """
+        Cache the value for the key, evicting the least recently used entry if the cache is full.
+
+        If generation is given and anything was invalidated since it was taken, the value isn't cached.
+        """
+
+        if self._max_size == 0:
+            return
+
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: K):
+        """Remove the key from the cache, if it's cached."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._generation += 1
+
+    def clear(self):
+        """Remove every entry from the cache."""
+
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    @property
+    def hits(self) -> int:
+        """Number of lookups that found a cached value."""
+
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        """Number of lookups that didn't find a cached value."""
+
+        return self._misses
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __repr__(self) -> str:
+        return f"<LRUCache {len(self)}/{self._max_size} entries, {self._hits} hits, {self._misses} misses>"
+
+    def __str__(self) -> str:
+        return repr(self)
@@ -0,0 +1,304 @@
+"""
+Compression of blobs at rest, and of downloads in transit.
+
+A codec compresses a blob as it's written, and decompresses it as it's read. The codec of a blob is recorded in the
+database (NULL for blobs stored as-is). Codecs that are also an HTTP content-coding can be sent to clients without
+decompressing them. More codecs can be added with register_codec().
+
+Downloads of text-like files can also be compressed on the fly with one of the TRANSFER_ENCODINGS.
+"""
+
+import abc
+import bz2
+import collections
+import gzip
+import io
+import lzma
+import logging
+import math
+import os
+import typing
+import zlib
+
+import filedrop.lib.exc as f_exc
+import filedrop.lib.hashing as f_hashing
+
+log = logging.getLogger(__name__)
+
+# codec name to request storing a file as-is
+NO_CODEC = "none"
+
+# how much of the start of a file is checked to decide if it's worth compressing
+SAMPLE_SIZE = 64 * 1024
+
+# bits per byte, anything more random than this is most likely already compressed (or encrypted)
+MAX_ENTROPY = 7.5
+
+# files smaller than this aren't worth the codec overhead
+MIN_SIZE = 1024
+
+# what reading corrupted (or truncated) compressed data can raise
+DECOMPRESS_ERRORS = (OSError, EOFError, zlib.error, lzma.LZMAError)
+
+# HTTP content-codings downloads can be compressed with on the fly (in order of preference), and their zlib wbits
+TRANSFER_ENCODINGS = {"gzip": 31, "deflate": 15}
+
+# compression level for downloads, favoring speed since it's paid on every uncached download
+TRANSFER_LEVEL = 6
+
+# how much of the source file is compressed at a time when compressing a download
+READ_SIZE = 1024 * 1024  # 1mb
+
+# mimetypes outside of text/* that are text
+TEXT_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/x-ndjson",
+    "application/x-sh",
+    "application/x-yaml",
+    "application/xml",
+    "application/yaml",
+}
+
+
+class Codec(abc.ABC):
+    """A compression format for blobs."""
+
+    # recorded in the database, so it can't change once blobs are written with it
+    name: str
+
+    # the HTTP content-coding for the format, if clients can decompress it themselves
+    content_encoding: str | None = None
+
+    @abc.abstractmethod
+    def compressor(self) -> f_hashing.Compressor:
+        """Get a new incremental compressor."""
+
+    @abc.abstractmethod
+    def open(self, f: typing.BinaryIO) -> typing.BinaryIO:
+        """Wrap a file of compressed data with a file that reads the decompressed data."""
+
+    def __repr__(self) -> str:
+        return f"<Codec {self.name}>"
+
+    def __str__(self) -> str:
+        return repr(self)
+
+
+class GzipCodec(Codec):
+    """zlib deflate, in a gzip container so it can be sent as Content-Encoding: gzip"""
+
+    name = "gzip"
+    content_encoding = "gzip"
+
+    def __init__(self, level: int = 6):
+        self._level = level
+
+    def compressor(self) -> f_hashing.Compressor:
+        # wbits 31 is the gzip container, without a file name or mtime so the output only depends on the data
+        return zlib.compressobj(self._level, zlib.DEFLATED, 31)
+
+    def open(self, f: typing.BinaryIO) -> typing.BinaryIO:
+        return typing.cast(typing.BinaryIO, gzip.GzipFile(fileobj=f, mode="rb"))
+
+
+class Bz2Codec(Codec):
+    """bzip2, smaller than gzip but slower"""
+
+    name = "bz2"
+
+    def __init__(self, level: int = 9):
+        self._level = level
+
+    def compressor(self) -> f_hashing.Compressor:
+        return bz2.BZ2Compressor(self._level)
+
+    def open(self, f: typing.BinaryIO) -> typing.BinaryIO:
+        return typing.cast(typing.BinaryIO, bz2.BZ2File(f, mode="rb"))
+
+
+class LzmaCodec(Codec):
+    """xz, the smallest output but the slowest to compress"""
+
+    name = "lzma"
+
+    def __init__(self, preset: int = 6):
+        self._preset = preset
+
+    def compressor(self) -> f_hashing.Compressor:
+        return lzma.LZMACompressor(preset=self._preset)
+
+    def open(self, f: typing.BinaryIO) -> typing.BinaryIO:
+        return typing.cast(typing.BinaryIO, lzma.LZMAFile(f, mode="rb"))
+
+
+_CODECS: dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    """Make a codec available by its name, replacing any codec with the same name."""
+
+    if not codec.name or codec.name == NO_CODEC:
+        raise f_exc.BadArgs(f"invalid codec name: {codec.name}")
+
+    _CODECS[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    """Get a codec by name. Raises BadArgs if there's no such codec."""
+
+    c = _CODECS.get(name)
+    if c is None:
+        raise f_exc.BadArgs(f"unknown codec: {name}")
+
+    return c
+
+
+def get_codec_names() -> list[str]:
+    """Get the names of the available codecs."""
+
+    return list(_CODECS)
+
+
+for _c in [GzipCodec(), Bz2Codec(), LzmaCodec()]:
+    register_codec(_c)
+
+
+def entropy(sample: bytes) -> float:
+    """Get the Shannon entropy of the sample, in bits per byte."""
+
+    if not sample:
+        return 0.0
+
+    n = len(sample)
+    return -sum(c / n * math.log2(c / n) for c in collections.Counter(sample).values())
+
+
+def is_compressible(sample: bytes, complete: bool) -> bool:
+    """
+    Guess if a file is worth compressing from a sample of its start.
+
+    complete is True if the sample is the whole file.
+    """
+
+    if complete and len(sample) < MIN_SIZE:
+        return False
+
+    return entropy(sample[:SAMPLE_SIZE]) < MAX_ENTROPY
+
+
+def is_text_type(mimetype: str) -> bool:
+    """Check if a mimetype is for text, which is worth compressing."""
+
+    return mimetype.startswith("text/") or mimetype in TEXT_TYPES or mimetype.endswith(("+xml", "+json"))
+
+
+def transfer_compressor(encoding: str) -> f_hashing.Compressor:
+    """Get a new compressor for one of the TRANSFER_ENCODINGS. Raises BadArgs for any other encoding."""
+
+    wbits = TRANSFER_ENCODINGS.get(encoding)
+    if wbits is None:
+        raise f_exc.BadArgs(f"unknown transfer encoding: {encoding}")
+
+    return zlib.compressobj(TRANSFER_LEVEL, zlib.DEFLATED, wbits)
+
+
+class CompressingReader(io.RawIOBase):
+    """
+    A file that reads the compressed contents of another file, compressing them as they're read.
+
+    Subclasses can see the compressed output as it's produced with _output(), and _finished() is called once all of
+    it has been produced. Closing the reader closes the source file.
+    """
+
+    def __init__(self, f: typing.BinaryIO, compressor: f_hashing.Compressor, read_size: int = READ_SIZE):
+        super().__init__()
+        self._f = f
+        self._compressor = compressor
+        self._read_size = read_size
+        self._buf = memoryview(b"")
+        self._done = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buf and not self._done:
+            data = self._f.read(self._read_size)
+            if data:
+                out = self._compressor.compress(data)
+            else:
+                out = self._compressor.flush()
+                self._done = True
+
+            if out:
+                self._output(out)
+            if self._done:
+                self._finished()
+            self._buf = memoryview(out)
+
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+
+        return n
+
+    def _output(self, data: bytes):
+        """Called with every piece of the compressed output."""
+
+    def _finished(self):
+        """Called once the whole file has been compressed."""
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+
+class CopyingReader(CompressingReader):
+    """
+    A CompressingReader that also writes the compressed output to a temp file, which is handed to save() once the
+    whole file has been compressed. The temp file is removed if the reader is closed before then.
+    """
+
+    def __init__(
+        self,
+        f: typing.BinaryIO,
+        compressor: f_hashing.Compressor,
+        tmp: typing.BinaryIO,
+        tmp_path: str,
+        save: typing.Callable[[str], typing.Any],
+    ):
+        super().__init__(f, compressor)
+        self._tmp: typing.BinaryIO | None = tmp
+        self._tmp_path = tmp_path
+        self._save = save
+
+    def _output(self, data: bytes):
+        if self._tmp is None:
+            return
+
+        # failing to make the copy shouldn't fail the read
+        try:
+            self._tmp.write(data)
+        except OSError as e:
+            log.error("failed to write compressed copy to %s: %s", self._tmp_path, str(e))
+            self._discard()
+
+    def _finished(self):
+        if self._tmp is None:
+            return
+
+        self._tmp.close()
+        self._tmp = None
+        self._save(self._tmp_path)
+
+    def _discard(self):
+        if self._tmp is not None:
+            self._tmp.close()
+            self._tmp = None
+            os.unlink(self._tmp_path)
+
+    def close(self):
+        self._discard()
+        super().close()
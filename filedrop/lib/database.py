@@ -1,76 +1,424 @@
+# pylint: disable=too-many-lines
+
 import contextlib
+import copy
 import logging
 import os
+import queue
+import re
 import sqlite3
+import threading
+import typing
 from datetime import datetime
 
 from filedrop import ROOT_DIR
+import filedrop.lib.cache as f_cache
 import filedrop.lib.exc as f_exc
+import filedrop.lib.metrics as f_metrics
 import filedrop.lib.models as f_models
 import filedrop.lib.time as f_time
 
 log = logging.getLogger(__name__)
 
+QUERY_SECONDS = f_metrics.REGISTRY.histogram(
+    "filedrop_db_query_seconds", "Time spent in each database method", f_metrics.QUERY_BUCKETS
+)
+
 ANONYMOUS_USERNAME = "anonymous"
 
+DEFAULT_POOL_SIZE = 4
+
+# the file metadata cache is per-process, so the ttl bounds how stale it can be after another process deletes a file
+DEFAULT_FILE_CACHE_SIZE = 10000
+DEFAULT_FILE_CACHE_TTL = 60  # seconds
+
+# the columns a File is made from, see _file_from_row()
+FILE_COLUMNS = (
+    "files.uuid, name, size, hash, path, users.username, expiration_time, max_downloads, files.created_at, codec"
+)
+
+# what files can be listed by, and the column for each
+LIST_SORTS = {"created": "files.created_at", "size": "files.size"}
+
+# max number of files in a page of a listing
+MAX_LIST_LIMIT = 1000
+
+# a position in a listing of files: the value of the sort column, and the id of the file
+ListKey = tuple[str | int, int]
+
+# max number of values bound to a single query (SQLite's limit is 999 in older versions)
+MAX_QUERY_PARAMS = 500
+
+# migration scripts are named like 001_description.sql, and applied in order of their number
+MIGRATION_NAME_PAT = re.compile(r"^(\d+)_[\w-]+\.sql$")
+
+# a migration script with this line is a backfill: it's run repeatedly (one transaction each time) until it doesn't
+# change any rows, so it should only change a batch of rows that still need it, e.g. UPDATE ... WHERE id IN (SELECT ...
+# WHERE col IS NULL LIMIT 1000). it's recorded in the migrations table by the runner once it's done.
+BACKFILL_MARKER = "-- filedrop: backfill"
+
+# only the runner records migrations, a script that did would stop a backfill after its first batch
+RECORD_MIGRATION_PAT = re.compile(r"\bINSERT\b[^;]*?\bINTO\s+`?migrations`?[\s(]", re.IGNORECASE)
+
+# how long to wait for another process to finish applying a migration
+MIGRATION_LOCK_TIMEOUT = 600  # seconds
+
+# connections inherited from the parent process by a fork, see Database._check_fork()
+_INHERITED_CONNS: list[sqlite3.Connection] = []
+
+# how long to wait for a connection from the pool before giving up
+POOL_TIMEOUT = 30  # seconds
+
+# what a PRAGMA name/value can look like, since they can't be passed as query parameters
+VALID_PRAGMA_PAT = re.compile(r"^[a-z_]+$")
+
+PragmaValueType = int | str
+
+# defaults for the tuned SQLite settings
+DEFAULT_JOURNAL_MODE = "wal"
+DEFAULT_SYNCHRONOUS = "normal"
+DEFAULT_CACHE_SIZE = -16384  # negative is in KiB, so 16mb per connection
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024  # 256mb
+DEFAULT_BUSY_TIMEOUT = 5000  # ms
+
+JOURNAL_MODES = ["delete", "truncate", "persist", "memory", "wal", "off"]
+SYNCHRONOUS_LEVELS = ["off", "normal", "full", "extra"]
+
+# how long a download claim can be used to resume a download without counting against the quota
+DOWNLOAD_CLAIM_LIFETIME = 24 * 60 * 60  # 1 day
+
+# how stale the last use of a cached compressed copy can get before a hit records it. eviction only needs a rough
+# order, and this keeps most hits from taking the write lock
+VARIANT_TOUCH_INTERVAL = 60  # seconds
+
+# called while adding a file, with the blob that's stored for its hash (see Database.add_new_file())
+PlaceBlobFunc = typing.Callable[[f_models.File, f_models.Blob | None], bool]
+
+
+def gen_pragmas(
+    journal_mode: str = DEFAULT_JOURNAL_MODE,
+    synchronous: str = DEFAULT_SYNCHRONOUS,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    mmap_size: int = DEFAULT_MMAP_SIZE,
+    busy_timeout: int = DEFAULT_BUSY_TIMEOUT,
+) -> dict[str, PragmaValueType]:
+    """
+    Generate the PRAGMAs for a tuned database connection.
+
+    WAL lets readers run concurrently with a writer, and synchronous=normal only fsyncs
+    the WAL at checkpoints instead of on every commit. Raises BadArgs on invalid values.
+    """
+
+    journal_mode = journal_mode.lower()
+    if journal_mode not in JOURNAL_MODES:
+        raise f_exc.BadArgs(f"invalid journal mode {journal_mode}, must be one of {JOURNAL_MODES}")
+
+    synchronous = synchronous.lower()
+    if synchronous not in SYNCHRONOUS_LEVELS:
+        raise f_exc.BadArgs(f"invalid synchronous level {synchronous}, must be one of {SYNCHRONOUS_LEVELS}")
+
+    if mmap_size < 0:
+        raise f_exc.BadArgs(f"invalid mmap size: {mmap_size}")
+
+    if busy_timeout < 0:
+        raise f_exc.BadArgs(f"invalid busy timeout: {busy_timeout}")
+
+    # the busy timeout goes first, so switching the journal mode waits for other connections
+    return {
+        "busy_timeout": busy_timeout,
+        "journal_mode": journal_mode,
+        "synchronous": synchronous,
+        "cache_size": cache_size,
+        "mmap_size": mmap_size,
+    }
+
 
 class Database:
     """Manager for the local database that handles auth, audit data and file metadata."""
 
-    def __init__(self, path=":memory:"):
+    def __init__(
+        self,
+        path=":memory:",
+        pool_size: int = DEFAULT_POOL_SIZE,
+        pragmas: dict[str, PragmaValueType] | None = None,
+        file_cache_size: int = DEFAULT_FILE_CACHE_SIZE,
+        file_cache_ttl: int = DEFAULT_FILE_CACHE_TTL,
+    ):
+        """
+        Open the database and run the migrations.
+
+        - pool_size: max number of connections that are opened, to be shared across threads
+        - pragmas: PRAGMA name -> value to set on every new connection
+        - file_cache_size | file_cache_ttl: number of File lookups to cache, and for how many seconds (0 disables it)
+        """
+
         self._path = path
 
-        self._conn: sqlite3.Connection | None = None
+        if pool_size < 1:
+            raise f_exc.BadArgs(f"invalid database pool size: {pool_size}")
+
+        # every connection to an in-memory database gets its own database, so there can only be one
+        self._pool_size = 1 if path == ":memory:" else pool_size
+
+        self._pragmas = pragmas or {}
+        for k, v in self._pragmas.items():
+            if not VALID_PRAGMA_PAT.match(k) or (isinstance(v, str) and not VALID_PRAGMA_PAT.match(v)):
+                raise f_exc.BadArgs(f"invalid database pragma: {k} = {v}")
+
+        # idle connections are handed out most-recently-used first
+        self._pool: queue.LifoQueue[sqlite3.Connection] | None = None
+        self._conns: list[sqlite3.Connection] = []
+        self._pool_lock = threading.Lock()
+        self._pid = os.getpid()
         self._migrated = False
 
+        self._file_cache: f_cache.LRUCache[bytes, f_models.File] = f_cache.LRUCache(file_cache_size, ttl=file_cache_ttl)
+
         self._connect()
         self._migrate()
 
     def _connect(self):
-        """Open a connection to the database"""
+        """Set up the connection pool, opening the first connection to the database"""
 
-        if self._conn is not None:
+        if self._pool is not None:
             raise f_exc.InvalidState("a database connection already exists")
 
-        self._conn = sqlite3.connect(self._path)
+        self._pool = queue.LifoQueue(maxsize=self._pool_size)
+        self._pool.put(self._new_conn())
 
-    def _migrate(self):
-        """Execute the database migrations"""
+    def _new_conn(self) -> sqlite3.Connection:
+        """Open a new connection to the database and add it to the set of pooled connections"""
+
+        # connections are only ever used by one thread at a time, but not always the thread that opened them.
+        # transactions are managed explicitly by cursor(), instead of implicitly by the sqlite3 module
+        conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._init_conn(conn)
+
+        self._conns.append(conn)
+        log.debug("opened database connection %d/%d", len(self._conns), self._pool_size)
+
+        return conn
+
+    def _init_conn(self, conn: sqlite3.Connection):
+        """Apply the per-connection settings to a new connection"""
+
+        for k, v in self._pragmas.items():
+            conn.execute(f"PRAGMA {k} = {v};")
 
-        if self._conn is None:
+    def _check_fork(self):
+        """Drop the connections inherited from the parent process, if this is a forked child (e.g. a gunicorn worker)"""
+
+        # in-memory databases don't have a file to share, so the child just has its own copy
+        if os.getpid() == self._pid or self._path == ":memory:":
+            return
+
+        log.debug("dropping %d database connections inherited from process %d", len(self._conns), self._pid)
+        self._pid = os.getpid()
+
+        # a SQLite connection can't be used by two processes, and closing it here could release the parent's locks, so
+        # they're kept open (and referenced, so they aren't closed when garbage collected)
+        _INHERITED_CONNS.extend(self._conns)
+        self._conns = []
+        self._pool_lock = threading.Lock()
+        if self._pool is not None:
+            self._pool = queue.LifoQueue(maxsize=self._pool_size)
+
+    def _checkout(self) -> sqlite3.Connection:
+        """Take a connection out of the pool, opening a new one if the pool isn't full yet"""
+
+        self._check_fork()
+        if self._pool is None:
             raise f_exc.InvalidState("no database connection exists")
 
-        with self.cursor() as c:
-            files = os.listdir(self.get_migrations_folder())
-            files.sort()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
 
-            for f in files:
-                if not f.endswith(".sql"):
-                    continue
+        with self._pool_lock:
+            if len(self._conns) < self._pool_size:
+                return self._new_conn()
+
+        try:
+            return self._pool.get(timeout=POOL_TIMEOUT)
+        except queue.Empty as e:
+            raise f_exc.InvalidState(f"timed out waiting for a database connection after {POOL_TIMEOUT}s") from e
+
+    @contextlib.contextmanager
+    def _connection(self):
+        """Get a connection from the pool for the duration of the with block"""
+
+        conn = self._checkout()
+        try:
+            yield conn
+        finally:
+            if self._pool is not None:
+                self._pool.put(conn)
+
+    @classmethod
+    def list_migrations(cls) -> list[tuple[int, str]]:
+        """Get the (number, path) of every migration script, in the order they're applied."""
+
+        migrations: dict[int, str] = {}
+        for f in os.listdir(cls.get_migrations_folder()):
+            if not f.endswith(".sql"):
+                continue
+
+            m = MIGRATION_NAME_PAT.match(f)
+            if m is None:
+                raise f_exc.MigrationFailure(f"invalid migration file name: {f}")
+
+            n = int(m.group(1))
+            if n in migrations:
+                raise f_exc.MigrationFailure(f"duplicate migration number {n}: {f}, {os.path.basename(migrations[n])}")
+
+            migrations[n] = os.path.join(cls.get_migrations_folder(), f)
+
+        return sorted(migrations.items())
+
+    @staticmethod
+    def _applied_migrations(conn: sqlite3.Connection) -> set[int]:
+        # a fresh database doesn't have the migrations table yet
+        try:
+            return {r[0] for r in conn.execute("SELECT migration_number FROM migrations;")}
+        except sqlite3.OperationalError:
+            return set()
+
+    @staticmethod
+    def _split_sql(script: str) -> list[str]:
+        """Split a script into statements, so they can run in one transaction (executescript() commits first)."""
+
+        stmts = []
+        buf = ""
+        for part in script.split(";"):
+            buf += part + ";"
+            if sqlite3.complete_statement(buf):
+                stmts.append(buf)
+                buf = ""
+
+        # whatever is left after the last ; is the trailing ; added above, or comments
+        if buf[:-1].strip():
+            stmts.append(buf[:-1])
+
+        return stmts
+
+    def _run_migration(self, conn: sqlite3.Connection, number: int, path: str):
+        """
+        Apply a migration, unless it was applied while waiting for the lock.
+
+        Each run of the script is its own transaction, which records the migration along with its changes. A backfill
+        migration is run again until it doesn't change anything, and is only recorded after that.
+        """
 
-                p = os.path.join(self.get_migrations_folder(), f)
+        with open(path, "r", encoding="utf-8") as f:
+            script = f.read()
 
-                log.debug("executing migration script: %s", p)
+        stmts = self._split_sql(script)
+        backfill = BACKFILL_MARKER in script.splitlines()
 
-                with open(p, "r", encoding="utf-8") as f:
-                    sql = f.read()
-                    try:
-                        c.executescript(sql)
-                    except sqlite3.OperationalError as e:
-                        raise f_exc.MigrationFailure(f"failed to execute migration file: {p} - {str(e)}")
+        if any(RECORD_MIGRATION_PAT.search(s) for s in stmts):
+            raise f_exc.MigrationFailure(f"migration file {path} records itself, that's done by the migration runner")
 
-        log.info("finished database migrations")
+        batches = 0
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE;")
+                if number in self._applied_migrations(conn):
+                    conn.rollback()
+                    return
+
+                changes = conn.total_changes
+                for stmt in stmts:
+                    conn.execute(stmt)
+                changed = conn.total_changes - changes
+
+                done = not backfill or changed == 0
+                if done:
+                    conn.execute("INSERT OR IGNORE INTO `migrations` (migration_number) VALUES (?);", (number,))
+                conn.commit()
+            except sqlite3.Error as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise f_exc.MigrationFailure(f"failed to execute migration file: {path} - {str(e)}") from e
+
+            if done:
+                break
+
+            batches += 1
+            log.debug("backfill migration %s: batch %d changed %d rows", path, batches, changed)
+
+        log.info("applied migration %s", path)
+
+    def _migrate(self):
+        """Apply the migrations that haven't been applied to the database yet"""
+
+        if self._pool is None:
+            raise f_exc.InvalidState("no database connection exists")
+
+        migrations = self.list_migrations()
+
+        with self._connection() as conn:
+            applied = self._applied_migrations(conn)
+            pending = [(n, p) for (n, p) in migrations if n not in applied]
+
+            unknown = applied - {n for (n, _) in migrations}
+            if unknown:
+                log.warning("the database has migrations applied that don't exist here: %s", sorted(unknown))
+
+            if pending:
+                # other processes migrating the same database hold the write lock while they apply a migration, which
+                # can take a while (e.g. building an index on a big table), so wait longer than usual for it
+                busy_timeout = conn.execute("PRAGMA busy_timeout;").fetchone()[0]
+                conn.execute(f"PRAGMA busy_timeout = {MIGRATION_LOCK_TIMEOUT * 1000};")
+                try:
+                    for n, p in pending:
+                        self._run_migration(conn, n, p)
+                finally:
+                    conn.execute(f"PRAGMA busy_timeout = {busy_timeout};")
+
+        log.info("finished database migrations, %d applied", len(pending))
         self._migrated = True
 
+    def disconnect(self):
+        """
+        Close the idle connections, new ones are opened when they're needed.
+
+        This is for before forking (e.g. in the gunicorn master with --preload), so the children don't inherit open
+        connections. Connections that are in use are left alone.
+        """
+
+        self._check_fork()
+        if self._pool is None:
+            raise f_exc.InvalidState("no database connection exists")
+
+        # the only copy of an in-memory database is in its connection
+        if self._path == ":memory:":
+            return
+
+        with self._pool_lock:
+            while True:
+                try:
+                    conn = self._pool.get_nowait()
+                except queue.Empty:
+                    break
+
+                conn.close()
+                self._conns.remove(conn)
+
     def close(self):
-        """Close the database connection"""
+        """Close the database connections"""
 
-        if self._conn is None:
+        self._check_fork()
+        if self._pool is None:
             raise f_exc.InvalidState("no database connection exists")
 
-        self._conn.commit()
-        self._conn.close()
-        self._conn = None
+        with self._pool_lock:
+            for conn in self._conns:
+                conn.commit()
+                conn.close()
+
+            self._conns = []
+            self._pool = None
 
     def __enter__(self):
         return self
@@ -90,24 +438,71 @@ class Database:
 
         return os.path.join(ROOT_DIR, "migrations")
 
+    def get_pragmas(self) -> dict[str, PragmaValueType]:
+        """Get the effective values of the configured PRAGMAs, as reported by SQLite."""
+
+        vals = {}
+        with self.read_cursor() as c:
+            for k in self._pragmas:
+                r = c.execute(f"PRAGMA {k};").fetchone()
+                vals[k] = r[0] if r else None
+
+        return vals
+
+    @property
+    def file_cache(self) -> f_cache.LRUCache[bytes, f_models.File]:
+        """The cache of File lookups by UUID."""
+
+        return self._file_cache
+
+    @property
+    def pool_size(self) -> int:
+        """Max number of connections to the database."""
+
+        return self._pool_size
+
+    @contextlib.contextmanager
+    def read_cursor(self):
+        """
+        Get a cursor for read-only queries, on a connection that is reserved for the calling thread until the with block exits.
+
+        No transaction is opened (or committed), so each statement reads from its own snapshot.
+        """
+
+        with self._connection() as conn:
+            c = conn.cursor()
+            try:
+                yield c
+            finally:
+                c.close()
+
     @contextlib.contextmanager
     def cursor(self):
-        """Get a cursor for the database."""
+        """
+        Get a cursor inside of a write transaction, on a connection that is reserved for the calling thread until the with block exits.
 
-        if self._conn is None:
-            raise f_exc.InvalidState("no database connection exists")
+        The transaction is committed when the with block exits, or rolled back if an exception is raised.
+        """
 
-        try:
-            c = self._conn.cursor()
-            yield c
-        finally:
-            self._conn.commit()
-            c.close()
+        with self._connection() as conn:
+            c = conn.cursor()
+            try:
+                # take the write lock up front, a deferred transaction can't wait for it once it has read
+                c.execute("BEGIN IMMEDIATE;")
+                yield c
+            except BaseException:
+                conn.rollback()
+                raise
+            else:
+                conn.commit()
+            finally:
+                c.close()
 
+    @QUERY_SECONDS.time("method")
     def get_user(self, username: str) -> f_models.User | None:
         """Get a user by username from the database, or None if the user does not exist."""
 
-        with self.cursor() as c:
+        with self.read_cursor() as c:
             x = c.execute(
                 "SELECT uuid, password_hash, salt, enabled, is_anon FROM users WHERE username = ?;",
                 (username,),
@@ -121,10 +516,11 @@ class Database:
 
             return None
 
+    @QUERY_SECONDS.time("method")
     def get_user_id(self, username: str) -> int | None:
         """Get the ID for a user from the database. Returns the id if exists, otherwise None."""
 
-        with self.cursor() as c:
+        with self.read_cursor() as c:
             x = c.execute(
                 "SELECT id FROM users WHERE username = ?;",
                 (username,),
@@ -136,6 +532,7 @@ class Database:
 
             return None
 
+    @QUERY_SECONDS.time("method")
     def add_user(self, user: f_models.User) -> bool:
         """Add a new user to the database. Returns False on failure or duplicate username, else True."""
 
@@ -150,83 +547,827 @@ class Database:
                 log.debug("duplicate username, can't add to database: %s", user.username)
                 return False
 
+    @QUERY_SECONDS.time("method")
     def update_user_pw(self, user: f_models.User) -> bool:
         """Update the hash and salt fields for the specified user. Returns False on failure or no user found, else True."""
 
         with self.cursor() as c:
             x = c.execute(
-                "UPDATE users SET password_hash = ? AND salt = ? WHERE username = ?;",
+                "UPDATE users SET password_hash = ?, salt = ? WHERE username = ?;",
                 (user.password_hash, user.salt, user.username),
             )
             return x.rowcount == 1
 
+    @QUERY_SECONDS.time("method")
+    def set_api_key(self, username: str, uuid: bytes, key_hash: str) -> bool:
+        """
+        Set the API key for a user, replacing their previous key if they have one.
+
+        key_hash is the hash of the key, not the key itself. Returns False if the user doesn't exist, else True.
+        """
+
+        with self.cursor() as c:
+            try:
+                x = c.execute(
+                    "INSERT INTO apikeys (uuid, user, key) VALUES (?, (SELECT id FROM users WHERE username = ?), ?) ON CONFLICT(user) DO UPDATE SET uuid = excluded.uuid, key = excluded.key, deleted = FALSE, created_at = CURRENT_TIMESTAMP;",
+                    (uuid, username, key_hash),
+                )
+                return x.rowcount == 1
+            except sqlite3.IntegrityError:
+                log.debug("can't set the api key for user %s, user doesn't exist", username)
+                return False
+
+    @QUERY_SECONDS.time("method")
+    def get_api_key_user(self, key_hash: str) -> f_models.User | None:
+        """Get the user an API key (by the hash of the key) belongs to, or None if there's no such key or it was deleted."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT users.uuid, username, password_hash, salt, enabled, is_anon FROM apikeys JOIN users ON apikeys.user = users.id WHERE apikeys.key = ? AND NOT apikeys.deleted;",
+                (key_hash,),
+            )
+            r = x.fetchone()
+
+            if r:
+                return f_models.User(
+                    uuid=r[0], username=r[1], password_hash=r[2], salt=r[3], enabled=bool(r[4]), is_anon=bool(r[5])
+                )
+
+            return None
+
+    @QUERY_SECONDS.time("method")
+    def delete_api_key(self, username: str) -> bool:
+        """Delete the API key for a user. Returns False if the user didn't have one, else True."""
+
+        with self.cursor() as c:
+            x = c.execute(
+                "UPDATE apikeys SET deleted = TRUE WHERE user = (SELECT id FROM users WHERE username = ?) AND NOT deleted;",
+                (username,),
+            )
+            return x.rowcount == 1
+
     def get_anon_user(self) -> f_models.User | None:
         """Get the anonymous user."""
 
         return self.get_user("anonymous")
 
-    def add_new_file(self, file: f_models.File) -> datetime | None:
-        """Add a new file upload. Returns the upload datetime on success, otherwise None"""
+    def _insert_file(
+        self,
+        c: sqlite3.Cursor,
+        file: f_models.File,
+        stored_size: int | None,
+        place: PlaceBlobFunc | None,
+        stale: list[bytes],
+    ) -> datetime | None:
+        """
+        Insert a file and reference its blob, with the cursor of a transaction. Returns the upload datetime.
+
+        The UUIDs of other files that were changed are added to stale, to be invalidated in the file cache.
+        """
+
+        current = self._get_blob(c, file.file_hash)
+        if place is not None and place(file, current):
+            # the blob that's already stored is used, wherever it is and however it's stored
+            x = c.execute(
+                "UPDATE blobs SET refcount = refcount + 1 WHERE hash = ? RETURNING path, codec;", (file.file_hash,)
+            )
+            (file.path, file.codec) = x.fetchone()
+        else:
+            c.execute(
+                "INSERT INTO blobs (hash, path, size, refcount, codec, stored_size) VALUES (?, ?, ?, 1, ?, ?) ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1, path = excluded.path, codec = excluded.codec, stored_size = excluded.stored_size;",
+                (file.file_hash, file.path, file.size, file.codec, stored_size),
+            )
+
+            # the files stored in the blob read the new copy now, however it's stored
+            if current is not None and (current.path, current.codec) != (file.path, file.codec):
+                x = c.execute(
+                    "UPDATE files SET path = ?, codec = ? WHERE hash = ? AND path = ? RETURNING uuid;",
+                    (file.path, file.codec, file.file_hash, current.path),
+                )
+                stale.extend(r[0] for r in x.fetchall())
+
+        x = c.execute(
+            "INSERT INTO files (uuid, name, size, hash, path, user, expiration_time, max_downloads, codec) VALUES (?, ?, ?, ?, ?, (SELECT id FROM users WHERE username = ?), ?, ?, ?) RETURNING created_at;",
+            (
+                file.uuid,
+                file.name,
+                file.size,
+                file.file_hash,
+                file.path,
+                file.username,
+                file.expiration_time,
+                file.max_downloads,
+                file.codec,
+            ),
+        )
+
+        r = x.fetchall()
+        if len(r) != 1:
+            log.error("just uploaded file %s but can't get the created_at value from the database", file)
+            return None
+
+        return f_time.parse_db_timestamp(r[0][0])
+
+    @QUERY_SECONDS.time("method")
+    def add_new_file(
+        self, file: f_models.File, stored_size: int | None = None, place: PlaceBlobFunc | None = None
+    ) -> datetime | None:
+        """
+        Add a new file upload. Returns the upload datetime on success, otherwise None
+
+        The blob for the file's hash gets a new reference (and is created if needed), pointing at the file's path.
+        stored_size is the size of the blob on disk, if it's compressed. If the blob was stored already, it's replaced,
+        and the files stored in it are pointed at the new copy (and its codec).
+
+        place(file, blob) is called inside of the transaction (holding the write lock) with the blob that's stored for
+        the file's hash, or None. It returns True to reference that blob as it is (the file's path and codec are set to
+        the blob's), or False if it put the file's own blob in place instead. Blobs are only removed from disk while
+        holding the write lock too (see remove_orphans()), so a blob can't disappear between being checked and
+        referenced. If it raises, nothing is added and the exception is raised.
+        """
+
+        stale: list[bytes] = []
+        try:
+            with self.cursor() as c:
+                return self._insert_file(c, file, stored_size, place, stale)
+        finally:
+            for uuid in stale:
+                self._file_cache.invalidate(uuid)
+
+    @QUERY_SECONDS.time("method")
+    def add_new_files(
+        self, files: list[tuple[f_models.File, int | None]], place: PlaceBlobFunc | None = None
+    ) -> list[datetime] | None:
+        """
+        Add a batch of new file uploads in a single transaction, like add_new_file(), from (file, stored_size) pairs.
+
+        Returns the upload datetimes on success. Otherwise, None is returned and none of the files are added.
+        """
+
+        ts = []
+        stale: list[bytes] = []
+        try:
+            with self.cursor() as c:
+                for f, stored_size in files:
+                    t = self._insert_file(c, f, stored_size, place, stale)
+                    if t is None:
+                        # roll back the whole batch
+                        raise sqlite3.DatabaseError(f"failed to add file {f}")
+                    ts.append(t)
+        except sqlite3.DatabaseError as e:
+            log.error("failed to add a batch of %d files: %s", len(files), str(e))
+            return None
+        finally:
+            for uuid in stale:
+                self._file_cache.invalidate(uuid)
+
+        return ts
+
+    def get_file(self, uuid: bytes) -> f_models.File | None:
+        """Get a file by it's UUID, or None if it doesn't exist. Lookups are served from the file cache when possible."""
+
+        f = self._file_cache.get(uuid)
+        if f is not None:
+            # hand out a copy so callers can't change the cached object
+            return copy.copy(f)
+
+        # a change that commits while this is looked up could invalidate the file before it's cached
+        generation = self._file_cache.generation
+        f = self._get_file(uuid)
+        if f is not None:
+            self._file_cache.put(uuid, copy.copy(f), generation)
+
+        return f
+
+    def get_files(self, uuids: list[bytes]) -> dict[bytes, f_models.File]:
+        """
+        Get a batch of files by their UUIDs, like get_file(). The ones that aren't cached are looked up together.
+
+        Returns the files that exist, by UUID.
+        """
+
+        files = {}
+        missing = []
+        for uuid in dict.fromkeys(uuids):
+            f = self._file_cache.get(uuid)
+            if f is not None:
+                files[uuid] = copy.copy(f)
+            else:
+                missing.append(uuid)
+
+        generation = self._file_cache.generation
+        for i in range(0, len(missing), MAX_QUERY_PARAMS):
+            for f in self._get_files(missing[i : i + MAX_QUERY_PARAMS]):
+                self._file_cache.put(f.uuid, copy.copy(f), generation)
+                files[f.uuid] = f
+
+        return files
+
+    def _file_from_row(self, r: tuple) -> f_models.File:
+        """Make a File from a row of the FILE_COLUMNS."""
+
+        return f_models.File(
+            uuid=r[0],
+            name=r[1],
+            size=r[2],
+            file_hash=r[3],
+            path=r[4],
+            username=r[5],
+            expiration_time=f_time.parse_db_timestamp(r[6]) if r[6] else None,
+            max_downloads=r[7],
+            uploaded_at=f_time.parse_db_timestamp(r[8]),
+            codec=r[9],
+        )
+
+    @QUERY_SECONDS.time("method")
+    def _get_file(self, uuid: bytes) -> f_models.File | None:
+        """Get a file by it's UUID from the database, or None if it doesn't exist."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                f"SELECT {FILE_COLUMNS} FROM files JOIN users ON files.user = users.id WHERE files.uuid = ?;",
+                (uuid,),
+            )
+
+            r = x.fetchone()
+
+            if r:
+                return self._file_from_row(r)
+
+            return None
+
+    @QUERY_SECONDS.time("method")
+    def _get_files(self, uuids: list[bytes]) -> list[f_models.File]:
+        """Get the files with any of the UUIDs (at most MAX_QUERY_PARAMS of them) from the database."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                f"SELECT {FILE_COLUMNS} FROM files JOIN users ON files.user = users.id WHERE files.uuid IN ({', '.join('?' * len(uuids))});",
+                uuids,
+            )
+
+            return [self._file_from_row(r) for r in x.fetchall()]
+
+    @QUERY_SECONDS.time("method")
+    def list_files(
+        self,
+        username: str | None,
+        sort: str = "created",
+        descending: bool = True,
+        limit: int = 100,
+        after: ListKey | None = None,
+    ) -> tuple[list[f_models.FileSummary], ListKey | None]:
+        """
+        Get a page of the files uploaded by a user (or by every user if username is None), sorted by one of LIST_SORTS.
+
+        Pages are found by their position in the sort order instead of an offset, so every page is as fast to get as the
+        first one. Pass the key returned with a page as after to get the next one. Returns the files, and the key of
+        the next page (None if this is the last page).
+        """
+
+        col = LIST_SORTS.get(sort)
+        if col is None:
+            raise f_exc.BadArgs(f"can't list files by {sort}, must be one of {list(LIST_SORTS)}")
+
+        if limit <= 0 or limit > MAX_LIST_LIMIT:
+            raise f_exc.BadArgs(f"invalid listing limit: {limit}")
+
+        where = []
+        args: list[typing.Any] = []
+        if username is not None:
+            where.append("files.user = (SELECT id FROM users WHERE username = ?)")
+            args.append(username)
+        if after is not None:
+            where.append(f"({col}, files.id) {'<' if descending else '>'} (?, ?)")
+            args.extend(after)
+
+        order = "DESC" if descending else "ASC"
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                f"SELECT files.uuid, name, files.size, users.username, files.created_at, {col}, files.id FROM files JOIN users ON files.user = users.id {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY {col} {order}, files.id {order} LIMIT ?;",
+                args + [limit],
+            )
+            rows = x.fetchall()
+
+        files = [
+            f_models.FileSummary(
+                uuid=r[0], name=r[1], size=r[2], username=r[3], uploaded_at=f_time.parse_db_timestamp(r[4])
+            )
+            for r in rows
+        ]
+
+        return (files, (rows[-1][5], rows[-1][6]) if len(rows) == limit else None)
+
+    @QUERY_SECONDS.time("method")
+    def inc_download_count(self, uuid: bytes, now: datetime | None = None) -> bool:
+        """
+        Increment the download count for a file. Returns True if the download count was incremented and the file is still under the quota
+
+        If now is specified, the file also has to not be expired at that time. Both are checked in the same statement
+        as the increment, so concurrent downloads can't go past the quota.
+        """
+
+        with self.cursor() as c:
+            x = c.execute(
+                "UPDATE files SET num_downloads = num_downloads + 1 WHERE uuid = ? AND (num_downloads < max_downloads OR max_downloads IS NULL) AND (expiration_time IS NULL OR ? IS NULL OR expiration_time > ?) RETURNING num_downloads;",
+                (uuid, now, now),
+            )
+
+            return x.fetchone() is not None
+
+    @QUERY_SECONDS.time("method")
+    def dec_download_count(self, uuid: bytes) -> bool:
+        """Give back a download counted by inc_download_count() that didn't happen. Returns True if it was decremented."""
+
+        with self.cursor() as c:
+            x = c.execute(
+                "UPDATE files SET num_downloads = num_downloads - 1 WHERE uuid = ? AND num_downloads > 0;", (uuid,)
+            )
+
+            return x.rowcount == 1
+
+    @QUERY_SECONDS.time("method")
+    def add_download_claim(self, uuid: bytes, token: bytes, served: int = 0) -> bool:
+        """
+        Record a download claim token for a file, that can continue the download from served bytes in. Returns True if
+        the claim was added.
+        """
+
+        with self.cursor() as c:
+            x = c.execute(
+                "INSERT INTO download_claims (token, file, served) SELECT ?, id, ? FROM files WHERE uuid = ?;",
+                (token, served, uuid),
+            )
+
+            return x.rowcount == 1
+
+    @QUERY_SECONDS.time("method")
+    def check_download_claim(self, uuid: bytes, token: bytes) -> bool:
+        """Check if a download claim token is valid (and not too old) for a file."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT COUNT(*) FROM download_claims JOIN files ON download_claims.file = files.id WHERE download_claims.token = ? AND files.uuid = ? AND download_claims.created_at > datetime('now', ?);",
+                (token, uuid, f"-{DOWNLOAD_CLAIM_LIFETIME} seconds"),
+            )
+
+            return x.fetchone()[0] == 1
+
+    @QUERY_SECONDS.time("method")
+    def continue_download_claim(self, uuid: bytes, token: bytes, start: int, stop: int | None) -> bool:
+        """
+        Use a download claim token to send the bytes from start to stop (or to the end if stop is None) of a file.
+
+        The range has to start at or after where the bytes sent with the claim so far end, and the claim then continues
+        from stop. A range to the end of the file uses up the claim. Returns True if the claim was valid.
+        """
+
+        with self.cursor() as c:
+            if stop is None:
+                x = c.execute(
+                    "DELETE FROM download_claims WHERE token = ? AND file = (SELECT id FROM files WHERE uuid = ?) AND served <= ? AND created_at > datetime('now', ?);",
+                    (token, uuid, start, f"-{DOWNLOAD_CLAIM_LIFETIME} seconds"),
+                )
+            else:
+                x = c.execute(
+                    "UPDATE download_claims SET served = ? WHERE token = ? AND file = (SELECT id FROM files WHERE uuid = ?) AND served <= ? AND created_at > datetime('now', ?);",
+                    (stop, token, uuid, start, f"-{DOWNLOAD_CLAIM_LIFETIME} seconds"),
+                )
+
+            return x.rowcount == 1
+
+    @QUERY_SECONDS.time("method")
+    def delete_old_download_claims(self, limit: int) -> int:
+        """Delete up to limit download claims that are too old to be used. Returns the number deleted."""
+
+        with self.cursor() as c:
+            x = c.execute(
+                "DELETE FROM download_claims WHERE id IN (SELECT id FROM download_claims WHERE created_at <= datetime('now', ?) LIMIT ?);",
+                (f"-{DOWNLOAD_CLAIM_LIFETIME} seconds", limit),
+            )
+
+            return x.rowcount
+
+    @QUERY_SECONDS.time("method")
+    def delete_download_claim(self, uuid: bytes, token: bytes) -> bool:
+        """Delete a download claim token for a file, once it's used up. Returns True if it was deleted."""
 
         with self.cursor() as c:
             x = c.execute(
-                "INSERT INTO files (uuid, name, size, hash, path, user, expiration_time, max_downloads) VALUES (?, ?, ?, ?, ?, (SELECT id FROM users WHERE username = ?), ?, ?)",
+                "DELETE FROM download_claims WHERE token = ? AND file = (SELECT id FROM files WHERE uuid = ?);",
+                (token, uuid),
+            )
+
+            return x.rowcount == 1
+
+    def _get_blob(self, c: sqlite3.Cursor, file_hash: str) -> f_models.Blob | None:
+        x = c.execute("SELECT path, size, refcount, codec, stored_size FROM blobs WHERE hash = ?;", (file_hash,))
+        r = x.fetchone()
+
+        if r:
+            return f_models.Blob(file_hash=file_hash, path=r[0], size=r[1], refcount=r[2], codec=r[3], stored_size=r[4])
+
+        return None
+
+    @QUERY_SECONDS.time("method")
+    def get_blob(self, file_hash: str) -> f_models.Blob | None:
+        """Get the blob for a file hash, or None if no file with that hash is stored."""
+
+        with self.read_cursor() as c:
+            return self._get_blob(c, file_hash)
+
+    @QUERY_SECONDS.time("method")
+    def get_blobs(self, after: int, limit: int) -> list[tuple[int, f_models.Blob]]:
+        """Get up to limit blobs with an id greater than after, in order, along with their ids (to page through them)."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT id, hash, path, size, refcount, codec, stored_size FROM blobs WHERE id > ? ORDER BY id LIMIT ?;",
+                (after, limit),
+            )
+
+            return [
                 (
-                    file.uuid,
-                    file.name,
-                    file.size,
-                    file.file_hash,
-                    file.path,
-                    file.username,
-                    file.expiration_time,
-                    file.max_downloads,
-                ),
+                    r[0],
+                    f_models.Blob(file_hash=r[1], path=r[2], size=r[3], refcount=r[4], codec=r[5], stored_size=r[6]),
+                )
+                for r in x.fetchall()
+            ]
+
+    @QUERY_SECONDS.time("method")
+    def move_blob(
+        self, file_hash: str, old_path: str, new_path: str, place: typing.Callable[[], typing.Any] | None = None
+    ) -> bool:
+        """
+        Point a blob, and the files stored in it, at a new path.
+
+        Returns False if the blob isn't at old_path anymore (e.g. it was deleted), in which case nothing is changed.
+        Otherwise, place() is called inside of the transaction to put the new copy in place (see add_new_file()). If
+        it raises, nothing is changed and the exception is raised.
+        """
+
+        uuids = []
+        try:
+            with self.cursor() as c:
+                x = c.execute("UPDATE blobs SET path = ? WHERE hash = ? AND path = ?;", (new_path, file_hash, old_path))
+                if x.rowcount == 0:
+                    return False
+
+                if place is not None:
+                    place()
+
+                x = c.execute(
+                    "UPDATE files SET path = ? WHERE hash = ? AND path = ? RETURNING uuid;",
+                    (new_path, file_hash, old_path),
+                )
+                uuids = [r[0] for r in x.fetchall()]
+        finally:
+            # only invalidate after the commit, so a lookup that started before it can't cache the old path (see
+            # get_file())
+            for uuid in uuids:
+                self._file_cache.invalidate(uuid)
+
+        return True
+
+    @QUERY_SECONDS.time("method")
+    def get_blob_usage(self) -> tuple[int, int]:
+        """Get the number of blobs stored, and their total size on disk in bytes."""
+
+        with self.read_cursor() as c:
+            x = c.execute("SELECT COUNT(*), COALESCE(SUM(COALESCE(stored_size, size)), 0) FROM blobs;")
+            r = x.fetchone()
+
+            return (r[0], r[1])
+
+    @QUERY_SECONDS.time("method")
+    def add_audit_events(self, events: list[f_models.AuditEvent]) -> int:
+        """Write a batch of events to the audit log in a single transaction. Returns the number of events written."""
+
+        with self.cursor() as c:
+            c.executemany(
+                "INSERT INTO log (ts, action, user, file, src_ip, message) VALUES (COALESCE(?, CURRENT_TIMESTAMP), ?, (SELECT id FROM users WHERE username = ?), (SELECT id FROM files WHERE uuid = ?), ?, ?);",
+                [(e.ts, e.action, e.username, e.file_uuid, e.src_ip, e.message) for e in events],
             )
 
-            if x.rowcount == 1:
-                y = c.execute("SELECT created_at FROM files WHERE uuid = ?;", (file.uuid,))
-                r = y.fetchall()
-                if len(r) != 1:
-                    log.error("just uploaded file %s but can't get the created_at value from the database", file)
-                    return None
+            return c.rowcount
+
+    @QUERY_SECONDS.time("method")
+    def get_audit_events(self, limit: int) -> list[f_models.AuditEvent]:
+        """Get the latest limit events from the audit log, newest first."""
 
-                return f_time.parse_db_timestamp(r[0][0])
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT log.ts, action, users.username, files.uuid, src_ip, message FROM log LEFT JOIN users ON log.user = users.id LEFT JOIN files ON log.file = files.id ORDER BY log.id DESC LIMIT ?;",
+                (limit,),
+            )
 
+            return [
+                f_models.AuditEvent(
+                    ts=f_time.parse_db_timestamp(r[0]),
+                    action=r[1],
+                    username=r[2],
+                    file_uuid=r[3],
+                    src_ip=r[4],
+                    message=r[5],
+                )
+                for r in x.fetchall()
+            ]
+
+    @QUERY_SECONDS.time("method")
+    def get_variant(self, file_hash: str, encoding: str) -> str | None:
+        """
+        Get the path of the cached compressed copy of a blob, marking it as used if it wasn't in the last
+        VARIANT_TOUCH_INTERVAL seconds. Returns None if it isn't cached.
+        """
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT path, julianday('now') - last_used > ? FROM variants WHERE hash = ? AND encoding = ?;",
+                (VARIANT_TOUCH_INTERVAL / 86400, file_hash, encoding),
+            )
+            r = x.fetchone()
+
+        if r is None:
             return None
 
-    def get_file(self, uuid: bytes) -> f_models.File | None:
-        """Get a file by it's UUID, or None if it doesn't exist."""
+        if r[1]:
+            with self.cursor() as c:
+                c.execute(
+                    "UPDATE variants SET last_used = julianday('now') WHERE hash = ? AND encoding = ? AND julianday('now') - last_used > ?;",
+                    (file_hash, encoding, VARIANT_TOUCH_INTERVAL / 86400),
+                )
+
+        return r[0]
+
+    @QUERY_SECONDS.time("method")
+    def add_variant(self, file_hash: str, encoding: str, path: str, size: int, max_total: int) -> list[tuple[str, str]]:
+        """
+        Record a cached compressed copy of a blob, evicting the least recently used copies past max_total bytes.
+
+        Returns the (hash, path) of the evicted copies, which are removed with remove_orphans().
+        """
 
         with self.cursor() as c:
+            c.execute(
+                "INSERT INTO variants (hash, encoding, path, size) VALUES (?, ?, ?, ?) ON CONFLICT(hash, encoding) DO UPDATE SET path = excluded.path, size = excluded.size, last_used = julianday('now');",
+                (file_hash, encoding, path, size),
+            )
+
             x = c.execute(
-                "SELECT name, size, hash, path, users.username, expiration_time, max_downloads, files.created_at FROM files JOIN users ON files.user = users.id WHERE files.uuid = ?;",
+                "DELETE FROM variants WHERE rowid IN (SELECT rowid FROM (SELECT rowid, SUM(size) OVER (ORDER BY last_used DESC, rowid DESC) AS total FROM variants) WHERE total > ?) RETURNING hash, path;",
+                (max_total,),
+            )
+
+            return [(r[0], r[1]) for r in x.fetchall()]
+
+    @QUERY_SECONDS.time("method")
+    def get_variant_usage(self) -> tuple[int, int]:
+        """Get the number of cached compressed copies of blobs, and their total size in bytes."""
+
+        with self.read_cursor() as c:
+            x = c.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM variants;")
+            r = x.fetchone()
+
+            return (r[0], r[1])
+
+    def _delete_file(self, c: sqlite3.Cursor, uuid: bytes) -> list[tuple[str, str]] | None:
+        """Delete a file inside of the cursor's transaction. Returns the same as delete_file()."""
+
+        x = c.execute("SELECT id, hash, path FROM files WHERE uuid = ?;", (uuid,))
+        r = x.fetchone()
+        if r is None:
+            return None
+        (file_id, file_hash, path) = r
+
+        c.execute("DELETE FROM download_claims WHERE file = ?;", (file_id,))
+        c.execute("DELETE FROM files WHERE id = ?;", (file_id,))
+        c.execute("UPDATE blobs SET refcount = refcount - 1 WHERE hash = ?;", (file_hash,))
+
+        orphaned = []
+
+        x = c.execute("SELECT path, refcount FROM blobs WHERE hash = ?;", (file_hash,))
+        blob = x.fetchone()
+        if blob is not None and blob[1] <= 0:
+            c.execute("DELETE FROM blobs WHERE hash = ?;", (file_hash,))
+            orphaned.append((file_hash, blob[0]))
+
+            # along with the cached compressed copies
+            x = c.execute("DELETE FROM variants WHERE hash = ? RETURNING path;", (file_hash,))
+            orphaned.extend((file_hash, r[0]) for r in x.fetchall())
+
+        # files uploaded before the blob store existed can have their own copy of the blob
+        if blob is None or blob[0] != path:
+            x = c.execute("SELECT COUNT(*) FROM files WHERE hash = ? AND path = ?;", (file_hash, path))
+            if x.fetchone()[0] == 0:
+                orphaned.append((file_hash, path))
+
+        return orphaned
+
+    @QUERY_SECONDS.time("method")
+    def delete_file(self, uuid: bytes) -> list[tuple[str, str]] | None:
+        """
+        Delete a file and drop its reference to the blob.
+
+        Returns the (hash, on-disk path) of the copies that aren't referenced anymore, or None if the file doesn't
+        exist. They're removed with remove_orphans().
+        """
+
+        try:
+            with self.cursor() as c:
+                return self._delete_file(c, uuid)
+        finally:
+            # only invalidate after the commit, so a lookup that started before it can't cache the deleted file (see
+            # get_file())
+            self._file_cache.invalidate(uuid)
+
+    @QUERY_SECONDS.time("method")
+    def delete_files(self, uuids: list[bytes]) -> tuple[list[bytes], list[tuple[str, str]]]:
+        """
+        Delete a batch of files in a single transaction, like delete_file().
+
+        Returns the UUIDs that were deleted, and the (hash, on-disk path) of the copies that aren't referenced anymore.
+        """
+
+        deleted = []
+        orphaned = []
+
+        try:
+            with self.cursor() as c:
+                for uuid in uuids:
+                    r = self._delete_file(c, uuid)
+                    if r is not None:
+                        deleted.append(uuid)
+                        orphaned.extend(r)
+        finally:
+            for uuid in uuids:
+                self._file_cache.invalidate(uuid)
+
+        return (deleted, orphaned)
+
+    @QUERY_SECONDS.time("method")
+    def remove_orphans(self, orphaned: list[tuple[str, str]], remove: typing.Callable[[str], typing.Any]) -> int:
+        """
+        Remove the on-disk copies of blobs that aren't referenced anymore, from (hash, path) pairs.
+
+        An upload of the same contents can put a new copy at the same path after the old one was orphaned, so
+        remove(path) is only called if no blob, file or cached compressed copy points at the path, while holding the
+        write lock (which uploads hold while they put blobs in place, see add_new_file()). Returns the number removed.
+        """
+
+        n = 0
+        for file_hash, path in orphaned:
+            with self.cursor() as c:
+                x = c.execute(
+                    "SELECT EXISTS (SELECT 1 FROM blobs WHERE hash = ? AND path = ?) OR EXISTS (SELECT 1 FROM files WHERE hash = ? AND path = ?) OR EXISTS (SELECT 1 FROM variants WHERE hash = ? AND path = ?);",
+                    (file_hash, path) * 3,
+                )
+                if x.fetchone()[0]:
+                    log.debug("%s is referenced again, not removing it", path)
+                    continue
+
+                remove(path)
+                n += 1
+
+        return n
+
+    @QUERY_SECONDS.time("method")
+    def get_expired_files(self, now: datetime, limit: int) -> list[bytes]:
+        """Get the UUIDs of up to limit files that expired before now."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT uuid FROM files WHERE expiration_time IS NOT NULL AND expiration_time < ? LIMIT ?;",
+                (now, limit),
+            )
+
+            return [r[0] for r in x.fetchall()]
+
+    @QUERY_SECONDS.time("method")
+    def get_exhausted_files(self, limit: int) -> list[bytes]:
+        """
+        Get the UUIDs of up to limit files that have used up their download quota.
+
+        Files with a download claim that can still be used to resume the download aren't included.
+        """
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT uuid FROM files WHERE max_downloads IS NOT NULL AND num_downloads >= max_downloads AND NOT EXISTS (SELECT 1 FROM download_claims WHERE download_claims.file = files.id AND download_claims.created_at > datetime('now', ?)) LIMIT ?;",
+                (f"-{DOWNLOAD_CLAIM_LIFETIME} seconds", limit),
+            )
+
+            return [r[0] for r in x.fetchall()]
+
+    @QUERY_SECONDS.time("method")
+    def get_stale_upload_sessions(self, max_age: int, limit: int) -> list[bytes]:
+        """Get the UUIDs of up to limit upload sessions that were started more than max_age seconds ago."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT uuid FROM upload_sessions WHERE created_at < datetime('now', ?) LIMIT ?;",
+                (f"-{max_age} seconds", limit),
+            )
+
+            return [r[0] for r in x.fetchall()]
+
+    @QUERY_SECONDS.time("method")
+    def add_upload_session(self, session: f_models.UploadSession) -> bool:
+        """Add a new chunked upload session. Returns True on success."""
+
+        with self.cursor() as c:
+            x = c.execute(
+                "INSERT INTO upload_sessions (uuid, name, size, chunk_size, user, expiration_time, max_downloads) VALUES (?, ?, ?, ?, (SELECT id FROM users WHERE username = ?), ?, ?);",
+                (
+                    session.uuid,
+                    session.name,
+                    session.size,
+                    session.chunk_size,
+                    session.username,
+                    session.expiration_time,
+                    session.max_downloads,
+                ),
+            )
+
+            return x.rowcount == 1
+
+    @QUERY_SECONDS.time("method")
+    def get_upload_session(self, uuid: bytes) -> f_models.UploadSession | None:
+        """Get a chunked upload session by it's UUID, or None if it doesn't exist."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT name, size, chunk_size, users.username, expiration_time, max_downloads, upload_sessions.created_at FROM upload_sessions JOIN users ON upload_sessions.user = users.id WHERE upload_sessions.uuid = ?;",
                 (uuid,),
             )
 
             r = x.fetchone()
 
             if r:
-                return f_models.File(
+                return f_models.UploadSession(
                     uuid=uuid,
                     name=r[0],
                     size=r[1],
-                    file_hash=r[2],
-                    path=r[3],
-                    username=r[4],
-                    expiration_time=f_time.parse_db_timestamp(r[5]) if r[5] else None,
-                    max_downloads=r[6],
-                    uploaded_at=f_time.parse_db_timestamp(r[7]),
+                    chunk_size=r[2],
+                    username=r[3],
+                    expiration_time=f_time.parse_db_timestamp(r[4]) if r[4] else None,
+                    max_downloads=r[5],
+                    created_at=f_time.parse_db_timestamp(r[6]),
                 )
 
             return None
 
-    def inc_download_count(self, uuid: bytes) -> bool:
-        """Increment the download count for a file. Returns True if the download count was incremented and the file is still under the quota"""
+    @QUERY_SECONDS.time("method")
+    def add_upload_chunk(self, uuid: bytes, idx: int, size: int, chunk_hash: str) -> bool:
+        """
+        Record a received chunk for an upload session, replacing a previous upload of the same chunk. Returns True on
+        success, or False if the session doesn't exist or is being finalized.
+        """
+
+        with self.cursor() as c:
+            x = c.execute(
+                "INSERT OR REPLACE INTO upload_chunks (session, idx, size, hash) SELECT id, ?, ?, ? FROM upload_sessions WHERE uuid = ? AND finalizing = 0;",
+                (idx, size, chunk_hash, uuid),
+            )
+
+            return x.rowcount == 1
+
+    @QUERY_SECONDS.time("method")
+    def set_upload_finalizing(self, uuid: bytes, finalizing: bool) -> bool:
+        """
+        Mark an upload session as being finalized, or not anymore. Returns True if it was changed, so only one caller
+        can mark a session at a time.
+        """
 
         with self.cursor() as c:
             x = c.execute(
-                "UPDATE files SET num_downloads = num_downloads + 1 WHERE uuid = ? AND (num_downloads < max_downloads OR max_downloads IS NULL);",
+                "UPDATE upload_sessions SET finalizing = ? WHERE uuid = ? AND finalizing = ?;",
+                (int(finalizing), uuid, int(not finalizing)),
+            )
+
+            return x.rowcount == 1
+
+    @QUERY_SECONDS.time("method")
+    def get_upload_chunks(self, uuid: bytes) -> dict[int, str]:
+        """Get the received chunks for an upload session, as a map of chunk index -> chunk hash."""
+
+        with self.read_cursor() as c:
+            x = c.execute(
+                "SELECT idx, hash FROM upload_chunks JOIN upload_sessions ON upload_chunks.session = upload_sessions.id WHERE upload_sessions.uuid = ? ORDER BY idx;",
+                (uuid,),
+            )
+
+            return dict(x.fetchall())
+
+    @QUERY_SECONDS.time("method")
+    def delete_upload_session(self, uuid: bytes) -> bool:
+        """Delete an upload session and the records of its chunks. Returns True if the session existed."""
+
+        with self.cursor() as c:
+            c.execute(
+                "DELETE FROM upload_chunks WHERE session = (SELECT id FROM upload_sessions WHERE uuid = ?);",
                 (uuid,),
             )
+            x = c.execute("DELETE FROM upload_sessions WHERE uuid = ?;", (uuid,))
 
             return x.rowcount == 1
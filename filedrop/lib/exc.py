@@ -25,3 +25,11 @@ class InvalidUser(FiledropException):
 
 class FileTooLarge(FiledropException):
     """The size of the file was too large to handle for the current configuration."""
+
+
+class BadChecksum(FiledropException):
+    """The checksum of the uploaded data didn't match the expected value."""
+
+
+class Overloaded(FiledropException):
+    """Too much work is already queued for the operation, try again later."""
@@ -1,29 +1,119 @@
-import hashlib
+# pylint: disable=too-many-lines
+
+import contextlib
+import io
+import itertools
 import logging
+import mimetypes
 import os
+import shutil
+import tempfile
+import time
+import typing
 from datetime import datetime
 
+import filedrop.lib.audit as f_audit
+import filedrop.lib.cache as f_cache
+import filedrop.lib.compression as f_compression
 import filedrop.lib.database as f_db
 import filedrop.lib.exc as f_exc
+import filedrop.lib.hashing as f_hashing
+import filedrop.lib.metrics as f_metrics
 import filedrop.lib.models as f_models
+import filedrop.lib.storage as f_storage
 import filedrop.lib.time as f_time
 import filedrop.lib.utils as f_utils
 
 DEFAULT_MAX_SIZE = 10 * 1024 * 1024 * 1024  # 10gb
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # 1mb
+DEFAULT_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # 8mb
+MAX_UPLOAD_CHUNK_SIZE = 256 * 1024 * 1024  # 256mb
+
+# in-memory uploads bigger than this are hashed while they're written, instead of before
+PIPELINE_MIN_SIZE = 4 * DEFAULT_CHUNK_SIZE
+
+# how long a chunked upload can take before it's abandoned
+UPLOAD_SESSION_LIFETIME = 24 * 60 * 60  # 1 day
+
+# folder in each storage root that the content-addressed blobs are stored in
+BLOBS_DIR = f_storage.BLOBS_DIR
+
+# folder in the filestore root that the chunks of in-progress chunked uploads are stored in
+UPLOADS_DIR = "uploads"
+
+# prefix for in-progress uploads in the filestore (and storage) roots
+TEMP_PREFIX = f_storage.TEMP_PREFIX
+
+# how many blobs are checked at a time when rebalancing
+DEFAULT_REBALANCE_BATCH_SIZE = 100
+
+# compressed copies of blobs for downloads are cached (next to the blob) once they've been compressed this many times
+DEFAULT_VARIANT_MIN_HITS = 2
+
+# max total size of the cached compressed copies
+DEFAULT_VARIANT_CACHE_SIZE = 1024 * 1024 * 1024  # 1gb
+
+# how many blobs the number of times they've been compressed is tracked for (per process)
+VARIANT_COUNTS_SIZE = 10000
+
+# either a file-like object (anything with .read()) or an iterable of chunks
+ByteStream = typing.Union[typing.BinaryIO, typing.Iterable[bytes]]
 
 log = logging.getLogger(__name__)
 
-# TODO: refactor the read/write stuff to use generators for more effeciency
+OP_SECONDS = f_metrics.REGISTRY.histogram("filedrop_filestore_seconds", "Time spent in each filestore operation")
+
+# TODO: refactor the read stuff to use generators for more effeciency
 
 
 class Filestore:
     """Manager for an on-disk filestore"""
 
-    def __init__(self, db: f_db.Database, root_path: str, max_size: int = DEFAULT_MAX_SIZE):
+    def __init__(
+        self,
+        db: f_db.Database,
+        root_path: str,
+        max_size: int = DEFAULT_MAX_SIZE,
+        codec: str | None = None,
+        variant_cache_size: int = DEFAULT_VARIANT_CACHE_SIZE,
+        variant_min_hits: int = DEFAULT_VARIANT_MIN_HITS,
+        audit: f_audit.AuditLog | None = None,
+        backend: f_storage.Backend | None = None,
+    ):
+        """
+        Set up the filestore.
+
+        - codec: name of the codec to compress new blobs with, unless the upload asks for another (default: none)
+        - variant_cache_size: max total bytes of compressed copies of blobs to cache for downloads (0 disables it)
+        - variant_min_hits: how many times a blob is compressed for a download before its compressed copy is cached
+        - audit: audit log to record deleted files in
+        - backend: where to store the blobs (default: in root_path). Chunked uploads are always kept in root_path.
+        """
+
+        if variant_cache_size < 0:
+            raise f_exc.BadArgs(f"invalid variant cache size: {variant_cache_size}")
+
+        if variant_min_hits < 1:
+            raise f_exc.BadArgs(f"invalid variant min hits: {variant_min_hits}")
+
         self._db = db
         self._root_path = root_path.rstrip("/")
         self._max_size = max_size
 
+        if codec == f_compression.NO_CODEC:
+            codec = None
+        elif codec is not None:
+            f_compression.get_codec(codec)
+        self._codec = codec
+
+        self._variant_cache_size = variant_cache_size
+        self._variant_min_hits = variant_min_hits
+        self._variant_counts: f_cache.LRUCache[tuple[str, str], int] = f_cache.LRUCache(VARIANT_COUNTS_SIZE)
+        self._variant_hits = 0
+        self._variant_misses = 0
+        self._audit = audit
+        self._backend = backend or f_storage.LocalBackend([self._root_path])
+
         # TODO lock the dir and clean it up on destroy
 
     @property
@@ -32,62 +122,41 @@ class Filestore:
 
         return self._root_path
 
-    def _hash_bytes(self, bytz: bytes) -> str:
-        """Get the hash of the provided bytes"""
+    @property
+    def backend(self) -> f_storage.Backend:
+        """Get the backend the blobs are stored in."""
 
-        return hashlib.sha256(bytz, usedforsecurity=False).hexdigest()
+        return self._backend
 
-    def _gen_path(self, filehash: str, user_id: int) -> str:
-        """Generate a path to save the file bytes at."""
+    @property
+    def max_size(self) -> int:
+        """Get the max size of a file that can be uploaded."""
 
-        p = os.path.join(self._root_path, str(user_id), filehash[0:2], filehash[2:4], filehash[4:6], filehash[6:])
-        if not p.startswith(self._root_path):
-            raise f_exc.BadArgs(
-                f"the generated file path didn't start with the root directory, something is wrong! generated: {p}, root: {self._root_path}"
-            )
+        return self._max_size
 
-        return p
+    @property
+    def codec(self) -> str | None:
+        """Get the name of the codec new blobs are compressed with by default, or None if they aren't."""
 
-    def _write_bytes(self, path: str, bytz: bytes, overwrite=True) -> bool:
-        """
-        Save the bytes to the specified path.
+        return self._codec
 
-        If overwrite is True, a file at that path will be overwritten, otherwise False will be returned if the file already exists.
-        """
-
-        # TODO: this is raceable. map path->mutex to lock this code path?
-        if not overwrite:
-            # make sure the file doesn't exist
-            if os.path.exists(path):
-                log.debug("file already exists at %s and overwrite=False", path)
-                return False
+    @property
+    def variant_hits(self) -> int:
+        """Number of compressed downloads that were served from a cached compressed copy."""
 
-        # make sure the directory exists
-        dirn = os.path.dirname(path)
-        if not os.path.exists(dirn):
-            os.makedirs(dirn, exist_ok=True)
+        return self._variant_hits
 
-        # save the file
-        try:
-            with open(path, "wb") as f:
-                l = f.write(bytz)
-                expected = len(bytz)
-                if l != expected:
-                    log.error("failed to write file to %s, only wrote %d bytes instead of %d", path, l, expected)
-                    return False
-                return True
-        except PermissionError:
-            log.error("failed to write file to %s, permission denied", path)
-        except FileNotFoundError:
-            log.error("failed to write file to %s, missing upper directories somehow", path)
+    @property
+    def variant_misses(self) -> int:
+        """Number of compressed downloads that had to be compressed on the fly."""
 
-        return False
+        return self._variant_misses
 
     def _read_bytes(self, file: f_models.File) -> bytes | None:
         """Read in the specified file."""
 
         try:
-            with open(file.path, "rb") as f:
+            with self.open_file(file) as f:
                 bytz = f.read()
                 sz = len(bytz)
 
@@ -105,22 +174,140 @@ class Filestore:
             log.error("failed to read file %s, permission denied", file.path)
         except FileNotFoundError:
             log.error("failed to read file %s, file not found", file.path)
+        except f_compression.DECOMPRESS_ERRORS as e:
+            log.error("failed to decompress file %s with %s: %s", file.path, file.codec, str(e))
 
         return None
 
-    def save_file(
+    def _limit_size(self, name: str, stream: ByteStream, chunk_size: int, max_size: int) -> typing.Iterator[bytes]:
+        """Yield the chunks of the stream, raising FileTooLarge as soon as more than max_size bytes arrive."""
+
+        sz = 0
+        for chunk in f_hashing.iter_chunks(stream, chunk_size):
+            sz += len(chunk)
+            if sz > max_size:
+                raise f_exc.FileTooLarge(
+                    f"can't upload file {name}, too big! max is {max_size} bytes, got at least {sz} bytes"
+                )
+
+            yield chunk
+
+    def _pick_codec(self, codec: str | None, sample: bytes, complete: bool) -> f_compression.Codec | None:
+        """
+        Pick the codec to store a file with, from the codec asked for (None for the filestore default) and a sample of
+        the start of the file. complete is True if the sample is the whole file.
+
+        Returns None if the file is stored as-is. Raises BadArgs if the codec doesn't exist.
+        """
+
+        if codec is None:
+            codec = self._codec
+
+        if codec is None or codec == f_compression.NO_CODEC:
+            return None
+
+        c = f_compression.get_codec(codec)
+
+        # compressing random-looking data (likely already compressed) costs cpu for nothing
+        if not f_compression.is_compressible(sample, complete):
+            log.debug("not compressing the upload with %s, it doesn't look compressible", c)
+            return None
+
+        return c
+
+    def _pick_stream_codec(
+        self, codec: str | None, chunks: typing.Iterator[bytes]
+    ) -> tuple[typing.Iterator[bytes], f_compression.Codec | None]:
+        """
+        Pick the codec to store a stream with (see _pick_codec()) from the first SAMPLE_SIZE bytes of its chunks.
+
+        Returns (the chunks, codec), since the sampled chunks are put back in front of the rest.
+        """
+
+        if codec == f_compression.NO_CODEC:
+            return (chunks, None)
+
+        head = []
+        n = 0
+        for chunk in chunks:
+            head.append(chunk)
+            n += len(chunk)
+            if n >= f_compression.SAMPLE_SIZE:
+                break
+
+        c = self._pick_codec(codec, b"".join(head), n < f_compression.SAMPLE_SIZE)
+
+        return (itertools.chain(head, chunks), c)
+
+    def _write_stream(
         self,
         name: str,
-        bytz: bytes,
-        anon_upload: bool = False,
-        username: str | None = None,
-        expiration_time: datetime | None = None,
-        max_downloads: int | None = None,
-    ) -> f_models.File | None:
+        stream: ByteStream,
+        chunk_size: int,
+        max_size: int | None = None,
+        codec: str | None = f_compression.NO_CODEC,
+        temp_dir: str | None = None,
+    ) -> tuple[str, str, int, str | None] | None:
         """
-        Save a file to disk and record the metadata in the database.
+        Write a stream to a temporary file, hashing it concurrently on another thread.
 
-        If anon_upload is True, username must be None. Otherwise, the username of the uploader must be specified.
+        The temp file is made by the backend, for a new blob, unless temp_dir is specified.
+
+        Raises FileTooLarge (and removes the temp file) as soon as more than max_size bytes arrive.
+        If max_size isn't specified, the filestore max size is used.
+
+        The stream is compressed with the codec if the start of it looks compressible (codec None is the filestore
+        default). The hash and size are of the uncompressed stream.
+
+        Returns (temp path, hash, size, codec name or None if not compressed) on success, otherwise None.
+        """
+
+        if temp_dir is None:
+            fd, tmp_path = self._backend.temp_file()
+        else:
+            os.makedirs(temp_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=temp_dir)
+
+        if max_size is None:
+            max_size = self._max_size
+
+        try:
+            (chunks, c) = self._pick_stream_codec(codec, self._limit_size(name, stream, chunk_size, max_size))
+            with os.fdopen(fd, "wb") as f:
+                (h, sz) = f_hashing.hash_and_write(chunks, f, compressor=c.compressor() if c is not None else None)
+        except PermissionError:
+            log.error("failed to write temp file to %s, permission denied", tmp_path)
+            os.unlink(tmp_path)
+            return None
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return (tmp_path, h, sz, c.name if c is not None else None)
+
+    def _find_blob(self, filehash: str) -> f_models.Blob | None:
+        """
+        Get the already stored blob with the hash, or None if it needs to be written.
+
+        This is only a hint to skip writing the contents, the blob can be deleted before a new file references it (see
+        _place_blob()).
+        """
+
+        b = self._db.get_blob(filehash)
+        if b is None:
+            return None
+
+        if not self._backend.exists(b.path):
+            log.warning("blob %s is missing from disk at %s, will write it again", b, b.path)
+            return None
+
+        return b
+
+    def _get_uploader(self, anon_upload: bool, username: str | None) -> str:
+        """
+        Validate the uploader arguments and resolve the uploading user.
+
+        Returns the username for the upload.
         """
 
         # validate the combination of arguments
@@ -130,48 +317,340 @@ class Filestore:
         if not anon_upload and username is None:
             raise f_exc.BadArgs("non-anon upload but no username specified")
 
-        # check size
-        sz = len(bytz)
-        if sz > self._max_size:
-            raise f_exc.FileTooLarge(
-                f"can't upload file {name}, too big! max is {self._max_size} bytes, this file is {sz} bytes"
-            )
-
         # get the username
         if username is None:
             # doing an anonymous file upload, set the username
             username = f_db.ANONYMOUS_USERNAME
 
-        uid = self._db.get_user_id(username)
-        if uid is None:
+        if self._db.get_user_id(username) is None:
             raise f_exc.InvalidUser(f"can't save file for user {username}, user doesn't exist")
 
-        # write the file to disk
-        h = self._hash_bytes(bytz)
-        p = self._gen_path(h, uid)
-        if not self._write_bytes(p, bytz):
-            return None
+        return username
+
+    def _place_blob(self, file: f_models.File, current: f_models.Blob | None, temps: dict[bytes, str]) -> bool:
+        """
+        Pick the blob a new file references, while the database holds the write lock (see Database.add_new_file()).
+
+        The stored blob is used if it's still on disk. Otherwise, the file's own blob is put in place from its temp
+        file in temps (keyed by the file's uuid, and removed from it once it's moved). Raises OSError if it can't be.
+        """
+
+        if current is not None and self._backend.exists(current.path):
+            return True
+
+        if current is not None:
+            log.warning("blob %s is missing from disk at %s, writing it again", current, current.path)
+
+        tmp_path = temps.pop(file.uuid, None)
+        if tmp_path is None:
+            raise OSError(f"the blob for {file} was removed before it could be used")
+
+        path = self._backend.locate(file.file_hash)
+        if not self._backend.put(tmp_path, path):
+            raise OSError(f"failed to put the blob for {file} in place at {path}")
+        file.path = path
+
+        return False
+
+    def _add_files(self, files: list[tuple[f_models.File, int | None]], temps: dict[bytes, str]) -> bool:
+        """
+        Record the metadata for new files in the database, in a single transaction.
 
-        f = f_models.File.new(
+        Each file references the blob that's stored for its hash, or has its own blob put in place from its temp file
+        in temps. The temp files that aren't used are removed. Returns False on failure.
+        """
+
+        try:
+            ts = self._db.add_new_files(files, lambda f, current: self._place_blob(f, current, temps))
+        except OSError as e:
+            log.error("failed to store the blobs for %d new files: %s", len(files), str(e))
+            ts = None
+        finally:
+            self._discard_temps(temps)
+
+        if ts is None:
+            log.error("failed to save %d new files to the database", len(files))
+            return False
+
+        for (f, _), t in zip(files, ts):
+            f.uploaded_at = t
+
+        return True
+
+    def _discard_temps(self, temps: dict[bytes, str]):
+        """Remove the temp files of blobs that weren't put in place."""
+
+        for tmp_path in temps.values():
+            os.unlink(tmp_path)
+        temps.clear()
+
+    def _new_file(
+        self,
+        name: str,
+        b: f_models.Blob,
+        username: str,
+        expiration_time: datetime | None,
+        max_downloads: int | None,
+    ) -> f_models.File:
+        return f_models.File.new(
             name=name,
-            path=p,
-            size=sz,
-            file_hash=h,
+            path=b.path,
+            size=b.size,
+            file_hash=b.file_hash,
             username=username,
             expiration_time=expiration_time,
             max_downloads=max_downloads,
+            codec=b.codec,
         )
 
-        # save to db
-        if not self._db.add_new_file(f):
-            log.error("failed to save new file to the database: %s", f)
+    def _add_file(
+        self,
+        name: str,
+        b: f_models.Blob,
+        tmp_path: str | None,
+        username: str,
+        expiration_time: datetime | None,
+        max_downloads: int | None,
+    ) -> f_models.File | None:
+        """Record the metadata for a file in the database, with its blob (from a temp file, if it was written)."""
+
+        f = self._new_file(name, b, username, expiration_time, max_downloads)
+        if not self._add_files([(f, b.stored_size)], {f.uuid: tmp_path} if tmp_path is not None else {}):
             return None
 
         return f
 
-    def get_file_bytes(self, uuid: bytes, validate_conditions=True) -> bytes | None:
+    def _write_blob(self, h: str, bytz: bytes, codec: str | None) -> tuple[f_models.Blob, str] | None:
+        """Write the contents of a new blob to a temp file, compressing them with the codec (see save_file())."""
+
+        sz = len(bytz)
+        c = self._pick_codec(codec, bytz[: f_compression.SAMPLE_SIZE], sz <= f_compression.SAMPLE_SIZE)
+        if c is not None:
+            compressor = c.compressor()
+            bytz = compressor.compress(bytz) + compressor.flush()
+
+        tmp_path = self._backend.write_temp(bytz, h)
+        if tmp_path is None:
+            return None
+
+        b = f_models.Blob(
+            h,
+            self._backend.locate(h),
+            sz,
+            codec=c.name if c is not None else None,
+            stored_size=len(bytz) if c else None,
+        )
+
+        return (b, tmp_path)
+
+    @OP_SECONDS.time("op")
+    def save_file(
+        self,
+        name: str,
+        bytz: bytes,
+        anon_upload: bool = False,
+        username: str | None = None,
+        expiration_time: datetime | None = None,
+        max_downloads: int | None = None,
+        codec: str | None = None,
+    ) -> f_models.File | None:
+        """
+        Save a file to disk and record the metadata in the database.
+
+        If anon_upload is True, username must be None. Otherwise, the username of the uploader must be specified.
+
+        The file is compressed with the codec (None for the filestore default, NO_CODEC for none) unless it doesn't look
+        compressible. If the same contents are already stored, the existing blob is used as-is.
         """
-        Get the bytes for a file.
+
+        # check size
+        sz = len(bytz)
+        if sz > self._max_size:
+            raise f_exc.FileTooLarge(
+                f"can't upload file {name}, too big! max is {self._max_size} bytes, this file is {sz} bytes"
+            )
+
+        # hashing a big buffer before writing it would leave the disk idle, so hash and write it at the same time
+        if sz > PIPELINE_MIN_SIZE:
+            view = memoryview(bytz)
+            chunks = (view[i : i + DEFAULT_CHUNK_SIZE] for i in range(0, sz, DEFAULT_CHUNK_SIZE))
+            return self.save_stream(
+                name,
+                typing.cast(typing.Iterable[bytes], chunks),
+                anon_upload=anon_upload,
+                username=username,
+                expiration_time=expiration_time,
+                max_downloads=max_downloads,
+                codec=codec,
+            )
+
+        username = self._get_uploader(anon_upload, username)
+
+        # write the file to disk, unless the same contents are already stored
+        h = f_hashing.hash_bytes(bytz)
+        b = self._find_blob(h)
+        if b is not None:
+            log.debug("blob for %s already exists, skipping the write", h)
+            f = self._add_file(name, b, None, username, expiration_time, max_downloads)
+            if f is not None:
+                return f
+
+            # the blob was deleted in the meantime, so it's written after all
+
+        r = self._write_blob(h, bytz, codec)
+        if r is None:
+            return None
+
+        return self._add_file(name, r[0], r[1], username, expiration_time, max_downloads)
+
+    @OP_SECONDS.time("op")
+    def save_stream(
+        self,
+        name: str,
+        stream: ByteStream,
+        anon_upload: bool = False,
+        username: str | None = None,
+        expiration_time: datetime | None = None,
+        max_downloads: int | None = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        codec: str | None = None,
+    ) -> f_models.File | None:
+        """
+        Save a file to disk from a stream and record the metadata in the database.
+
+        The stream is either a file-like object (read in chunk_size pieces) or an iterable of byte chunks.
+        The contents are hashed (and compressed, see save_file()) while being written to a temp file in the filestore,
+        which is then atomically moved into place, so the whole file is never held in memory.
+
+        If anon_upload is True, username must be None. Otherwise, the username of the uploader must be specified.
+        """
+
+        username = self._get_uploader(anon_upload, username)
+
+        r = self._store_stream(name, stream, chunk_size, codec)
+        if r is None:
+            return None
+
+        return self._add_file(name, r[0], r[1], username, expiration_time, max_downloads)
+
+    def _store_stream(
+        self, name: str, stream: ByteStream, chunk_size: int, codec: str | None
+    ) -> tuple[f_models.Blob, str] | None:
+        """
+        Write a stream to a temp file. Returns the blob it would be, and the temp file.
+
+        The temp file is only put in place when the file is recorded, if the same contents aren't stored by then.
+        """
+
+        r = self._write_stream(name, stream, chunk_size, codec=codec)
+        if r is None:
+            return None
+        (tmp_path, h, sz, codec) = r
+
+        b = f_models.Blob(
+            h, self._backend.locate(h), sz, codec=codec, stored_size=os.path.getsize(tmp_path) if codec else None
+        )
+
+        # the blob is put in place while the database is locked, so get the temp file onto the same disk first, unless
+        # it's likely to be discarded anyway
+        if self._find_blob(h) is None:
+            staged = self._backend.stage(tmp_path, h)
+            if staged is None:
+                return None
+            tmp_path = staged
+        else:
+            log.debug("blob for %s already exists, the upload will likely be discarded", h)
+
+        return (b, tmp_path)
+
+    @OP_SECONDS.time("op")
+    def save_streams(
+        self,
+        uploads: list[tuple[str, ByteStream]],
+        anon_upload: bool = False,
+        username: str | None = None,
+        expiration_time: datetime | None = None,
+        max_downloads: int | None = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        codec: str | None = None,
+    ) -> list[f_models.File] | None:
+        """
+        Save a batch of (name, stream) uploads to disk like save_stream(), recording all of them in a single transaction.
+
+        Returns the files in the same order, or None if any of them failed, in which case none of them are recorded.
+        """
+
+        username = self._get_uploader(anon_upload, username)
+
+        files = []
+        temps: dict[bytes, str] = {}
+        try:
+            for name, stream in uploads:
+                r = self._store_stream(name, stream, chunk_size, codec)
+                if r is None:
+                    return None
+
+                f = self._new_file(name, r[0], username, expiration_time, max_downloads)
+                files.append((f, r[0].stored_size))
+                temps[f.uuid] = r[1]
+
+            if not self._add_files(files, temps):
+                return None
+        finally:
+            # the uploads before one that failed
+            self._discard_temps(temps)
+
+        return [f for f, _ in files]
+
+    def _check_download(self, f: f_models.File, count_download=True) -> bool:
+        """
+        Validate the download conditions for a file, incrementing the download count if count_download is True.
+
+        Counting the download checks the expiration and quota in the same statement, so concurrent downloads can't both
+        get the last one. Give it back with release_download() if the file can't be sent after all.
+
+        Returns True if the file can be downloaded.
+        """
+
+        now = f_time.now()
+
+        if count_download:
+            if not self._db.inc_download_count(f.uuid, now):
+                log.debug("can't download %s, file is expired or has exceeded download quota", f_utils.hexstr(f.uuid))
+                return False
+
+            return True
+
+        # check expiration
+        if f.expiration_time is not None and now > f.expiration_time:
+            log.debug("can't download %s, file is expired", f_utils.hexstr(f.uuid))
+            return False
+
+        return True
+
+    def release_download(self, file: f_models.File) -> bool:
+        """
+        Give back a download that was counted (by get_file_path() or get_file_bytes()) but couldn't be completed.
+
+        Returns True if the download count was decremented.
+        """
+
+        log.debug("releasing a download of %s", f_utils.hexstr(file.uuid))
+
+        return self._db.dec_download_count(file.uuid)
+
+    def _resolve_file(self, file: bytes | f_models.File) -> f_models.File | None:
+        """Get the File for a UUID, or use the already loaded File as-is."""
+
+        if isinstance(file, f_models.File):
+            return file
+
+        return self._db.get_file(file)
+
+    @OP_SECONDS.time("op")
+    def get_file_bytes(self, file: bytes | f_models.File, validate_conditions=True) -> bytes | None:
+        """
+        Get the bytes for a file, by UUID or an already loaded File.
 
         If validate_conditions is True:
             - the download count is incremented from the database.
@@ -183,23 +662,550 @@ class Filestore:
         """
 
         # get the file from the db
-        f = self._db.get_file(uuid)
+        f = self._resolve_file(file)
         if f is None:
             return None
 
-        if validate_conditions:
-            # check expiration
-            if f.expiration_time is not None:
-                now = f_time.now()
-                if now > f.expiration_time:
-                    log.debug("can't download %s, file is expired", f_utils.hexstr(f.uuid))
-                    return None
+        if validate_conditions and not self._check_download(f):
+            return None
 
-            # check download count
-            if not self._db.inc_download_count(f.uuid):
-                log.debug("can't download %s, file has exceeded download quota", f_utils.hexstr(f.uuid))
-                return None
+        bytz = self._read_bytes(f)
+        if bytz is None and validate_conditions:
+            self.release_download(f)
+
+        return bytz
+
+    @OP_SECONDS.time("op")
+    def get_file_path(self, file: bytes | f_models.File, validate_conditions=True, count_download=True) -> str | None:
+        """
+        Get the on-disk path for a file (by UUID or an already loaded File), so it can be streamed without reading it into memory.
+
+        The same conditions as get_file_bytes() are validated if validate_conditions is True. If
+        count_download is False, the download quota is neither checked nor incremented (e.g. for
+        resuming a download that was already counted), but the expiration time still is.
+
+        The blob at the path is compressed if the file has a codec, see open_file() to read the file contents.
+
+        Returns the path if the file can be downloaded (and exists on disk with the expected size), else None.
+        """
+
+        # get the file from the db
+        f = self._resolve_file(file)
+        if f is None:
+            return None
+
+        if validate_conditions and not self._check_download(f, count_download=count_download):
+            return None
+
+        sz = self._backend.stat(f.path)
+
+        # the compressed size is only in the blobs table, so compressed blobs aren't checked
+        if sz is not None and f.codec is None and sz != f.size:
+            log.error("file %s is the wrong size on disk (%d bytes instead of %d)", f.path, sz, f.size)
+            sz = None
+
+        if sz is None:
+            if validate_conditions and count_download:
+                self.release_download(f)
+            return None
+
+        return f.path
+
+    def open_file(self, file: f_models.File) -> typing.BinaryIO:
+        """
+        Open a file for reading its contents, decompressing them as they're read if the blob is compressed.
+
+        No download conditions are checked, see get_file_path(). Raises OSError if the blob can't be opened.
+        """
+
+        f = self._backend.open(file.path)
+        if file.codec is None:
+            return f
+
+        try:
+            return f_compression.get_codec(file.codec).open(f)
+        except BaseException:
+            f.close()
+            raise
+
+    def should_encode(self, file: f_models.File) -> bool:
+        """
+        Check if a file is worth compressing for a download.
+
+        Text is, other known types (images, archives etc.) aren't, and unknown types are if their contents look
+        compressible. Blobs stored with a codec that's also a content-coding are better sent as-is.
+        """
+
+        if file.size < f_compression.MIN_SIZE:
+            return False
+
+        if file.codec is not None and f_compression.get_codec(file.codec).content_encoding is not None:
+            return False
+
+        (mimetype, encoding) = mimetypes.guess_type(file.name)
+        if encoding is not None:
+            return False
+        if mimetype is not None:
+            return f_compression.is_text_type(mimetype)
+
+        try:
+            with self.open_file(file) as f:
+                return f_compression.is_compressible(f.read(f_compression.SAMPLE_SIZE), False)
+        except (FileNotFoundError, *f_compression.DECOMPRESS_ERRORS) as e:
+            log.error("failed to sample file %s: %s", file.path, str(e))
+
+        return False
+
+    def get_variant_path(self, file: f_models.File, encoding: str) -> str | None:
+        """Get the path of the cached copy of a file compressed with the transfer encoding, or None if there isn't one."""
+
+        p = self._db.get_variant(file.file_hash, encoding)
+        if p is not None and not self._backend.exists(p):
+            log.warning("compressed copy of %s is missing from disk at %s", file, p)
+            p = None
+
+        if p is None:
+            self._variant_misses += 1
+        else:
+            self._variant_hits += 1
+
+        return p
+
+    def open_encoded(self, file: f_models.File, encoding: str) -> typing.BinaryIO:
+        """
+        Open a file for reading its contents compressed with the transfer encoding, compressing them as they're read.
+
+        Once a file has been compressed variant_min_hits times, the compressed copy is saved (when it's been read all
+        the way through) so get_variant_path() can find it. Raises BadArgs for an unknown encoding, or OSError if the
+        blob can't be opened.
+        """
+
+        compressor = f_compression.transfer_compressor(encoding)
+        f = self.open_file(file)
+
+        key = (file.file_hash, encoding)
+        n = (self._variant_counts.get(key) or 0) + 1
+        self._variant_counts.put(key, n)
+
+        raw: f_compression.CompressingReader
+        if self._variant_cache_size > 0 and n >= self._variant_min_hits:
+            fd, tmp_path = self._backend.temp_file(file.file_hash)
+            raw = f_compression.CopyingReader(
+                f, compressor, os.fdopen(fd, "wb"), tmp_path, lambda p: self._save_variant(file, encoding, p)
+            )
+        else:
+            raw = f_compression.CompressingReader(f, compressor)
+
+        return typing.cast(typing.BinaryIO, io.BufferedReader(raw, f_compression.READ_SIZE))
+
+    def _save_variant(self, file: f_models.File, encoding: str, tmp_path: str):
+        """Move a complete compressed copy of a file into the variant cache, evicting the least recently used ones."""
+
+        p = f"{self._backend.locate(file.file_hash)}.{encoding}"
+        sz = os.path.getsize(tmp_path)
+        if sz > self._variant_cache_size:
+            os.unlink(tmp_path)
+            return
+
+        if not self._backend.put(tmp_path, p):
+            return
+
+        log.debug("cached the %s compressed copy of %s at %s", encoding, file, p)
+        self._variant_counts.invalidate((file.file_hash, encoding))
+        self._remove_orphans(self._db.add_variant(file.file_hash, encoding, p, sz, self._variant_cache_size))
+
+    def get_tree_hash(
+        self, file: bytes | f_models.File, leaf_size: int = DEFAULT_UPLOAD_CHUNK_SIZE, workers: int | None = None
+    ) -> tuple[str, list[str]] | None:
+        """
+        Compute the tree hash of a stored file on up to workers threads (default: one per core).
+
+        The default leaf size matches the default upload chunk size, so the leaves can be checked against the chunks
+        of a chunked upload. Returns (root, leaf hashes), or None if the file doesn't exist.
+        """
+
+        if leaf_size <= 0:
+            raise f_exc.BadArgs(f"invalid leaf size: {leaf_size}")
+
+        f = self._resolve_file(file)
+        if f is None:
+            return None
+
+        try:
+            # the leaves of a compressed blob can't be read independently
+            if f.codec is not None:
+                with self.open_file(f) as fh:
+                    return f_hashing.stream_tree_hash(fh, leaf_size)
+
+            return f_hashing.tree_hash(f.path, leaf_size, workers)
+        except FileNotFoundError:
+            log.error("failed to hash file %s, file not found", f.path)
+        except f_compression.DECOMPRESS_ERRORS as e:
+            log.error("failed to decompress file %s with %s: %s", f.path, f.codec, str(e))
+
+        return None
+
+    def claim_download(self, uuid: bytes, served: int = 0) -> bytes | None:
+        """
+        Issue a claim token for a download that was just counted, which sent the file up to served bytes in (0 if the
+        whole file was sent, since it may not have all arrived).
+
+        Presenting the token later lets the client resume the download with a Range request without using up another
+        download, as long as each range continues from the last one. Returns the token, or None if the file doesn't
+        exist.
+        """
+
+        token = f_utils.gen_uuid()
+        if not self._db.add_download_claim(uuid, token, served):
+            return None
+
+        return token
+
+    def check_download_claim(self, uuid: bytes, token: bytes) -> bool:
+        """Check if a claim token from a previous download of the file is still valid."""
+
+        return self._db.check_download_claim(uuid, token)
+
+    def continue_download(self, uuid: bytes, token: bytes, start: int, stop: int | None) -> bool:
+        """
+        Use a claim token to resume a download with the bytes from start to stop (None for the end of the file).
+        Returns True if the claim is valid for that range, in which case the download isn't counted again.
+        """
+
+        return self._db.continue_download_claim(uuid, token, start, stop)
+
+    def prune_download_claims(self, limit: int) -> int:
+        """Delete up to limit download claims that are too old to be used. Returns the number deleted."""
+
+        return self._db.delete_old_download_claims(limit)
+
+    def release_claim(self, uuid: bytes, token: bytes) -> bool:
+        """Use up a claim token, once the end of the file was sent with it. Returns True if it was valid."""
+
+        return self._db.delete_download_claim(uuid, token)
+
+    def _remove_orphans(self, orphaned: list[tuple[str, str]]):
+        """Remove unreferenced blobs from disk, from (hash, path) pairs, unless they're referenced again by now."""
+
+        def remove(path: str):
+            log.debug("removing unreferenced blob %s", path)
+            self._backend.delete(path)
+
+        if orphaned:
+            self._db.remove_orphans(orphaned, remove)
+
+    def _audit_deletes(self, uuids: list[bytes]):
+        if self._audit is None:
+            return
+
+        # the file row is gone by now, so the uuid is in the message
+        for u in uuids:
+            self._audit.record("file.delete", file_uuid=u, message=f_utils.hexstr(u))
+
+    def delete_file(self, uuid: bytes) -> bool:
+        """
+        Delete a file from the database, and remove its blob from disk if no other file references it.
+
+        Returns True if the file was deleted.
+        """
+
+        orphaned = self._db.delete_file(uuid)
+        if orphaned is None:
+            return False
+
+        self._remove_orphans(orphaned)
+        self._audit_deletes([uuid])
+
+        return True
+
+    @OP_SECONDS.time("op")
+    def delete_files(self, uuids: list[bytes]) -> int:
+        """
+        Delete a batch of files in a single transaction, removing the blobs that aren't referenced anymore.
+
+        Returns the number of files that were deleted.
+        """
+
+        (deleted, orphaned) = self._db.delete_files(uuids)
+        self._remove_orphans(orphaned)
+        self._audit_deletes(deleted)
+
+        return len(deleted)
+
+    def get_reapable_files(self, limit: int) -> list[bytes]:
+        """Get the UUIDs of up to limit files that can't be downloaded anymore (expired or out of download quota)."""
+
+        uuids = self._db.get_expired_files(f_time.now(), limit)
+        if len(uuids) < limit:
+            uuids += self._db.get_exhausted_files(limit - len(uuids))
+
+        # a file can be both expired and out of quota
+        return list(dict.fromkeys(uuids))
+
+    def _move_blob(self, b: f_models.Blob, path: str) -> bool:
+        """Copy a blob to a new path, and point it (and its files) there. The old copy is left alone."""
+
+        fd, tmp_path = self._backend.temp_file(b.file_hash)
+        try:
+            with self._backend.open(b.path) as src, os.fdopen(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst, DEFAULT_CHUNK_SIZE)
+        except OSError as e:
+            log.error("failed to copy blob %s from %s: %s", b, b.path, str(e))
+            os.unlink(tmp_path)
+            return False
+
+        def place():
+            if not self._backend.put(tmp_path, path):
+                raise OSError(f"failed to put the copy of {b} in place at {path}")
+
+        # the copy is put in place while the database is locked, so it can't replace a copy an upload just wrote
+        try:
+            moved = self._db.move_blob(b.file_hash, b.path, path, place)
+        except OSError as e:
+            log.error("failed to move blob %s: %s", b, str(e))
+            return False
+
+        if not moved:
+            log.debug("blob %s changed while it was being moved, discarding the copy", b)
+            os.unlink(tmp_path)
+            return False
+
+        log.debug("moved blob %s from %s to %s", b, b.path, path)
+        return True
+
+    def _remove_moved(self, moved: list[f_models.Blob]):
+        """Remove the old copies of moved blobs, unless a blob was pointed back at its old copy since."""
+
+        self._remove_orphans([(b.file_hash, b.path) for b in moved])
+
+    @OP_SECONDS.time("op")
+    def rebalance(self, batch_size: int = DEFAULT_REBALANCE_BATCH_SIZE, grace: float = 0) -> int:
+        """
+        Move the blobs that aren't where the backend would store them now (e.g. after adding a disk to it).
+
+        Other processes can have the old paths in their file cache, so the old copy of a blob is only removed grace
+        seconds (the file cache ttl) after it's moved. Returns the number of blobs that were moved.
+        """
+
+        if batch_size <= 0 or grace < 0:
+            raise f_exc.BadArgs(f"invalid rebalance settings, batch_size={batch_size} grace={grace}")
+
+        moved = 0
+        pending: list[tuple[float, list[f_models.Blob]]] = []
+
+        after = 0
+        while blobs := self._db.get_blobs(after, batch_size):
+            after = blobs[-1][0]
+
+            batch = []
+            for _, b in blobs:
+                path = self._backend.locate(b.file_hash)
+                if b.path != path and self._move_blob(b, path):
+                    batch.append(b)
+
+            moved += len(batch)
+            pending.append((time.monotonic() + grace, batch))
+
+            while pending and pending[0][0] <= time.monotonic():
+                self._remove_moved(pending.pop(0)[1])
+
+        for due, batch in pending:
+            time.sleep(max(due - time.monotonic(), 0))
+            self._remove_moved(batch)
+
+        log.info("rebalanced %d blobs", moved)
+        return moved
+
+    def _gen_upload_dir(self, session: f_models.UploadSession) -> str:
+        """Generate the path of the directory the chunks of a chunked upload are saved in."""
+
+        return os.path.join(self._root_path, UPLOADS_DIR, f_utils.hexstr(session.uuid))
+
+    def _gen_chunk_path(self, session: f_models.UploadSession, idx: int, chunk_hash: str) -> str:
+        """
+        Generate a path to save a chunk of a chunked upload at. Each version of a chunk gets its own path, so uploading
+        it again can't change the one that's being read to finalize the upload.
+        """
+
+        return os.path.join(self._gen_upload_dir(session), f"{idx}.{chunk_hash}")
+
+    def _read_chunks(self, session: f_models.UploadSession, received: dict[int, str]) -> typing.Iterator[bytes]:
+        """Yield the contents of the received chunks (index -> hash) of an upload session in order."""
+
+        for idx in range(session.num_chunks):
+            with open(self._gen_chunk_path(session, idx, received[idx]), "rb") as f:
+                yield from f_hashing.iter_chunks(f, DEFAULT_CHUNK_SIZE)
+
+    def new_upload_session(
+        self,
+        name: str,
+        size: int,
+        chunk_size: int = DEFAULT_UPLOAD_CHUNK_SIZE,
+        anon_upload: bool = False,
+        username: str | None = None,
+        expiration_time: datetime | None = None,
+        max_downloads: int | None = None,
+    ) -> f_models.UploadSession | None:
+        """
+        Start a chunked upload of a file that is size bytes long.
+
+        The file is split into chunk_size byte chunks (the last one can be shorter), which can be
+        uploaded in any order (and in parallel) with save_upload_chunk() and then assembled with finalize_upload().
+
+        If anon_upload is True, username must be None. Otherwise, the username of the uploader must be specified.
+        """
+
+        if size < 0:
+            raise f_exc.BadArgs(f"invalid upload size: {size}")
+
+        if chunk_size <= 0 or chunk_size > MAX_UPLOAD_CHUNK_SIZE:
+            raise f_exc.BadArgs(f"invalid chunk size {chunk_size}, must be between 1 and {MAX_UPLOAD_CHUNK_SIZE} bytes")
+
+        if size > self._max_size:
+            raise f_exc.FileTooLarge(
+                f"can't upload file {name}, too big! max is {self._max_size} bytes, this file is {size} bytes"
+            )
+
+        username = self._get_uploader(anon_upload, username)
+
+        s = f_models.UploadSession.new(name, size, chunk_size, username, expiration_time, max_downloads)
+
+        if not self._db.add_upload_session(s):
+            log.error("failed to save new upload session to the database: %s", s)
+            return None
+
+        return s
+
+    def get_upload_session(self, uuid: bytes) -> f_models.UploadSession | None:
+        """Get a chunked upload session, or None if it doesn't exist."""
+
+        return self._db.get_upload_session(uuid)
+
+    @OP_SECONDS.time("op")
+    def save_upload_chunk(self, session: f_models.UploadSession, idx: int, stream: ByteStream, chunk_hash: str) -> bool:
+        """
+        Save a chunk of a chunked upload. Uploading the same chunk again replaces it.
+
+        Raises BadArgs if the chunk is the wrong size, or BadChecksum if the sha256 of the chunk doesn't match chunk_hash.
+
+        Returns True if the chunk was saved.
+        """
+
+        expected = session.chunk_length(idx)
+
+        r = self._write_stream(session.name, stream, DEFAULT_CHUNK_SIZE, max_size=expected, temp_dir=self._root_path)
+        if r is None:
+            return False
+        (tmp_path, h, sz, _) = r
+
+        if sz != expected:
+            os.unlink(tmp_path)
+            raise f_exc.BadArgs(f"chunk {idx} of {session} is the wrong size ({sz} bytes instead of {expected})")
+
+        if h != chunk_hash.lower():
+            os.unlink(tmp_path)
+            raise f_exc.BadChecksum(f"chunk {idx} of {session} has the wrong hash ({h} instead of {chunk_hash})")
+
+        path = self._gen_chunk_path(session, idx, h)
+        if not f_storage.move_file(tmp_path, path):
+            return False
+
+        if self._db.add_upload_chunk(session.uuid, idx, sz, h):
+            return True
+
+        # the chunks can't change once the upload is being finalized, and removing this one could remove the chunk
+        # that's being read (if it's the same), so it's left for when the session is removed
+        if self._db.get_upload_session(session.uuid) is not None:
+            raise f_exc.InvalidState(f"can't save chunk {idx} of {session}, it's being finalized")
+
+        # the session was aborted while the chunk was being received, and moving it recreated the session's directory
+        with contextlib.suppress(OSError):
+            os.unlink(path)
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.dirname(path))
+
+        return False
+
+    def get_upload_chunks(self, session: f_models.UploadSession) -> list[int]:
+        """Get the indexes of the chunks that have been received for an upload session."""
+
+        return list(self._db.get_upload_chunks(session.uuid).keys())
+
+    def get_upload_tree_hash(self, session: f_models.UploadSession) -> str | None:
+        """
+        Get the tree hash of a chunked upload, with its chunks as the leaves.
+
+        This comes from the chunk hashes that were verified as the chunks arrived, so nothing is read from disk.
+        Returns None if not all of the chunks have been received.
+        """
+
+        received = self._db.get_upload_chunks(session.uuid)
+        if any(i not in received for i in range(session.num_chunks)):
+            return None
+
+        return f_hashing.tree_root(received[i] for i in range(session.num_chunks))
+
+    @OP_SECONDS.time("op")
+    def finalize_upload(self, session: f_models.UploadSession) -> f_models.File | None:
+        """
+        Assemble the chunks of a chunked upload into a file, and remove the upload session.
+
+        Raises InvalidState if not all of the chunks have been received, or if the upload is already being finalized
+        (or aborted).
+        """
+
+        # only one request gets to read the chunks, and no more can be saved while it does
+        if not self._db.set_upload_finalizing(session.uuid, True):
+            raise f_exc.InvalidState(f"can't finalize {session}, it's already being finalized")
+
+        f = None
+        try:
+            received = self._db.get_upload_chunks(session.uuid)
+            missing = [i for i in range(session.num_chunks) if i not in received]
+            if missing:
+                raise f_exc.InvalidState(f"can't finalize {session}, missing {len(missing)} chunks")
+
+            # the chunks are streamed into the blob store, so the whole file is never in memory
+            anon = session.username == f_db.ANONYMOUS_USERNAME
+            f = self.save_stream(
+                session.name,
+                self._read_chunks(session, received),
+                anon_upload=anon,
+                username=None if anon else session.username,
+                expiration_time=session.expiration_time,
+                max_downloads=session.max_downloads,
+            )
+        finally:
+            if f is None:
+                self._db.set_upload_finalizing(session.uuid, False)
+
+        if f is not None:
+            self.abort_upload(session, force=True)
+
+        return f
+
+    def get_stale_upload_sessions(self, limit: int) -> list[f_models.UploadSession]:
+        """Get up to limit upload sessions that were started too long ago to be finished."""
+
+        sessions = []
+        for uuid in self._db.get_stale_upload_sessions(UPLOAD_SESSION_LIFETIME, limit):
+            s = self._db.get_upload_session(uuid)
+            if s is not None:
+                sessions.append(s)
+
+        return sessions
+
+    def abort_upload(self, session: f_models.UploadSession, force: bool = False) -> bool:
+        """
+        Remove an upload session and any chunks that were received for it. Returns True if the session existed.
+
+        Raises InvalidState if the upload is being finalized, unless force is set (e.g. it's too old to still be).
+        """
+
+        if not force and not self._db.set_upload_finalizing(session.uuid, True):
+            if self._db.get_upload_session(session.uuid) is not None:
+                raise f_exc.InvalidState(f"can't abort {session}, it's being finalized")
+
+        shutil.rmtree(self._gen_upload_dir(session), ignore_errors=True)
 
-        # TODO: dec download count if this fails
-        # TODO: this whole thing is super raceable too. need some way to do txn locking on the file
-        return self._read_bytes(f)
+        return self._db.delete_upload_session(session.uuid)
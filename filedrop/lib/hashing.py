@@ -0,0 +1,231 @@
+"""
+File hashing.
+
+Files are identified by their sha256 (the files.hash column). A single sha256 can't be split across cores, so large
+uploads are instead pipelined: the request thread reads the upload while one thread hashes it and another writes it to
+disk, so hashing overlaps the network and disk I/O. hashlib releases the GIL on large buffers, so threads are enough.
+
+There's also a tree hash, the sha256 of the concatenated (raw) sha256 digests of every leaf_size piece of a file. The
+leaves can be hashed on every core, and verified one at a time (e.g. the chunks of a chunked upload).
+"""
+
+import concurrent.futures
+import hashlib
+import itertools
+import math
+import os
+import queue
+import threading
+import typing
+
+# how many chunks can be waiting for each stage of the pipeline, bounding the memory used per upload
+DEFAULT_PIPELINE_DEPTH = 4
+
+# how much of a leaf is read at a time when computing a tree hash
+READ_SIZE = 1024 * 1024  # 1mb
+
+
+def new_hash() -> "hashlib._Hash":
+    """Get a new hash object for the file hash algorithm."""
+
+    return hashlib.sha256(usedforsecurity=False)
+
+
+def hash_bytes(bytz: bytes | memoryview) -> str:
+    """Get the hash of the provided bytes"""
+
+    h = new_hash()
+    h.update(bytz)
+
+    return h.hexdigest()
+
+
+def iter_chunks(stream: typing.Any, chunk_size: int) -> typing.Iterator[bytes]:
+    """Yield the chunks from a file-like object or an iterable of bytes."""
+
+    read = getattr(stream, "read", None)
+    if read is None:
+        yield from typing.cast(typing.Iterable[bytes], stream)
+        return
+
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+class _Stage(threading.Thread):
+    """A pipeline stage, calling fn on every chunk put in its queue (until None) in its own thread"""
+
+    def __init__(self, name: str, fn: typing.Callable[[typing.Any], typing.Any], depth: int):
+        super().__init__(name=name, daemon=True)
+        self.queue: queue.Queue[bytes | memoryview | None] = queue.Queue(depth)
+        self.error: BaseException | None = None
+        self._fn = fn
+
+    def run(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+
+            # keep draining after an error, so the reader doesn't block on a full queue
+            if self.error is None:
+                try:
+                    self._fn(chunk)
+                except BaseException as e:  # pylint: disable=broad-exception-caught
+                    self.error = e
+
+
+class Compressor(typing.Protocol):
+    """An incremental compressor, like zlib/bz2/lzma compressor objects."""
+
+    def compress(self, data: bytes, /) -> bytes:
+        """Compress the next piece of the data, returning whatever compressed output is ready."""
+
+    def flush(self) -> bytes:
+        """Finish the compressed data, returning the rest of the compressed output."""
+
+
+def _writer(out: typing.BinaryIO, compressor: Compressor | None) -> typing.Callable[[typing.Any], typing.Any]:
+    """Get the function that writes a chunk to out, compressing it first if there's a compressor"""
+
+    if compressor is None:
+        return out.write
+
+    c: Compressor = compressor
+    return lambda chunk: out.write(c.compress(chunk))
+
+
+def hash_and_write(
+    chunks: typing.Iterable[bytes | memoryview],
+    out: typing.BinaryIO,
+    depth: int = DEFAULT_PIPELINE_DEPTH,
+    compressor: Compressor | None = None,
+) -> tuple[str, int]:
+    """
+    Write the chunks to out while hashing them, with the reading, hashing and writing running concurrently.
+
+    If a compressor is given, the chunks are compressed by the writer, but the hash and size are of the uncompressed data.
+    Exceptions from the chunks iterable, or from writing, are raised once the pipeline has stopped.
+    Returns (hash, size).
+    """
+
+    h = new_hash()
+    write = _writer(out, compressor)
+
+    # a single chunk isn't worth starting threads for
+    it = iter(chunks)
+    first = list(itertools.islice(it, 2))
+    if len(first) < 2:
+        for chunk in first:
+            h.update(chunk)
+            write(chunk)
+        if compressor is not None:
+            out.write(compressor.flush())
+        return (h.hexdigest(), sum(len(c) for c in first))
+
+    stages = [_Stage("filedrop-hash", h.update, depth), _Stage("filedrop-write", write, depth)]
+    for s in stages:
+        s.start()
+
+    sz = 0
+    try:
+        for chunk in itertools.chain(first, it):
+            for s in stages:
+                if s.error is not None:
+                    raise s.error
+                s.queue.put(chunk)
+            sz += len(chunk)
+    finally:
+        for s in stages:
+            s.queue.put(None)
+        for s in stages:
+            s.join()
+
+    for s in stages:
+        if s.error is not None:
+            raise s.error
+
+    if compressor is not None:
+        out.write(compressor.flush())
+
+    return (h.hexdigest(), sz)
+
+
+def tree_root(leaves: typing.Iterable[str]) -> str:
+    """Get the tree hash from the (hex) hashes of the leaves."""
+
+    h = new_hash()
+    for leaf in leaves:
+        h.update(bytes.fromhex(leaf))
+
+    return h.hexdigest()
+
+
+def _hash_range(fd: int, offset: int, length: int) -> str:
+    """Hash length bytes of the file starting at offset"""
+
+    h = new_hash()
+    end = offset + length
+    while offset < end:
+        b = os.pread(fd, min(READ_SIZE, end - offset), offset)
+        if not b:
+            break
+        h.update(b)
+        offset += len(b)
+
+    return h.hexdigest()
+
+
+def leaf_hashes(path: str, leaf_size: int, workers: int | None = None) -> list[str]:
+    """Hash every leaf_size piece of a file (the last one can be shorter), on up to workers threads."""
+
+    n = max(1, math.ceil(os.path.getsize(path) / leaf_size))
+
+    with open(path, "rb") as f:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="filedrop-hash") as pool:
+            return list(pool.map(lambda i: _hash_range(f.fileno(), i * leaf_size, leaf_size), range(n)))
+
+
+def tree_hash(path: str, leaf_size: int, workers: int | None = None) -> tuple[str, list[str]]:
+    """Compute the tree hash of a file on up to workers threads. Returns (root, leaf hashes)."""
+
+    leaves = leaf_hashes(path, leaf_size, workers)
+
+    return (tree_root(leaves), leaves)
+
+
+def stream_tree_hash(f: typing.BinaryIO, leaf_size: int) -> tuple[str, list[str]]:
+    """Compute the tree hash of a file that can only be read in order (e.g. a decompressing one). Returns (root, leaf hashes)."""
+
+    leaves: list[str] = []
+    while True:
+        h = new_hash()
+        n = 0
+        while n < leaf_size:
+            b = f.read(min(READ_SIZE, leaf_size - n))
+            if not b:
+                break
+            h.update(b)
+            n += len(b)
+
+        # like leaf_hashes(), an empty file is one empty leaf
+        if n == 0 and leaves:
+            break
+        leaves.append(h.hexdigest())
+        if n < leaf_size:
+            break
+
+    return (tree_root(leaves), leaves)
+
+
+def verify_leaves(path: str, leaves: list[str], leaf_size: int, workers: int | None = None) -> list[int]:
+    """Check a file against the expected leaf hashes. Returns the indexes of the leaves that don't match."""
+
+    actual = leaf_hashes(path, leaf_size, workers)
+    if len(actual) != len(leaves):
+        return list(range(max(len(actual), len(leaves))))
+
+    return [i for i, (a, e) in enumerate(zip(actual, leaves)) if a != e.lower()]
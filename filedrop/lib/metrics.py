@@ -0,0 +1,365 @@
+"""
+Prometheus-style metrics.
+
+Metrics are kept in memory per process. When a metrics directory is set (with multiple gunicorn workers), every
+process also periodically writes a snapshot of its counters and histograms to its own file in the directory, and the
+snapshots of all of the processes are added together when the metrics are collected. The directory should be emptied
+before the server starts, otherwise the counts from the previous run are included.
+"""
+
+import functools
+import glob
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import typing
+
+import filedrop.lib.exc as f_exc
+
+log = logging.getLogger(__name__)
+
+# how often each process writes its snapshot to the metrics directory (in seconds)
+FLUSH_INTERVAL = 1.0
+
+SNAPSHOT_PREFIX = "metrics-"
+
+# request latencies, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# sqlite query latencies, in seconds
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+# sorted (label name, label value) pairs
+LabelsType = tuple[tuple[str, str], ...]
+
+F = typing.TypeVar("F", bound=typing.Callable[..., typing.Any])
+
+
+def label_set(**kwargs: str) -> LabelsType:
+    """Build the labels for a value, e.g. in the dict returned by a counter/gauge func."""
+
+    return tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+
+
+def _fmt_labels(labels: LabelsType, extra: tuple[str, str] | None = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _fmt_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class Counter:
+    """A value that only goes up, e.g. the number of requests. Get these from Registry.counter()."""
+
+    def __init__(self, registry: "Registry", name: str, desc: str):
+        self._registry = registry
+        self.name = name
+        self.desc = desc
+
+    def inc(self, amount: float = 1, **labels: str):
+        """Increment the counter for the labels."""
+
+        if amount < 0:
+            raise f_exc.BadArgs(f"counters can only go up: {self.name}")
+
+        with self._registry.lock:
+            values = self._registry.values(self.name)
+            k = label_set(**labels)
+            values[k] = values.get(k, 0) + amount
+
+        self._registry.mark_dirty()
+
+
+class Histogram:
+    """Observations counted into buckets, e.g. request latencies. Get these from Registry.histogram()."""
+
+    def __init__(self, registry: "Registry", name: str, desc: str, buckets: typing.Sequence[float]):
+        if list(buckets) != sorted(buckets) or not buckets:
+            raise f_exc.BadArgs(f"invalid histogram buckets: {name}")
+
+        self._registry = registry
+        self.name = name
+        self.desc = desc
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str):
+        """Add an observation for the labels."""
+
+        with self._registry.lock:
+            values = self._registry.values(self.name)
+            k = label_set(**labels)
+
+            # [count per bucket..., count past the last bucket, sum]
+            v = values.get(k)
+            if v is None:
+                v = values[k] = [0.0] * (len(self.buckets) + 2)
+
+            i = 0
+            while i < len(self.buckets) and value > self.buckets[i]:
+                i += 1
+            v[i] += 1
+            v[-1] += value
+
+        self._registry.mark_dirty()
+
+    def time(self, label: str, **labels: str) -> typing.Callable[[F], F]:
+        """
+        Decorator to observe how long every call of a function takes.
+
+        The function name (without leading underscores) is used as the value of the label.
+        """
+
+        def decorator(fn: F) -> F:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **{label: fn.__name__.lstrip("_")}, **labels)
+
+            return typing.cast(F, wrapper)
+
+        return decorator
+
+
+class Registry:
+    """
+    A set of metrics for the process.
+
+    Besides counters and histograms, functions can be registered to compute values when the metrics are collected:
+    - counter funcs return the absolute value of a counter for the process (e.g. cache hits), and are summed across
+      processes like any other counter
+    - gauge funcs return the current value of something that isn't per process (e.g. disk usage), and are only
+      computed by the process collecting the metrics
+    Both return a dict of label dicts (as sorted pair tuples) to values; registering a name again replaces the func.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+        # name -> (type, desc, buckets)
+        self._meta: dict[str, tuple[str, str, tuple[float, ...]]] = {}
+
+        # name -> labels -> counter value, or histogram bucket counts and sum
+        self._values: dict[str, dict[LabelsType, typing.Any]] = {}
+
+        self._counter_funcs: dict[str, typing.Callable[[], dict[LabelsType, float]]] = {}
+        self._gauge_funcs: dict[str, typing.Callable[[], dict[LabelsType, float]]] = {}
+
+        self._dir: str | None = None
+        self._pid = os.getpid()
+        self._dirty = threading.Event()
+        self._flusher: threading.Thread | None = None
+
+    def _define(self, name: str, kind: str, desc: str, buckets: tuple[float, ...] = ()):
+        with self.lock:
+            existing = self._meta.get(name)
+            if existing is not None and existing[0] != kind:
+                raise f_exc.BadArgs(f"metric {name} is already defined as a {existing[0]}")
+
+            self._meta[name] = (kind, desc, buckets)
+
+    def counter(self, name: str, desc: str) -> Counter:
+        """Define a counter."""
+
+        self._define(name, "counter", desc)
+        return Counter(self, name, desc)
+
+    def histogram(self, name: str, desc: str, buckets: typing.Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """Define a histogram."""
+
+        h = Histogram(self, name, desc, buckets)
+        self._define(name, "histogram", desc, h.buckets)
+        return h
+
+    def counter_func(self, name: str, desc: str, fn: typing.Callable[[], dict[LabelsType, float]]):
+        """Register a function that returns the per-process values of a counter."""
+
+        self._define(name, "counter", desc)
+        with self.lock:
+            self._counter_funcs[name] = fn
+
+    def gauge_func(self, name: str, desc: str, fn: typing.Callable[[], dict[LabelsType, float]]):
+        """Register a function that returns the current values of a gauge."""
+
+        self._define(name, "gauge", desc)
+        with self.lock:
+            self._gauge_funcs[name] = fn
+
+    def values(self, name: str) -> dict[LabelsType, typing.Any]:
+        """Get the values of a metric for this process. Must be called with the lock held."""
+
+        # the values are inherited when a worker is forked, but they were already counted by the parent
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._values.clear()
+            self._flusher = None
+
+        return self._values.setdefault(name, {})
+
+    @property
+    def metrics_dir(self) -> str | None:
+        """The directory the processes share their metrics through, or None if they aren't shared."""
+
+        return self._dir
+
+    def set_dir(self, path: str | None):
+        """Share the metrics of every process through the directory (or stop sharing them if None)."""
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+        with self.lock:
+            self._dir = path
+
+    def mark_dirty(self):
+        """Note that the values changed, so the snapshot is rewritten soon."""
+
+        if self._dir is None:
+            return
+
+        self._dirty.set()
+
+        with self.lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="filedrop-metrics", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        """Background thread entrypoint, writes the snapshot whenever it changed"""
+
+        pid = os.getpid()
+        while self._dir is not None and pid == self._pid:
+            self._dirty.wait()
+            self._dirty.clear()
+
+            try:
+                self.flush()
+            except OSError:
+                log.exception("failed to write the metrics snapshot")
+
+            time.sleep(FLUSH_INTERVAL)
+
+    def snapshot(self) -> dict[str, list]:
+        """Get the counters and histograms of this process, in a JSON-serializable form."""
+
+        with self.lock:
+            out = {name: [[list(k), v] for k, v in self.values(name).items()] for name in list(self._values)}
+            funcs = list(self._counter_funcs.items())
+
+        for name, fn in funcs:
+            try:
+                out[name] = [[list(k), v] for k, v in fn().items()]
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception("failed to collect the %s metric", name)
+
+        return out
+
+    def flush(self):
+        """Write the snapshot of this process to the metrics directory."""
+
+        d = self._dir
+        if d is None:
+            return
+
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=d)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, os.path.join(d, f"{SNAPSHOT_PREFIX}{os.getpid()}.json"))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _merge(self, total: dict[str, dict[LabelsType, typing.Any]], snap: dict[str, list]):
+        for name, entries in snap.items():
+            if name not in self._meta:
+                continue
+
+            values = total.setdefault(name, {})
+            for k, v in entries:
+                k = tuple(tuple(x) for x in k)
+                if isinstance(v, list):
+                    prev = values.get(k)
+                    values[k] = v if prev is None else [a + b for a, b in zip(prev, v)]
+                else:
+                    values[k] = values.get(k, 0) + v
+
+    def collect(self) -> dict[str, dict[LabelsType, typing.Any]]:
+        """Get the values of every metric, added up across all of the processes."""
+
+        total: dict[str, dict[LabelsType, typing.Any]] = {}
+
+        if self._dir is None:
+            self._merge(total, self.snapshot())
+        else:
+            # make sure this process's values are up to date
+            self.flush()
+
+            for p in glob.glob(os.path.join(self._dir, f"{SNAPSHOT_PREFIX}*.json")):
+                try:
+                    with open(p, "r", encoding="utf-8") as f:
+                        self._merge(total, json.load(f))
+                except (OSError, ValueError):
+                    log.warning("failed to read metrics snapshot %s", p)
+
+        with self.lock:
+            funcs = list(self._gauge_funcs.items())
+
+        for name, fn in funcs:
+            try:
+                total[name] = fn()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception("failed to collect the %s metric", name)
+
+        return total
+
+    def render(self, total: dict[str, dict[LabelsType, typing.Any]] | None = None) -> str:
+        """Render the collected metrics in the Prometheus text format."""
+
+        if total is None:
+            total = self.collect()
+
+        lines = []
+        for name in sorted(total):
+            (kind, desc, buckets) = self._meta[name]
+            lines.append(f"# HELP {name} {desc}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for k, v in sorted(total[name].items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{_fmt_labels(k)} {_fmt_value(v)}")
+                    continue
+
+                cumulative = 0.0
+                for le, n in zip(buckets + (math.inf,), v[:-1]):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_fmt_labels(k, ('le', _fmt_value(le)))} {_fmt_value(cumulative)}")
+                lines.append(f"{name}_sum{_fmt_labels(k)} {_fmt_value(v[-1])}")
+                lines.append(f"{name}_count{_fmt_labels(k)} {_fmt_value(cumulative)}")
+
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """Reset every metric of this process."""
+
+        with self.lock:
+            self._values.clear()
+
+
+# the registry for the process
+REGISTRY = Registry()
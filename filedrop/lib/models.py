@@ -1,16 +1,62 @@
 import hashlib
+import hmac
 import logging
-from dataclasses import dataclass
+import secrets
+from dataclasses import dataclass, field
 from datetime import datetime
 
-from Crypto.Random import get_random_bytes
-
 import filedrop.lib.exc as f_exc
 import filedrop.lib.utils as f_utils
 
 log = logging.getLogger(__name__)
 
 
+# prefix of password hashes that record their scrypt parameters. hashes without it are from before the parameters
+# were configurable, and used LEGACY_SCRYPT_PARAMS
+SCRYPT_PREFIX = b"scrypt$"
+
+
+@dataclass(frozen=True)
+class ScryptParams:
+    """Cost parameters for scrypt: CPU/memory cost n (a power of 2), block size r, and parallelization p."""
+
+    n: int = 2**14
+    r: int = 8
+    p: int = 1
+
+    def validate(self):
+        """Raise BadArgs if the parameters aren't valid for scrypt."""
+
+        if self.n < 2 or self.n & (self.n - 1) or self.r < 1 or self.p < 1:
+            raise f_exc.BadArgs(f"invalid scrypt parameters: {self}")
+
+    @property
+    def maxmem(self) -> int:
+        """How much memory scrypt needs with these parameters (hashlib refuses to use more than 32MB by default)."""
+
+        return 128 * self.r * (self.n + self.p + 2) + 1024 * 1024
+
+    def encode(self, h: bytes) -> bytes:
+        """Encode a hash along with the parameters it was made with."""
+
+        return SCRYPT_PREFIX + f"{self.n}${self.r}${self.p}$".encode() + h
+
+    @classmethod
+    def decode(cls, encoded: bytes) -> tuple["ScryptParams", bytes]:
+        """Split an encoded hash into the parameters it was made with, and the raw hash."""
+
+        if not encoded.startswith(SCRYPT_PREFIX):
+            return (LEGACY_SCRYPT_PARAMS, encoded)
+
+        (n, r, p, h) = encoded[len(SCRYPT_PREFIX) :].split(b"$", 3)
+
+        return (cls(n=int(n), r=int(r), p=int(p)), h)
+
+
+LEGACY_SCRYPT_PARAMS = ScryptParams(n=2**14, r=8, p=1)
+DEFAULT_SCRYPT_PARAMS = ScryptParams()
+
+
 @dataclass
 class User:
     """A representation of a user from the database."""
@@ -26,11 +72,13 @@ class User:
     def gen_salt(cls) -> bytes:
         """Generate a salt value"""
 
-        return get_random_bytes(16)
+        return secrets.token_bytes(16)
 
     @classmethod
-    def hash_pw(cls, password: str | bytes, salt: bytes | None = None) -> tuple[bytes, bytes]:
-        """Hash the password using scrypt. Returns the (hash, salt)"""
+    def hash_pw(
+        cls, password: str | bytes, salt: bytes | None = None, params: ScryptParams = DEFAULT_SCRYPT_PARAMS
+    ) -> tuple[bytes, bytes]:
+        """Hash the password using scrypt. Returns the (hash, salt), with the parameters encoded in the hash."""
 
         if isinstance(password, str):
             password = password.encode()
@@ -38,24 +86,29 @@ class User:
         if not salt:
             salt = cls.gen_salt()
 
-        n = 2**14
-        r = 8
-        p = 1
-
-        h = hashlib.scrypt(password=password, salt=salt, n=n, r=r, p=p)
+        h = hashlib.scrypt(password=password, salt=salt, n=params.n, r=params.r, p=params.p, maxmem=params.maxmem)
         del password
 
-        return (h, salt)
+        return (params.encode(h), salt)
 
     @staticmethod
-    def new(username, password) -> "User":
+    def new(username, password, params: ScryptParams = DEFAULT_SCRYPT_PARAMS) -> "User":
         """Construct a new user object"""
 
-        (h, salt) = User.hash_pw(password)
+        (h, salt) = User.hash_pw(password, params=params)
         del password
 
         return User(uuid=f_utils.gen_uuid(), username=username, password_hash=h, salt=salt)
 
+    @property
+    def scrypt_params(self) -> ScryptParams | None:
+        """The scrypt parameters the password was hashed with, or None if there's no password."""
+
+        if self.password_hash is None:
+            return None
+
+        return ScryptParams.decode(self.password_hash)[0]
+
     def check_password(self, password: str) -> bool:
         """Check if the provided password is valid for this user"""
 
@@ -63,18 +116,19 @@ class User:
             log.debug("%s is anonymous, assuming valid password", self)
             return True
 
-        if not self.password_hash is not None and self.salt is not None:
+        if self.password_hash is None or self.salt is None:
             raise f_exc.InvalidState(f"Can't check the password, don't have valid params for {self}")
 
-        (h, _) = self.hash_pw(password, self.salt)
+        (params, expected) = ScryptParams.decode(self.password_hash)
+        (h, _) = self.hash_pw(password, self.salt, params)
         del password
 
-        return h == self.password_hash
+        return hmac.compare_digest(ScryptParams.decode(h)[1], expected)
 
-    def update_password(self, password: str):
+    def update_password(self, password: str, params: ScryptParams = DEFAULT_SCRYPT_PARAMS):
         """Replace the hash+salt for the new password."""
 
-        (self.password_hash, self.salt) = self.hash_pw(password)
+        (self.password_hash, self.salt) = self.hash_pw(password, params=params)
         del password
 
     def __repr__(self) -> str:
@@ -97,6 +151,7 @@ class File:
     expiration_time: datetime | None = None
     max_downloads: int | None = None
     uploaded_at: datetime | None = None
+    codec: str | None = None
 
     @staticmethod
     def new(
@@ -108,6 +163,7 @@ class File:
         expiration_time: datetime | None = None,
         max_downloads: int | None = None,
         uploaded_at: datetime | None = None,
+        codec: str | None = None,
     ) -> "File":
         """Generate a new File object"""
 
@@ -121,6 +177,7 @@ class File:
             expiration_time=expiration_time,
             max_downloads=max_downloads,
             uploaded_at=uploaded_at,
+            codec=codec,
         )
 
     def __repr__(self) -> str:
@@ -142,4 +199,118 @@ class File:
             and self.username == rhs.username
             and self.expiration_time == rhs.expiration_time
             and self.max_downloads == rhs.max_downloads
+            and self.codec == rhs.codec
         )
+
+
+@dataclass
+class FileSummary:
+    """The metadata of a file that's shown in a listing of files."""
+
+    uuid: bytes
+    name: str
+    size: int
+    username: str
+    uploaded_at: datetime
+
+    def __repr__(self) -> str:
+        return f"<FileSummary {self.name} - {f_utils.hexstr(self.uuid)}>"
+
+    def __str__(self) -> str:
+        return repr(self)
+
+
+@dataclass
+class UploadSession:
+    """A representation of an in-progress chunked upload from the database."""
+
+    uuid: bytes
+    name: str
+    size: int
+    chunk_size: int
+    username: str
+    expiration_time: datetime | None = None
+    max_downloads: int | None = None
+    created_at: datetime | None = field(default=None, compare=False)
+
+    @staticmethod
+    def new(
+        name: str,
+        size: int,
+        chunk_size: int,
+        username: str,
+        expiration_time: datetime | None = None,
+        max_downloads: int | None = None,
+    ) -> "UploadSession":
+        """Generate a new UploadSession object"""
+
+        return UploadSession(
+            uuid=f_utils.gen_uuid(),
+            name=name,
+            size=size,
+            chunk_size=chunk_size,
+            username=username,
+            expiration_time=expiration_time,
+            max_downloads=max_downloads,
+        )
+
+    @property
+    def num_chunks(self) -> int:
+        """Number of chunks the file is split into. An empty file still has one (empty) chunk."""
+
+        return max(1, -(-self.size // self.chunk_size))
+
+    def chunk_length(self, idx: int) -> int:
+        """Get the expected length of a chunk. Every chunk is chunk_size bytes, except for the last one."""
+
+        if idx < 0 or idx >= self.num_chunks:
+            raise f_exc.BadArgs(f"invalid chunk index {idx} for {self}")
+
+        if idx == self.num_chunks - 1:
+            return self.size - (self.num_chunks - 1) * self.chunk_size
+
+        return self.chunk_size
+
+    def __repr__(self) -> str:
+        return f"<UploadSession {self.name} [{self.size} bytes in {self.num_chunks} chunks] - user {self.username}>"
+
+    def __str__(self) -> str:
+        return repr(self)
+
+
+@dataclass
+class Blob:
+    """A representation of a content-addressed blob from the database, shared by every file with the same hash."""
+
+    file_hash: str
+    path: str
+    size: int
+    refcount: int = 0
+
+    # the compression codec the blob is stored with (None if it isn't), and its size on disk if so
+    codec: str | None = None
+    stored_size: int | None = None
+
+    def __repr__(self) -> str:
+        return f"<Blob [{self.file_hash[:8]}...{self.file_hash[-8:]}, {self.size} bytes] - {self.refcount} refs>"
+
+    def __str__(self) -> str:
+        return repr(self)
+
+
+@dataclass
+class AuditEvent:
+    """An event for the audit log (the log table)."""
+
+    action: str
+    username: str | None = None
+    file_uuid: bytes | None = None
+    src_ip: str | None = None
+    message: str | None = None
+    ts: datetime | None = None
+
+    def __repr__(self) -> str:
+        return f"<AuditEvent {self.action} - user {self.username}>"
+
+    def __str__(self) -> str:
+        return repr(self)
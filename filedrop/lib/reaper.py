@@ -0,0 +1,174 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+import typing
+
+import filedrop.lib.exc as f_exc
+import filedrop.lib.filestore as f_fs
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 10 * 60  # 10 minutes
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_RATE = 50  # files per second
+
+
+class Reaper:
+    """
+    Deletes files that can't be downloaded anymore (expired or out of download quota), abandoned chunked uploads, and
+    download claims that are too old to be used.
+
+    Files are deleted in batches of batch_size (one transaction per batch), and at most rate files per second are
+    deleted so the disk isn't saturated. It can either be run once with run_once(), or periodically in a background
+    thread with start()/stop().
+
+    When several processes share a database (e.g. the gunicorn workers), they can each start a reaper with the same
+    lock_path, and only the one holding the lock on it reaps. If that process exits, the lock is released and another
+    one takes over on its next interval.
+    """
+
+    def __init__(
+        self,
+        fs: f_fs.Filestore,
+        interval: int = DEFAULT_INTERVAL,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        rate: int = DEFAULT_RATE,
+        lock_path: str | None = None,
+    ):
+        if interval <= 0 or batch_size <= 0 or rate <= 0:
+            raise f_exc.BadArgs(f"invalid reaper settings, interval={interval} batch_size={batch_size} rate={rate}")
+
+        self._fs = fs
+        self._interval = interval
+        self._batch_size = batch_size
+        self._rate = rate
+        self._lock_path = lock_path
+        self._lock_file: typing.IO | None = None
+
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def _throttle(self, num: int, started: float) -> bool:
+        """
+        Sleep long enough that num deletions since started don't exceed the rate.
+
+        Returns False if the reaper was stopped while waiting.
+        """
+
+        delay = num / self._rate - (time.monotonic() - started)
+        if delay > 0:
+            return not self._stop.wait(delay)
+
+        return not self._stop.is_set()
+
+    def run_once(self) -> int:
+        """Delete everything that can be reaped right now. Returns the number of files deleted."""
+
+        total = 0
+
+        while not self._stop.is_set():
+            started = time.monotonic()
+
+            uuids = self._fs.get_reapable_files(self._batch_size)
+            if not uuids:
+                break
+
+            n = self._fs.delete_files(uuids)
+            total += n
+            log.debug("reaped a batch of %d files", n)
+
+            if n == 0 or not self._throttle(len(uuids), started):
+                break
+
+        while not self._stop.is_set():
+            started = time.monotonic()
+
+            sessions = self._fs.get_stale_upload_sessions(self._batch_size)
+            if not sessions:
+                break
+
+            for s in sessions:
+                log.debug("aborting abandoned upload %s", s)
+                self._fs.abort_upload(s, force=True)
+
+            if not self._throttle(len(sessions), started):
+                break
+
+        # every download leaves a claim behind, which is only useful for a day
+        claims = 0
+        while not self._stop.is_set():
+            n = self._fs.prune_download_claims(self._batch_size)
+            claims += n
+            if n < self._batch_size:
+                break
+
+        if claims > 0:
+            log.debug("pruned %d old download claims", claims)
+
+        if total > 0:
+            log.info("reaped %d files", total)
+
+        return total
+
+    def elect(self) -> bool:
+        """
+        Try to become the process that reaps, by locking lock_path. Returns True if this reaper holds the lock (or
+        doesn't use one), False if another process does.
+        """
+
+        if self._lock_path is None or self._lock_file is not None:
+            return True
+
+        f = open(self._lock_path, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+
+        self._lock_file = f
+        log.info("reaping in this process (pid %d)", os.getpid())
+
+        return True
+
+    def _release(self):
+        """Release the lock, so another process can take over reaping."""
+
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _run(self):
+        """Background thread entrypoint"""
+
+        while not self._stop.is_set():
+            try:
+                if self.elect():
+                    self.run_once()
+            except Exception:  # pylint: disable=broad-exception-caught
+                log.exception("failed to reap files")
+
+            self._stop.wait(self._interval)
+
+    def start(self):
+        """Start reaping periodically in a background thread."""
+
+        if self._thread is not None:
+            raise f_exc.InvalidState("the reaper is already running")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="filedrop-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, waiting for it to finish."""
+
+        if self._thread is None:
+            raise f_exc.InvalidState("the reaper isn't running")
+
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self._release()
@@ -0,0 +1,279 @@
+"""
+Storage backends for blobs.
+
+A backend decides where a new blob is stored, and does the file operations on the blobs. Blobs are identified by their
+sha256 hash, and the path a blob was stored at is recorded in the database, so it's always read from there, even if the
+backend would put it somewhere else now (e.g. after adding a disk, until the filestore is rebalanced).
+
+Downloads are sent straight from the blob's path (with sendfile), so backends store blobs on local (or mounted)
+filesystems.
+"""
+
+import abc
+import bisect
+import errno
+import hashlib
+import itertools
+import logging
+import os
+import re
+import shutil
+import tempfile
+import typing
+
+import filedrop.lib.exc as f_exc
+
+log = logging.getLogger(__name__)
+
+# folder in each root that the content-addressed blobs are stored in
+BLOBS_DIR = "blobs"
+
+# prefix for in-progress writes in a root
+TEMP_PREFIX = ".upload-"
+
+# points on the hash ring per root, more of them spread the blobs more evenly
+RING_POINTS = 128
+
+# how much is copied at a time when a blob has to be copied to another disk
+COPY_SIZE = 1024 * 1024  # 1mb
+
+# a lowercase hex sha256
+HASH_PAT = re.compile(r"^[0-9a-f]{64}$")
+
+
+def move_file(tmp_path: str, path: str, copy_dir: str | None = None) -> bool:
+    """
+    Atomically move a temp file to a path. The temp file is removed either way. Returns False on failure.
+
+    If the temp file is on another filesystem, it's copied to a temp file in copy_dir (default: the path's folder)
+    first, so the move is still atomic.
+    """
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.replace(tmp_path, path)
+            return True
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+        fd, copy_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=copy_dir or os.path.dirname(path))
+        try:
+            with open(tmp_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+                shutil.copyfileobj(src, dst, COPY_SIZE)
+            os.replace(copy_path, path)
+        except BaseException:
+            os.unlink(copy_path)
+            raise
+
+        os.unlink(tmp_path)
+        return True
+    except OSError as e:
+        log.error("failed to move temp file %s to %s: %s", tmp_path, path, str(e))
+        os.unlink(tmp_path)
+
+    return False
+
+
+class Backend(abc.ABC):
+    """Where the blobs are stored."""
+
+    @property
+    @abc.abstractmethod
+    def roots(self) -> list[str]:
+        """The folders the blobs are stored in."""
+
+    @abc.abstractmethod
+    def locate(self, filehash: str) -> str:
+        """Get the path to store a new blob with the hash at. Raises BadArgs if it isn't a sha256 hash."""
+
+    @abc.abstractmethod
+    def temp_file(self, filehash: str | None = None) -> tuple[int, str]:
+        """
+        Create a temp file to write a new blob to. Returns (fd, path).
+
+        If the hash is already known, the temp file is on the same filesystem as where the blob goes.
+        """
+
+    @abc.abstractmethod
+    def stage(self, tmp_path: str, filehash: str) -> str | None:
+        """
+        Make sure a temp file is on the same filesystem as where the blob with the hash goes, so putting it in place is
+        just a rename. Returns the temp file's (possibly new) path, or None on failure (the temp file is removed).
+        """
+
+    @abc.abstractmethod
+    def put(self, tmp_path: str, path: str) -> bool:
+        """Atomically move a temp file to its final path. The temp file is removed either way. Returns False on failure."""
+
+    def write_temp(self, bytz: bytes, filehash: str | None = None) -> str | None:
+        """Write the bytes to a new temp file (see temp_file()). Returns its path, or None on failure."""
+
+        fd, tmp_path = self.temp_file(filehash)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(bytz)
+        except OSError as e:
+            log.error("failed to write file to %s: %s", tmp_path, str(e))
+            os.unlink(tmp_path)
+            return None
+
+        return tmp_path
+
+    def put_bytes(self, path: str, bytz: bytes, filehash: str | None = None) -> bool:
+        """Atomically write the bytes to the path. Returns False on failure."""
+
+        tmp_path = self.write_temp(bytz, filehash)
+
+        return tmp_path is not None and self.put(tmp_path, path)
+
+    @abc.abstractmethod
+    def open(self, path: str) -> typing.BinaryIO:
+        """Open a blob for reading. Raises OSError if it can't be opened."""
+
+    @abc.abstractmethod
+    def stat(self, path: str) -> int | None:
+        """Get the size of a blob on disk, or None if it can't be read."""
+
+    @abc.abstractmethod
+    def exists(self, path: str) -> bool:
+        """Check if a blob exists."""
+
+    @abc.abstractmethod
+    def delete(self, path: str) -> bool:
+        """Remove a blob (and anything that only existed to hold it). Returns False if it couldn't be removed."""
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} {', '.join(self.roots)}>"
+
+    def __str__(self) -> str:
+        return repr(self)
+
+
+class LocalBackend(Backend):
+    """
+    Blobs stored in one or more folders, e.g. on different disks.
+
+    Each blob goes in one of the roots, picked by consistent hashing on its hash, so adding a root only moves about
+    1/n of the blobs to it (see Filestore.rebalance()). In a root, the blob with hash abcdef123... is stored at
+    blobs/ab/cd/ef/123...
+    """
+
+    def __init__(self, roots: list[str]):
+        if not roots:
+            raise f_exc.BadArgs("a local backend needs at least one root folder")
+
+        self._roots = [r.rstrip("/") for r in roots]
+        if len(set(self._roots)) != len(self._roots):
+            raise f_exc.BadArgs(f"duplicate root folders: {roots}")
+
+        # each root is on the ring many times, at points derived from its path, so the placement doesn't depend on
+        # the order the roots are listed in
+        ring = sorted(
+            (int.from_bytes(hashlib.sha256(f"{r}#{i}".encode()).digest()[:8], "big"), r)
+            for r in self._roots
+            for i in range(RING_POINTS)
+        )
+        self._points = [p for (p, _) in ring]
+        self._ring = [r for (_, r) in ring]
+
+        # temp files with no hash yet are spread over the roots
+        self._next_root = itertools.cycle(self._roots)
+
+    @property
+    def roots(self) -> list[str]:
+        return list(self._roots)
+
+    def _pick_root(self, filehash: str) -> str:
+        if not HASH_PAT.match(filehash):
+            raise f_exc.BadArgs(f"invalid blob hash: {filehash}")
+
+        # sha256 is already uniform, so the start of it is the blob's point on the ring
+        i = bisect.bisect(self._points, int(filehash[:16], 16))
+
+        return self._ring[i % len(self._ring)]
+
+    def _root_of(self, path: str) -> str | None:
+        """Get the root a path is in, if it's in one."""
+
+        for r in self._roots:
+            if path.startswith(r + "/"):
+                return r
+
+        return None
+
+    def locate(self, filehash: str) -> str:
+        root = self._pick_root(filehash)
+
+        p = os.path.join(root, BLOBS_DIR, filehash[0:2], filehash[2:4], filehash[4:6], filehash[6:])
+        if not p.startswith(root):
+            raise f_exc.BadArgs(
+                f"the generated file path didn't start with the root directory, something is wrong! generated: {p}, root: {root}"
+            )
+
+        return p
+
+    def _mkstemp(self, root: str) -> tuple[int, str]:
+        os.makedirs(root, exist_ok=True)
+        return tempfile.mkstemp(prefix=TEMP_PREFIX, dir=root)
+
+    def temp_file(self, filehash: str | None = None) -> tuple[int, str]:
+        return self._mkstemp(self._pick_root(filehash) if filehash is not None else next(self._next_root))
+
+    def stage(self, tmp_path: str, filehash: str) -> str | None:
+        root = self._pick_root(filehash)
+        if self._root_of(tmp_path) == root:
+            return tmp_path
+
+        fd, staged = self._mkstemp(root)
+        os.close(fd)
+        if not move_file(tmp_path, staged, root):
+            os.unlink(staged)
+            return None
+
+        return staged
+
+    def put(self, tmp_path: str, path: str) -> bool:
+        return move_file(tmp_path, path, self._root_of(path))
+
+    def open(self, path: str) -> typing.BinaryIO:
+        return open(path, "rb")  # pylint: disable=consider-using-with
+
+    def stat(self, path: str) -> int | None:
+        try:
+            return os.stat(path).st_size
+        except OSError as e:
+            log.error("failed to stat file %s: %s", path, str(e))
+
+        return None
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def delete(self, path: str) -> bool:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            log.warning("blob %s was already removed", path)
+        except PermissionError:
+            log.error("failed to remove blob %s, permission denied", path)
+            return False
+
+        root = self._root_of(path)
+        if root is not None:
+            self._prune_dirs(root, os.path.dirname(path))
+
+        return True
+
+    def _prune_dirs(self, root: str, path: str):
+        """Remove the directory and its parents (up to the root) for as long as they are empty."""
+
+        while path.startswith(root + "/"):
+            try:
+                os.rmdir(path)
+            except OSError:
+                # not empty (or already gone), so none of the parents are empty either
+                return
+
+            path = os.path.dirname(path)
@@ -57,5 +57,4 @@ CREATE TABLE IF NOT EXISTS `log` (
 
 ---------
 
-INSERT OR IGNORE INTO `migrations` (migration_number) VALUES (0);
 INSERT OR IGNORE INTO `users` (uuid, username, is_anon) VALUES (X'f37c170e59244480a8b42e03c0cb81bb', 'anonymous', TRUE);
\ No newline at end of file
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS `download_claims` (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    token BLOB UNIQUE NOT NULL,
+    file INTEGER NOT NULL,
+
+    FOREIGN KEY(file) REFERENCES files(id)
+);
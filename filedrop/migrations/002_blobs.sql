@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS `blobs` (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    hash TEXT UNIQUE NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS `files_hash` ON `files` (hash, path);
+
+---------
+
+-- track the files that were uploaded before the blob store existed
+INSERT OR IGNORE INTO `blobs` (hash, path, size, refcount) SELECT hash, MIN(path), size, COUNT(*) FROM `files` GROUP BY hash;
@@ -0,0 +1,25 @@
+CREATE TABLE IF NOT EXISTS `upload_sessions` (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    uuid BLOB UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    chunk_size INTEGER NOT NULL,
+    user INTEGER NOT NULL,
+    expiration_time TIMESTAMP,
+    max_downloads INTEGER,
+
+    FOREIGN KEY(user) REFERENCES users(id)
+);
+
+CREATE TABLE IF NOT EXISTS `upload_chunks` (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    session INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+
+    UNIQUE(session, idx),
+    FOREIGN KEY(session) REFERENCES upload_sessions(id)
+);
@@ -0,0 +1,4 @@
+CREATE INDEX IF NOT EXISTS `files_expiration_time` ON `files` (expiration_time) WHERE expiration_time IS NOT NULL;
+CREATE INDEX IF NOT EXISTS `files_exhausted` ON `files` (id) WHERE max_downloads IS NOT NULL AND num_downloads >= max_downloads;
+CREATE INDEX IF NOT EXISTS `download_claims_file` ON `download_claims` (file, created_at);
+CREATE INDEX IF NOT EXISTS `upload_sessions_created_at` ON `upload_sessions` (created_at);
@@ -0,0 +1,3 @@
+ALTER TABLE `files` ADD COLUMN codec TEXT;
+ALTER TABLE `blobs` ADD COLUMN codec TEXT;
+ALTER TABLE `blobs` ADD COLUMN stored_size INTEGER;
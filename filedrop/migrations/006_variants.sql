@@ -0,0 +1,11 @@
+-- compressed copies of blobs, cached for downloads. last_used is a julian day, for sub-second resolution
+CREATE TABLE IF NOT EXISTS `variants` (
+    hash TEXT NOT NULL,
+    encoding TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL DEFAULT (julianday('now')),
+    PRIMARY KEY (hash, encoding)
+);
+
+CREATE INDEX IF NOT EXISTS `variants_last_used` ON `variants` (last_used);
@@ -0,0 +1,2 @@
+-- api keys are looked up by the hmac of the key on every authenticated request
+CREATE UNIQUE INDEX IF NOT EXISTS `apikeys_key` ON `apikeys` (key);
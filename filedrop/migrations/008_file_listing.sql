@@ -0,0 +1,6 @@
+-- covering indexes for listing files (per user, and across users) newest/biggest first, with keyset pagination.
+-- id breaks ties so every row has a unique position, and the listed columns are included so pages don't touch the table
+CREATE INDEX IF NOT EXISTS `files_user_created_at` ON `files` (user, created_at, id, uuid, name, size);
+CREATE INDEX IF NOT EXISTS `files_user_size` ON `files` (user, size, id, uuid, name, created_at);
+CREATE INDEX IF NOT EXISTS `files_created_at` ON `files` (created_at, id, uuid, name, size, user);
+CREATE INDEX IF NOT EXISTS `files_size` ON `files` (size, id, uuid, name, created_at, user);
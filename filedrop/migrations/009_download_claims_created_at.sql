@@ -0,0 +1,2 @@
+-- for pruning the download claims that are too old to be used
+CREATE INDEX IF NOT EXISTS `download_claims_created_at` ON `download_claims` (created_at);
@@ -0,0 +1,2 @@
+-- where the bytes sent with a download claim end, so a claim can only continue a download rather than repeat it
+ALTER TABLE `download_claims` ADD COLUMN served INTEGER NOT NULL DEFAULT 0;
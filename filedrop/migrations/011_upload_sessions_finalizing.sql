@@ -0,0 +1,2 @@
+-- set while an upload is being assembled into a file, so it can only be finalized (or aborted) once
+ALTER TABLE `upload_sessions` ADD COLUMN finalizing INTEGER NOT NULL DEFAULT 0;
@@ -1,16 +1,31 @@
 import atexit
 import logging
+import os
+import shutil
 import sys
 
 from flask import Flask
 
+import filedrop.lib.audit as f_audit
+import filedrop.lib.auth as f_auth
+import filedrop.lib.cache as f_cache
+import filedrop.lib.compression as f_compression
 import filedrop.lib.config as f_config
 import filedrop.lib.database as f_db
 import filedrop.lib.filestore as f_fs
+import filedrop.lib.metrics as f_metrics
+import filedrop.lib.models as f_models
+import filedrop.lib.reaper as f_reaper
+import filedrop.lib.storage as f_storage
 from filedrop.srv.routes import BLUEPRINTS
 
 log = logging.getLogger(__name__)
 
+DEFAULT_ASGI_THREADS = 32
+
+# metrics that come from the same query reuse its result for this long, so it only runs once per scrape
+METRICS_QUERY_TTL = 1  # seconds
+
 CONFIG = f_config.ConfigLoader(
     "filedrop-server",
     [
@@ -18,14 +33,378 @@ CONFIG = f_config.ConfigLoader(
         f_config.ConfigOption(
             "fs.max", "Max file size that can be uploaded (in bytes)", int, default=f_fs.DEFAULT_MAX_SIZE
         ),
+        f_config.ConfigOption(
+            "fs.codec",
+            f"Codec to compress stored files with ({', '.join([f_compression.NO_CODEC] + f_compression.get_codec_names())})",
+            str,
+            default=f_compression.NO_CODEC,
+        ),
+        f_config.ConfigOption(
+            "fs.blobs",
+            "Comma separated folders (e.g. on different disks) to spread the stored files across (default: fs.path)",
+            str,
+        ),
         f_config.ConfigOption("db.path", "Path to store the SQLite database", str, required=True),
+        f_config.ConfigOption(
+            "db.pool", "Max number of SQLite connections per worker process", int, default=f_db.DEFAULT_POOL_SIZE
+        ),
+        f_config.ConfigOption(
+            "db.journal",
+            f"SQLite journal mode ({', '.join(f_db.JOURNAL_MODES)})",
+            str,
+            default=f_db.DEFAULT_JOURNAL_MODE,
+        ),
+        f_config.ConfigOption(
+            "db.synchronous",
+            f"SQLite synchronous level ({', '.join(f_db.SYNCHRONOUS_LEVELS)})",
+            str,
+            default=f_db.DEFAULT_SYNCHRONOUS,
+        ),
+        f_config.ConfigOption(
+            "db.cache.size",
+            "SQLite page cache size per connection (pages if positive, KiB if negative)",
+            int,
+            default=f_db.DEFAULT_CACHE_SIZE,
+        ),
+        f_config.ConfigOption(
+            "db.mmap.size",
+            "Max bytes of the SQLite database to mmap (0 to disable)",
+            int,
+            default=f_db.DEFAULT_MMAP_SIZE,
+        ),
+        f_config.ConfigOption(
+            "db.busy.timeout",
+            "How long to wait for a SQLite lock before failing (in ms)",
+            int,
+            default=f_db.DEFAULT_BUSY_TIMEOUT,
+        ),
+        f_config.ConfigOption(
+            "cache.files.size",
+            "Number of file metadata lookups to cache per worker process (0 to disable)",
+            int,
+            default=f_db.DEFAULT_FILE_CACHE_SIZE,
+        ),
+        f_config.ConfigOption(
+            "cache.files.ttl",
+            "How long to cache file metadata lookups for (in seconds, 0 to disable)",
+            int,
+            default=f_db.DEFAULT_FILE_CACHE_TTL,
+        ),
+        f_config.ConfigOption(
+            "cache.variants.size",
+            "Max total size of the compressed copies of files cached for downloads (in bytes, 0 to disable)",
+            int,
+            default=f_fs.DEFAULT_VARIANT_CACHE_SIZE,
+        ),
+        f_config.ConfigOption(
+            "cache.variants.hits",
+            "How many times a file is compressed for a download before its compressed copy is cached",
+            int,
+            default=f_fs.DEFAULT_VARIANT_MIN_HITS,
+        ),
+        f_config.ConfigOption(
+            "cache.credentials.size",
+            "Number of verified passwords/API keys to cache per worker process (0 to disable)",
+            int,
+            default=f_auth.DEFAULT_CACHE_SIZE,
+        ),
+        f_config.ConfigOption(
+            "cache.credentials.ttl",
+            "How long to cache verified passwords/API keys for (in seconds, 0 to disable)",
+            int,
+            default=f_auth.DEFAULT_CACHE_TTL,
+        ),
+        f_config.ConfigOption(
+            "auth.secret",
+            "Secret key for hashing the stored API keys (changing it invalidates every API key)",
+            str,
+        ),
+        f_config.ConfigOption(
+            "auth.scrypt.n",
+            "scrypt CPU/memory cost for password hashes (a power of 2, existing hashes are upgraded on login)",
+            int,
+            default=f_models.DEFAULT_SCRYPT_PARAMS.n,
+        ),
+        f_config.ConfigOption(
+            "auth.scrypt.r", "scrypt block size for password hashes", int, default=f_models.DEFAULT_SCRYPT_PARAMS.r
+        ),
+        f_config.ConfigOption(
+            "auth.scrypt.p", "scrypt parallelization for password hashes", int, default=f_models.DEFAULT_SCRYPT_PARAMS.p
+        ),
+        f_config.ConfigOption(
+            "auth.hash.workers",
+            "Number of passwords to hash at once per worker process",
+            int,
+            default=f_auth.DEFAULT_HASH_WORKERS,
+        ),
+        f_config.ConfigOption(
+            "auth.hash.queue",
+            "Max number of passwords waiting to be hashed per worker process, past that logins are rejected with a 503",
+            int,
+            default=f_auth.DEFAULT_HASH_QUEUE,
+        ),
+        f_config.ConfigOption("auth.admins", "Comma separated usernames of the users that can use the admin API", str),
+        f_config.ConfigOption(
+            "reaper.interval",
+            "How often to delete expired/used up files in the background (in seconds, 0 to disable). Only one process per database reaps at a time, the others take over if it exits",
+            int,
+            default=f_reaper.DEFAULT_INTERVAL,
+        ),
+        f_config.ConfigOption(
+            "reaper.batch", "Number of files to delete per transaction", int, default=f_reaper.DEFAULT_BATCH_SIZE
+        ),
+        f_config.ConfigOption(
+            "reaper.rate", "Max number of files to delete per second", int, default=f_reaper.DEFAULT_RATE
+        ),
+        f_config.ConfigOption(
+            "audit.queue",
+            "Max number of audit log events waiting to be written per worker process",
+            int,
+            default=f_audit.DEFAULT_QUEUE_SIZE,
+        ),
+        f_config.ConfigOption(
+            "audit.batch",
+            "Number of audit log events to write per transaction",
+            int,
+            default=f_audit.DEFAULT_BATCH_SIZE,
+        ),
+        f_config.ConfigOption(
+            "audit.spill.dir",
+            "Directory to spill audit log events to when they can't be queued or written (dropped if unset)",
+            str,
+        ),
+        f_config.ConfigOption(
+            "metrics.dir",
+            "Directory for the worker processes to share metrics through (should be emptied before starting)",
+            str,
+        ),
+        f_config.ConfigOption(
+            "asgi.threads",
+            "Number of threads to handle requests on in the ASGI mode (db.pool should be about as big)",
+            int,
+            default=DEFAULT_ASGI_THREADS,
+        ),
         f_config.ConfigOption("debug", "Enable debug logging", bool),
     ],
 )
 
 
+def _init_db() -> f_db.Database:
+    """Initialize the database from the config."""
+
+    pragmas = f_db.gen_pragmas(
+        journal_mode=CONFIG.get_value("db.journal"),  # type: ignore
+        synchronous=CONFIG.get_value("db.synchronous"),  # type: ignore
+        cache_size=CONFIG.get_value("db.cache.size"),  # type: ignore
+        mmap_size=CONFIG.get_value("db.mmap.size"),  # type: ignore
+        busy_timeout=CONFIG.get_value("db.busy.timeout"),  # type: ignore
+    )
+    db = f_db.Database(
+        CONFIG.get_value("db.path"),  # type: ignore
+        pool_size=CONFIG.get_value("db.pool"),  # type: ignore
+        pragmas=pragmas,
+        file_cache_size=CONFIG.get_value("cache.files.size"),  # type: ignore
+        file_cache_ttl=CONFIG.get_value("cache.files.ttl"),  # type: ignore
+    )
+    log.info("database settings: %s", db.get_pragmas())
+
+    return db
+
+
+def _init_audit(db: f_db.Database) -> f_audit.AuditLog:
+    """Initialize the audit log from the config."""
+
+    return f_audit.AuditLog(
+        db,
+        queue_size=CONFIG.get_value("audit.queue"),  # type: ignore
+        batch_size=CONFIG.get_value("audit.batch"),  # type: ignore
+        spill_dir=CONFIG.get_value("audit.spill.dir"),  # type: ignore
+    )
+
+
+def _init_auth(db: f_db.Database) -> f_auth.Authenticator:
+    """Initialize the authenticator from the config."""
+
+    return f_auth.Authenticator(
+        db,
+        secret=CONFIG.get_value("auth.secret"),  # type: ignore
+        cache_size=CONFIG.get_value("cache.credentials.size"),  # type: ignore
+        cache_ttl=CONFIG.get_value("cache.credentials.ttl"),  # type: ignore
+        scrypt_params=f_models.ScryptParams(
+            n=CONFIG.get_value("auth.scrypt.n"),  # type: ignore
+            r=CONFIG.get_value("auth.scrypt.r"),  # type: ignore
+            p=CONFIG.get_value("auth.scrypt.p"),  # type: ignore
+        ),
+        hash_workers=CONFIG.get_value("auth.hash.workers"),  # type: ignore
+        hash_queue=CONFIG.get_value("auth.hash.queue"),  # type: ignore
+        admins=[u.strip() for u in (CONFIG.get_value("auth.admins") or "").split(",") if u.strip()],  # type: ignore
+    )
+
+
+def _init_fs(db: f_db.Database, audit: f_audit.AuditLog | None = None) -> f_fs.Filestore:
+    """Initialize the filestore from the config."""
+
+    roots = [p.strip() for p in (CONFIG.get_value("fs.blobs") or "").split(",") if p.strip()]  # type: ignore
+
+    return f_fs.Filestore(
+        db,
+        CONFIG.get_value("fs.path"),  # type: ignore
+        CONFIG.get_value("fs.max"),  # type: ignore
+        codec=CONFIG.get_value("fs.codec"),  # type: ignore
+        variant_cache_size=CONFIG.get_value("cache.variants.size"),  # type: ignore
+        variant_min_hits=CONFIG.get_value("cache.variants.hits"),  # type: ignore
+        audit=audit,
+        backend=f_storage.LocalBackend(roots) if roots else None,
+    )
+
+
+def _init_reaper(fs: f_fs.Filestore, interval: int, lock_path: str | None = None) -> f_reaper.Reaper:
+    """Initialize the reaper from the config."""
+
+    return f_reaper.Reaper(
+        fs,
+        interval=interval,
+        lock_path=lock_path,
+        batch_size=CONFIG.get_value("reaper.batch"),  # type: ignore
+        rate=CONFIG.get_value("reaper.rate"),  # type: ignore
+    )
+
+
+def _init_metrics(db: f_db.Database, fs: f_fs.Filestore, auth: f_auth.Authenticator):
+    """Register the metrics that are computed from the database and filestore when they're collected."""
+
+    def cache_hits() -> dict[f_metrics.LabelsType, float]:
+        return {
+            f_metrics.label_set(cache="files"): db.file_cache.hits,
+            f_metrics.label_set(cache="variants"): fs.variant_hits,
+            f_metrics.label_set(cache="credentials"): auth.cache.hits,
+        }
+
+    def cache_misses() -> dict[f_metrics.LabelsType, float]:
+        return {
+            f_metrics.label_set(cache="files"): db.file_cache.misses,
+            f_metrics.label_set(cache="variants"): fs.variant_misses,
+            f_metrics.label_set(cache="credentials"): auth.cache.misses,
+        }
+
+    def variant_bytes() -> dict[f_metrics.LabelsType, float]:
+        return {f_metrics.label_set(): db.get_variant_usage()[1]}
+
+    # counting the blobs scans the whole table, so it's shared by both of the metrics that need it
+    usage: f_cache.LRUCache[str, tuple[int, int]] = f_cache.LRUCache(1, ttl=METRICS_QUERY_TTL)
+
+    def blob_usage() -> tuple[int, int]:
+        u = usage.get("blobs")
+        if u is None:
+            u = db.get_blob_usage()
+            usage.put("blobs", u)
+
+        return u
+
+    def blobs() -> dict[f_metrics.LabelsType, float]:
+        return {f_metrics.label_set(): blob_usage()[0]}
+
+    def blob_bytes() -> dict[f_metrics.LabelsType, float]:
+        return {f_metrics.label_set(): blob_usage()[1]}
+
+    def disk_bytes() -> dict[f_metrics.LabelsType, float]:
+        # the filestore root is only created on the first upload
+        if not os.path.isdir(fs.root_path):
+            return {}
+
+        du = shutil.disk_usage(fs.root_path)
+        return {f_metrics.label_set(kind="total"): du.total, f_metrics.label_set(kind="free"): du.free}
+
+    def blob_disk_bytes() -> dict[f_metrics.LabelsType, float]:
+        values: dict[f_metrics.LabelsType, float] = {}
+        for path in fs.backend.roots:
+            if not os.path.isdir(path):
+                continue
+
+            du = shutil.disk_usage(path)
+            values[f_metrics.label_set(kind="total", path=path)] = du.total
+            values[f_metrics.label_set(kind="free", path=path)] = du.free
+
+        return values
+
+    f_metrics.REGISTRY.counter_func("filedrop_cache_hits_total", "Lookups served from a cache", cache_hits)
+    f_metrics.REGISTRY.counter_func("filedrop_cache_misses_total", "Lookups that weren't cached", cache_misses)
+    f_metrics.REGISTRY.gauge_func("filedrop_filestore_blobs", "Number of unique files stored", blobs)
+    f_metrics.REGISTRY.gauge_func("filedrop_filestore_blob_bytes", "Total size of the unique files stored", blob_bytes)
+    f_metrics.REGISTRY.gauge_func("filedrop_filestore_disk_bytes", "Size of the filestore filesystem", disk_bytes)
+    f_metrics.REGISTRY.gauge_func(
+        "filedrop_filestore_blob_disk_bytes",
+        "Size of the filesystem of each folder files are stored in",
+        blob_disk_bytes,
+    )
+    f_metrics.REGISTRY.gauge_func(
+        "filedrop_filestore_variant_bytes", "Total size of the cached compressed copies of files", variant_bytes
+    )
+
+
+def reap(argv: list[str]) -> int:
+    """Delete the expired/used up files once, and exit. Returns the process exit code."""
+
+    if not CONFIG.load_config(argv):
+        return 1
+
+    logging.basicConfig(level=logging.DEBUG if CONFIG.get_value("debug") else logging.INFO)
+
+    with _init_db() as db:
+        audit = _init_audit(db)
+        fs = _init_fs(db, audit)
+        _init_reaper(fs, f_reaper.DEFAULT_INTERVAL).run_once()
+        audit.flush()
+
+    return 0
+
+
+def rebalance(argv: list[str]) -> int:
+    """Move the stored files to where they belong after changing fs.blobs, and exit. Returns the process exit code."""
+
+    if not CONFIG.load_config(argv):
+        return 1
+
+    logging.basicConfig(level=logging.DEBUG if CONFIG.get_value("debug") else logging.INFO)
+
+    with _init_db() as db:
+        fs = _init_fs(db)
+        fs.rebalance(grace=CONFIG.get_value("cache.files.ttl"))  # type: ignore
+
+    return 0
+
+
+def start_background(app: Flask):
+    """
+    Start the background threads of an app (writing the audit log, sharing the metrics, and the reaper).
+
+    create_app() does this itself, unless preload is set. Threads don't survive a fork, so a preloaded app has to
+    start them in each worker, after it's forked.
+    """
+
+    # share the metrics between the gunicorn workers
+    if CONFIG.get_value("metrics.dir"):
+        f_metrics.REGISTRY.set_dir(CONFIG.get_value("metrics.dir"))  # type: ignore
+
+    app.config["audit"].start()
+    atexit.register(app.config["audit"].stop)
+
+    # delete expired/used up files in the background. every worker starts a reaper, but they share a lock next to the
+    # database so only one of them runs it at a time (an in-memory database isn't shared, so it doesn't need one)
+    if CONFIG.get_value("reaper.interval"):
+        db_path: str = CONFIG.get_value("db.path")  # type: ignore
+        lock_path = None if db_path == ":memory:" else f"{db_path}.reaper.lock"
+        reaper = _init_reaper(app.config["fs"], CONFIG.get_value("reaper.interval"), lock_path)  # type: ignore
+        reaper.start()
+        atexit.register(reaper.stop)
+
+
 def create_app(
-    testing=False, gunicorn=False, db: f_db.Database | None = None, fs: f_fs.Filestore | None = None
+    testing=False,
+    gunicorn=False,
+    db: f_db.Database | None = None,
+    fs: f_fs.Filestore | None = None,
+    preload=False,
 ) -> Flask:
     """
     Initialize the Flask application.
@@ -33,6 +412,8 @@ def create_app(
     - testing: if True, the config is not loaded and requires a db and fs to be specified
     - gunicorn: if True, argv is ignored when loading the config
     - db | fs: use the provided db or fs objects instead of initializing a new one
+    - preload: if True, the app is being created before forking the processes that serve it (gunicorn --preload). The
+      database is disconnected when it's ready, and start_background() has to be called in each of the processes.
     """
 
     # load the config
@@ -53,16 +434,30 @@ def create_app(
 
     # init the database and filestore
     if db is None:
-        db = f_db.Database(CONFIG.get_value("db.path"))
+        db = _init_db()
 
         def db_cleanup():
             db.close()
 
         atexit.register(db_cleanup)
+
+    # events are only written in the background when running for real, tests flush() it themselves
+    audit = f_audit.AuditLog(db) if testing else _init_audit(db)
+
     if fs is None:
-        fs = f_fs.Filestore(db, CONFIG.get_value("fs.path"), CONFIG.get_value("fs.max"))  # type: ignore
+        fs = _init_fs(db, audit)
 
     app.config["db"] = db
     app.config["fs"] = fs
+    app.config["audit"] = audit
+    app.config["auth"] = f_auth.Authenticator(db) if testing else _init_auth(db)
+
+    _init_metrics(db, fs, app.config["auth"])
+
+    if preload:
+        # the workers open their own connections after they're forked
+        db.disconnect()
+    elif not testing:
+        start_background(app)
 
     return app
@@ -1,5 +1,15 @@
+import sys
+
 import filedrop.srv as f_srv
 
 if __name__ == "__main__":
+    # `python -m filedrop.srv reap [config args]` deletes the expired/used up files once
+    if len(sys.argv) > 1 and sys.argv[1] == "reap":
+        sys.exit(f_srv.reap(sys.argv[2:]))
+
+    # `python -m filedrop.srv rebalance [config args]` moves the stored files after changing fs.blobs
+    if len(sys.argv) > 1 and sys.argv[1] == "rebalance":
+        sys.exit(f_srv.rebalance(sys.argv[2:]))
+
     app = f_srv.create_app()
     app.run(host="localhost", port=5000, debug=bool(f_srv.CONFIG.get_value("debug")))
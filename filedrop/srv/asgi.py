@@ -0,0 +1,255 @@
+"""
+Async (ASGI) serving mode.
+
+The Flask routes are reused as-is, but only the request handling runs on a thread pool. Receiving the request body and
+sending the response body happen on the event loop, with the disk reads/writes done on the pool one chunk at a time,
+so a slow client doesn't hold a thread (or a whole worker process) for the length of its transfer:
+    $ uvicorn --factory filedrop.srv.asgi:create_app
+
+Request bodies are received before the route runs, spooled to a temp file once they're bigger than SPOOL_MAX_MEMORY.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import sys
+import tempfile
+import typing
+
+from flask import Flask
+from werkzeug.wsgi import FileWrapper
+
+import filedrop.lib.database as f_db
+import filedrop.lib.filestore as f_fs
+import filedrop.srv as f_srv
+
+log = logging.getLogger(__name__)
+
+# request bodies bigger than this are spooled to disk instead of kept in memory
+SPOOL_MAX_MEMORY = 1024 * 1024  # 1mb
+
+# room for the multipart framing around a file upload of the max size
+MAX_BODY_OVERHEAD = 1024 * 1024  # 1mb
+
+# how much of a file is read per chunk of a download
+READ_SIZE = f_fs.DEFAULT_CHUNK_SIZE
+
+Scope = dict[str, typing.Any]
+Receive = typing.Callable[[], typing.Awaitable[dict[str, typing.Any]]]
+Send = typing.Callable[[dict[str, typing.Any]], typing.Awaitable[None]]
+
+# returned by next() on the pool once a response body is done
+_DONE = object()
+
+
+class _FileWrapper(FileWrapper):
+    """wsgi.file_wrapper that reads bigger blocks, since every block is a round trip to the thread pool"""
+
+    def __init__(self, file: typing.IO[bytes], buffer_size: int = READ_SIZE):
+        super().__init__(file, max(buffer_size, READ_SIZE))
+
+
+class AsgiApp:
+    """ASGI application wrapping the Flask app. Get one from create_app()."""
+
+    def __init__(self, app: Flask, threads: int = f_srv.DEFAULT_ASGI_THREADS, max_body: int | None = None):
+        self.app = app
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix="filedrop-asgi")
+        self._max_body = max_body
+
+    async def _run(self, fn: typing.Callable[..., typing.Any], *args) -> typing.Any:
+        """Run a blocking function on the thread pool."""
+
+        return await asyncio.get_running_loop().run_in_executor(self._pool, functools.partial(fn, *args))
+
+    def close(self):
+        """Wait for the running requests to finish, and stop the thread pool."""
+
+        self._pool.shutdown(wait=True)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            await self._http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive: Receive, send: Send):
+        while True:
+            msg = await receive()
+            if msg["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif msg["type"] == "lifespan.shutdown":
+                self._pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _watch_disconnect(self, receive: Receive, disconnected: asyncio.Event):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+        disconnected.set()
+
+    async def _error(self, send: Send, code: int, msg: bytes):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": code,
+                "headers": [(b"content-type", b"text/plain"), (b"content-length", str(len(msg)).encode())],
+            }
+        )
+        await send({"type": "http.response.body", "body": msg})
+
+    async def _receive_body(self, receive: Receive) -> tuple[typing.IO[bytes], int] | None:
+        """
+        Receive the whole request body. Returns (body, size), or None if the client disconnected.
+
+        Raises OverflowError if the body is bigger than the max body size.
+        """
+
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)  # pylint: disable=consider-using-with
+        sz = 0
+        try:
+            while True:
+                msg = await receive()
+                if msg["type"] == "http.disconnect":
+                    body.close()
+                    return None
+
+                chunk = msg.get("body", b"")
+                if chunk:
+                    sz += len(chunk)
+                    if self._max_body is not None and sz > self._max_body:
+                        raise OverflowError(f"request body is bigger than {self._max_body} bytes")
+
+                    # once it's big enough to be on disk, don't block the event loop writing to it
+                    if sz > SPOOL_MAX_MEMORY:
+                        await self._run(body.write, chunk)
+                    else:
+                        body.write(chunk)
+
+                if not msg.get("more_body", False):
+                    break
+
+            body.seek(0)
+            return (body, sz)
+        except BaseException:
+            body.close()
+            raise
+
+    def _environ(self, scope: Scope, body: typing.IO[bytes], sz: int) -> dict[str, typing.Any]:
+        """Build the WSGI environ for a request."""
+
+        (server_name, server_port) = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": server_name,
+            "SERVER_PORT": str(server_port),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "CONTENT_LENGTH": str(sz),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": _FileWrapper,
+        }
+
+        for k, v in scope.get("headers", []):
+            name = k.decode("latin-1").upper().replace("-", "_")
+            value = v.decode("latin-1")
+
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif name != "CONTENT_LENGTH":
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        return environ
+
+    def _start(self, environ: dict[str, typing.Any]) -> tuple[typing.Iterable[bytes], str, list[tuple[str, str]]]:
+        """Run the Flask app for a request (on the pool). Returns (response body, status, headers)."""
+
+        started: list[tuple[str, list[tuple[str, str]]]] = []
+
+        def start_response(status: str, headers: list[tuple[str, str]], exc_info=None):
+            if exc_info is not None and started:
+                raise exc_info[1].with_traceback(exc_info[2])
+
+            started[:] = [(status, headers)]
+
+        result = self.app(environ, start_response)
+
+        return (result, started[0][0], started[0][1])
+
+    async def _http(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            r = await self._receive_body(receive)
+        except OverflowError as e:
+            await self._error(send, 413, str(e).encode())
+            return
+
+        if r is None:
+            return
+
+        (body, sz) = r
+        try:
+            (result, status, headers) = await self._run(self._start, self._environ(scope, body, sz))
+        finally:
+            body.close()
+
+        # the server might not fail sends after the client is gone, so watch for it to stop reading the file
+        disconnected = asyncio.Event()
+        watcher = asyncio.create_task(self._watch_disconnect(receive, disconnected))
+
+        it = iter(result)
+        try:
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": int(status.split(" ", 1)[0]),
+                    "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+                }
+            )
+
+            # every chunk is read on the pool, but the event loop waits on the client
+            while not disconnected.is_set():
+                chunk = await self._run(next, it, _DONE)
+                if chunk is _DONE:
+                    await send({"type": "http.response.body", "body": b""})
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            watcher.cancel()
+            if hasattr(result, "close"):
+                await self._run(result.close)
+
+
+def create_app(
+    testing=False, db: f_db.Database | None = None, fs: f_fs.Filestore | None = None, threads: int | None = None
+) -> AsgiApp:
+    """
+    Initialize the ASGI application.
+
+    - testing: if True, the config is not loaded and requires a db and fs to be specified
+    - db | fs: use the provided db or fs objects instead of initializing a new one
+    - threads: size of the thread pool the requests are handled on (default from the config)
+    """
+
+    # argv belongs to the ASGI server, so the config only comes from the environment
+    app = f_srv.create_app(testing=testing, gunicorn=True, db=db, fs=fs)
+
+    if threads is None:
+        threads = typing.cast(int, f_srv.DEFAULT_ASGI_THREADS if testing else f_srv.CONFIG.get_value("asgi.threads"))
+
+    return AsgiApp(app, threads=threads, max_body=app.config["fs"].max_size + MAX_BODY_OVERHEAD)
@@ -0,0 +1,22 @@
+"""
+gunicorn settings for serving filedrop with the app preloaded:
+    $ gunicorn -c python:filedrop.srv.gunicorn_conf -w 4 -b 0.0.0.0:5000
+
+The app is created once in the master process, before the workers are forked. So the config is loaded, the modules
+imported and the database migrated once, instead of in every worker, and the workers share the memory of all of it
+(copy-on-write). Starting (or restarting) a worker is just a fork. Each worker opens its own database connections and
+starts its own background threads once it's forked, except that only one worker at a time runs the reaper.
+"""
+
+# pylint: disable=unused-argument
+
+import filedrop.srv as f_srv
+
+wsgi_app = "filedrop.srv:create_app(gunicorn=True, preload=True)"
+preload_app = True
+
+
+def post_fork(server, worker):
+    """Called in each worker after it's forked from the master."""
+
+    f_srv.start_background(server.app.wsgi())
@@ -1,6 +1,6 @@
 from flask import Blueprint
 
-from filedrop.srv.routes import apiv1, healthcheck
+from filedrop.srv.routes import apiv1, healthcheck, metrics
 
 # define the blueprint->url prefix mapping
-BLUEPRINTS: list[tuple[Blueprint, str]] = [(apiv1.bp, "/api/v1"), (healthcheck.bp, "/")]
+BLUEPRINTS: list[tuple[Blueprint, str]] = [(apiv1.bp, "/api/v1"), (healthcheck.bp, "/"), (metrics.bp, "/")]
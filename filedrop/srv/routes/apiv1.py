@@ -1,15 +1,136 @@
 # pylint: disable=missing-function-docstring
 
-import io
+import base64
+import json
+from datetime import datetime, timedelta
 
-from flask import Blueprint, current_app, send_file
+from flask import Blueprint, Response, current_app, request, send_file
+from werkzeug.exceptions import HTTPException
 
+import filedrop.lib.archive as f_archive
+import filedrop.lib.compression as f_compression
+import filedrop.lib.exc as f_exc
+import filedrop.lib.filestore as f_fs
 import filedrop.lib.models as f_models
+import filedrop.lib.time as f_time
 import filedrop.lib.utils as f_utils
 from filedrop.srv.resps import ApiError, ApiSuccess
 
 bp = Blueprint("apiv1", __name__)
 
+# header used to hand out/resume download claims, so a resumed download isn't counted twice
+DOWNLOAD_CLAIM_HEADER = "X-Filedrop-Download-Claim"
+
+# header with the API key of the user making the request
+API_KEY_HEADER = "X-Filedrop-Key"
+
+# how long to tell clients to wait before retrying when the server is overloaded (in seconds)
+OVERLOADED_RETRY_AFTER = 1
+
+# default number of files in a page of a listing
+DEFAULT_LIST_LIMIT = 100
+
+# max number of files in a single batch request
+MAX_BATCH_SIZE = 1000
+
+# header with the sha256 of an uploaded chunk
+CHUNK_HASH_HEADER = "X-Filedrop-Chunk-Hash"
+
+# conditional responses that don't send the file, so they don't count as a download
+NOT_SENT_STATUSES = (304, 412)
+
+
+def _get_upload_options(vals) -> tuple[datetime | None, int | None]:
+    """Parse the optional expires_in (seconds) and max_downloads upload options. Raises BadArgs on invalid values."""
+
+    expiration_time = None
+    max_downloads = None
+
+    try:
+        if vals.get("expires_in") is not None:
+            expiration_time = f_time.now() + timedelta(seconds=int(vals["expires_in"]))
+
+        if vals.get("max_downloads") is not None:
+            max_downloads = int(vals["max_downloads"])
+    except (TypeError, ValueError) as e:
+        raise f_exc.BadArgs("invalid expires_in or max_downloads value") from e
+
+    return (expiration_time, max_downloads)
+
+
+@bp.errorhandler(f_exc.InvalidUser)
+def invalid_user(e: f_exc.InvalidUser):
+    return ApiError(str(e), code=401)
+
+
+@bp.errorhandler(f_exc.Overloaded)
+def overloaded(e: f_exc.Overloaded):
+    resp = ApiError(str(e), code=503)
+    resp.headers["Retry-After"] = str(OVERLOADED_RETRY_AFTER)
+
+    return resp
+
+
+def _get_auth_user() -> f_models.User | None:
+    """
+    Authenticate the request with an API key (X-Filedrop-Key, or Authorization: Bearer) or a password
+    (Authorization: Basic).
+
+    Returns None if the request has no credentials, and raises InvalidUser (a 401) if they aren't valid.
+    """
+
+    auth = current_app.config["auth"]
+    key = request.headers.get(API_KEY_HEADER)
+    creds = request.authorization
+
+    if key:
+        user = auth.check_api_key(key)
+    elif creds is None:
+        return None
+    elif creds.type == "bearer" and creds.token:
+        user = auth.check_api_key(creds.token)
+    elif creds.type == "basic" and creds.username and creds.password:
+        user = auth.check_password(creds.username, creds.password)
+    else:
+        raise f_exc.InvalidUser(f"unsupported authorization type: {creds.type}")
+
+    if user is None:
+        raise f_exc.InvalidUser("invalid credentials")
+
+    return user
+
+
+def _uploader() -> dict:
+    """Get the uploader arguments for the filestore, for the authenticated user (or an anonymous upload)."""
+
+    user = _get_auth_user()
+    if user is None:
+        return {"anon_upload": True}
+
+    return {"username": user.username}
+
+
+def _audit(action: str, f: f_models.File | None = None, message: str | None = None, username: str | None = None):
+    """Record an event (about a file, or a user) in the audit log."""
+
+    current_app.config["audit"].record(
+        action,
+        username=f.username if f is not None else username,
+        file_uuid=f.uuid if f is not None else None,
+        src_ip=request.remote_addr,
+        message=message,
+    )
+
+
+def _get_upload_session(uuid: str) -> f_models.UploadSession | None:
+    """Look up a chunked upload session by the hex uuid from the url."""
+
+    uuidb = f_utils.unhexstr(uuid)
+    if uuidb is None or len(uuidb) != f_utils.UUID_LENGTH:
+        return None
+
+    return current_app.config["fs"].get_upload_session(uuidb)
+
 
 @bp.get("/file/<uuid>")
 def file_info(uuid: str):
@@ -50,11 +171,488 @@ def file_download(uuid: str):
     if f is None:
         return ApiError("file doesn't exist", uuid=uuid)
 
-    bytz = current_app.config["fs"].get_file_bytes(uuidb)
+    fs = current_app.config["fs"]
 
-    return send_file(io.BytesIO(bytz), as_attachment=True, download_name=f.name)
+    # a download is only counted once. continuing it with a Range request and the claim from the first
+    # response, or just checking the headers, doesn't use up more quota
+    claim = f_utils.unhexstr(request.headers.get(DOWNLOAD_CLAIM_HEADER, ""))
+    resumed = False
+    if claim and request.method != "HEAD":
+        r = _resumed_range(f)
+        resumed = r is not None and fs.continue_download(uuidb, claim, *r)
+    count_download = not resumed and request.method != "HEAD"
+
+    # stream the file from disk, letting the server use sendfile/wsgi.file_wrapper
+    path = fs.get_file_path(f, count_download=count_download)
+    if path is None:
+        _audit("file.download.denied", f)
+        return ApiError("file doesn't exist", uuid=uuid)
+
+    try:
+        resp = _send_file(f, path)
+    except HTTPException:
+        # e.g. an unsatisfiable range
+        if count_download:
+            fs.release_download(f)
+        raise
+    except OSError:
+        # the file was deleted (or went missing) since it was checked
+        resp = None
+
+    # give the download back if the file isn't actually sent
+    if resp is None or resp.status_code in NOT_SENT_STATUSES:
+        if count_download:
+            fs.release_download(f)
+        if resp is None:
+            return ApiError("file doesn't exist", uuid=uuid)
+    elif count_download:
+        # a partial download continues from where it stopped, a whole one from anywhere (it may not all arrive)
+        claim = fs.claim_download(uuidb, resp.content_range.stop if resp.status_code == 206 else 0)
+        _audit("file.download", f, message=resp.headers.get("Content-Encoding"))
+    elif resumed and _sends_end(resp):
+        # the claim was for finishing the download, once the end of the file is sent it's used up
+        fs.release_claim(uuidb, claim)
+        claim = None
+
+    if claim:
+        resp.headers[DOWNLOAD_CLAIM_HEADER] = f_utils.hexstr(claim)
+
+    return resp
+
+
+def _resumed_range(f: f_models.File) -> tuple[int, int | None] | None:
+    """
+    Get the range a request continues a download of the file from: a single Range from a known offset, for the file's
+    etag if it has If-Range. Returns (start, stop), with stop None for the end of the file, or None if it isn't a resume.
+    """
+
+    if request.range is None or len(request.range.ranges) != 1:
+        return None
+
+    etag = request.if_range.etag
+    if etag is None:
+        # a date isn't enough to know it's the same file
+        if request.if_range.date is not None:
+            return None
+    elif etag != f.file_hash and not etag.startswith(f"{f.file_hash}."):
+        # the etag of a compressed representation is the file hash with the encoding after it
+        return None
+
+    start, stop = request.range.ranges[0]
+    if start < 0:
+        # a suffix range (the last n bytes) doesn't say where it starts
+        return None
+
+    return start, stop
+
+
+def _sends_end(resp: Response) -> bool:
+    """Check if a response sends the end of the file (or all of it)."""
+
+    if resp.status_code != 206:
+        return True
+
+    cr = resp.content_range
+    return cr.stop is not None and cr.stop == cr.length
+
+
+def _send_encoded(path_or_file, f: f_models.File, enc: str):
+    """Send a compressed representation of a file."""
+
+    # the encoded bytes are a different representation, so they get their own etag (and ranges are of the encoded bytes)
+    resp = send_file(
+        path_or_file, as_attachment=True, download_name=f.name, conditional=True, etag=f"{f.file_hash}.{enc}"
+    )
+    resp.headers["Content-Encoding"] = enc
+
+    return resp
+
+
+def _send_file(f: f_models.File, path: str):
+    """
+    Send a file in the best representation the client accepts:
+        - a blob stored compressed with a content-coding the client accepts is sent as-is
+        - text-like files are compressed on the fly with a transfer encoding, or sent from a cached compressed copy
+        - otherwise the file is sent uncompressed
+    """
+
+    fs = current_app.config["fs"]
+    codec = f_compression.get_codec(f.codec) if f.codec is not None else None
+    enc = request.accept_encodings.best_match(list(f_compression.TRANSFER_ENCODINGS))
+
+    if (
+        codec is not None
+        and codec.content_encoding is not None
+        and request.accept_encodings[codec.content_encoding] > 0
+    ):
+        resp = _send_encoded(path, f, codec.content_encoding)
+    elif enc is not None and fs.should_encode(f):
+        resp = None
+
+        # the cached copy can be evicted by another worker before it's opened
+        variant = fs.get_variant_path(f, enc)
+        if variant is not None:
+            try:
+                resp = _send_encoded(variant, f, enc)
+            except FileNotFoundError:
+                pass
+
+        # the compressed size isn't known up front, so there's no Range support
+        if resp is None:
+            resp = _send_encoded(fs.open_encoded(f, enc), f, enc)
+    elif codec is None:
+        # the file hash is a strong etag, which lets werkzeug handle Range/If-Range and send 206s
+        resp = send_file(path, as_attachment=True, download_name=f.name, conditional=True, etag=f.file_hash)
+    else:
+        # decompressed as it's sent, so the length is known but ranges can't be seeked to
+        resp = send_file(fs.open_file(f), as_attachment=True, download_name=f.name, conditional=True, etag=f.file_hash)
+        if resp.status_code == 200:
+            resp.content_length = f.size
+
+    resp.vary.add("Accept-Encoding")
+
+    return resp
 
 
 @bp.post("/file/new")
 def file_new():
-    pass
+    upload = request.files.get("file")
+    if upload is None or not upload.filename:
+        return ApiError("no file was uploaded")
+
+    # werkzeug spools large multipart uploads to disk, so this is streamed into the filestore
+    try:
+        (expiration_time, max_downloads) = _get_upload_options(request.form)
+        f: f_models.File | None = current_app.config["fs"].save_stream(
+            upload.filename,
+            upload.stream,
+            **_uploader(),
+            expiration_time=expiration_time,
+            max_downloads=max_downloads,
+            codec=request.form.get("codec"),
+        )
+    except f_exc.FileTooLarge as e:
+        return ApiError(str(e), code=413)
+    except f_exc.BadArgs as e:
+        return ApiError(str(e))
+
+    if f is None:
+        return ApiError("failed to save the file", code=500)
+
+    _audit("file.upload", f)
+
+    return ApiSuccess(uuid=f_utils.hexstr(f.uuid), name=f.name, size=f.size, hash=f.file_hash)
+
+
+def _get_batch_uuids() -> list[bytes]:
+    """Get the list of file UUIDs from the uuids field of a JSON request. Raises BadArgs if it's invalid."""
+
+    j = request.get_json(silent=True)
+    uuids = j.get("uuids") if isinstance(j, dict) else None
+    if not isinstance(uuids, list) or not uuids or not all(isinstance(u, str) for u in uuids):
+        raise f_exc.BadArgs("invalid batch request, expected a list of uuids")
+
+    if len(uuids) > MAX_BATCH_SIZE:
+        raise f_exc.BadArgs(f"too many files in one request, max is {MAX_BATCH_SIZE}")
+
+    uuidbs = [f_utils.unhexstr(u) for u in uuids]
+
+    return [u for u in uuidbs if u is not None and len(u) == f_utils.UUID_LENGTH]
+
+
+@bp.post("/files")
+def files_info():
+    try:
+        uuids = _get_batch_uuids()
+    except f_exc.BadArgs as e:
+        return ApiError(str(e))
+
+    files: dict[bytes, f_models.File] = current_app.config["db"].get_files(uuids)
+
+    return ApiSuccess(files={f_utils.hexstr(u): {"name": f.name, "size": f.size} for u, f in files.items()})
+
+
+def _encode_list_cursor(sort: str, order: str, key: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort, order, *key]).encode()).decode()
+
+
+def _decode_list_cursor(cursor: str, sort: str, order: str) -> tuple:
+    """Get the key from a listing cursor. Raises BadArgs if it's invalid, or for a different sort order."""
+
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor))
+    except ValueError as e:
+        raise f_exc.BadArgs("invalid cursor") from e
+
+    if not isinstance(key, list) or len(key) != 4:
+        raise f_exc.BadArgs("invalid cursor")
+    (csort, corder, value, fid) = key
+
+    if (csort, corder) != (sort, order) or not isinstance(value, (str, int)) or not isinstance(fid, int):
+        raise f_exc.BadArgs("invalid cursor")
+
+    return (value, fid)
+
+
+def _list_files(username: str | None, with_owner: bool = False):
+    """List a page of files, with the sort/order/limit/cursor query args. with_owner adds who uploaded each file."""
+
+    sort = request.args.get("sort", "created")
+    order = request.args.get("order", "desc")
+    if order not in ("asc", "desc"):
+        return ApiError(f"invalid order: {order}")
+
+    try:
+        limit = int(request.args.get("limit", DEFAULT_LIST_LIMIT))
+        cursor = request.args.get("cursor")
+        after = _decode_list_cursor(cursor, sort, order) if cursor else None
+        (files, key) = current_app.config["db"].list_files(
+            username, sort=sort, descending=order == "desc", limit=limit, after=after
+        )
+    except ValueError:
+        return ApiError("invalid limit")
+    except f_exc.BadArgs as e:
+        return ApiError(str(e))
+
+    return ApiSuccess(
+        files=[
+            {
+                "uuid": f_utils.hexstr(f.uuid),
+                "name": f.name,
+                "size": f.size,
+                "uploaded_at": f_time.iso8601(f.uploaded_at),
+                **({"username": f.username} if with_owner else {}),
+            }
+            for f in files
+        ],
+        cursor=_encode_list_cursor(sort, order, key) if key is not None else None,
+    )
+
+
+@bp.get("/files")
+def files_list():
+    user = _get_auth_user()
+    if user is None:
+        return ApiError("authentication required", code=401)
+
+    return _list_files(user.username)
+
+
+@bp.get("/admin/files")
+def admin_files_list():
+    user = _get_auth_user()
+    if user is None:
+        return ApiError("authentication required", code=401)
+
+    if not current_app.config["auth"].is_admin(user):
+        return ApiError("not allowed", code=403)
+
+    return _list_files(request.args.get("user"), with_owner=True)
+
+
+@bp.post("/files/download")
+def files_download():
+    try:
+        uuids = _get_batch_uuids()
+    except f_exc.BadArgs as e:
+        return ApiError(str(e))
+
+    fmt = (request.get_json(silent=True) or {}).get("format", "zip")
+    if fmt not in f_archive.FORMATS:
+        return ApiError(f"unknown archive format: {fmt}")
+
+    # every file has to be downloadable, otherwise none of them count
+    fs = current_app.config["fs"]
+    found: dict[bytes, f_models.File] = current_app.config["db"].get_files(uuids)
+    files: list[f_models.File] = []
+    for u in dict.fromkeys(uuids):
+        f = found.get(u)
+        if f is None or fs.get_file_path(f) is None:
+            for counted in files:
+                fs.release_download(counted)
+            return ApiError("file doesn't exist", uuid=f_utils.hexstr(u))
+        files.append(f)
+
+    for f in files:
+        _audit("file.download", f, message=f"{fmt} archive")
+
+    # archives can't be resumed, so the files that weren't sent when the archive stops early are given back
+    def release(unsent: list[f_models.File]):
+        for f in unsent:
+            fs.release_download(f)
+
+    return Response(
+        f_archive.stream_archive(fs, files, fmt, on_unsent=release),
+        mimetype=f_archive.FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=filedrop.{fmt}"},
+    )
+
+
+@bp.post("/files/new")
+def files_new():
+    uploads = [u for u in request.files.getlist("file") if u.filename]
+    if not uploads:
+        return ApiError("no file was uploaded")
+
+    if len(uploads) > MAX_BATCH_SIZE:
+        return ApiError(f"too many files in one request, max is {MAX_BATCH_SIZE}")
+
+    try:
+        (expiration_time, max_downloads) = _get_upload_options(request.form)
+        files: list[f_models.File] | None = current_app.config["fs"].save_streams(
+            [(u.filename, u.stream) for u in uploads],
+            **_uploader(),
+            expiration_time=expiration_time,
+            max_downloads=max_downloads,
+            codec=request.form.get("codec"),
+        )
+    except f_exc.FileTooLarge as e:
+        return ApiError(str(e), code=413)
+    except f_exc.BadArgs as e:
+        return ApiError(str(e))
+
+    if files is None:
+        return ApiError("failed to save the files", code=500)
+
+    for f in files:
+        _audit("file.upload", f)
+
+    return ApiSuccess(
+        files=[{"uuid": f_utils.hexstr(f.uuid), "name": f.name, "size": f.size, "hash": f.file_hash} for f in files]
+    )
+
+
+@bp.post("/upload")
+def upload_new():
+    j = request.get_json(silent=True)
+    if not isinstance(j, dict):
+        return ApiError("invalid upload request")
+
+    name = j.get("name")
+    size = j.get("size")
+    chunk_size = j.get("chunk_size", f_fs.DEFAULT_UPLOAD_CHUNK_SIZE)
+    if not isinstance(name, str) or not name or not isinstance(size, int) or not isinstance(chunk_size, int):
+        return ApiError("invalid upload request")
+
+    try:
+        (expiration_time, max_downloads) = _get_upload_options(j)
+        s: f_models.UploadSession | None = current_app.config["fs"].new_upload_session(
+            name,
+            size,
+            chunk_size=chunk_size,
+            **_uploader(),
+            expiration_time=expiration_time,
+            max_downloads=max_downloads,
+        )
+    except f_exc.FileTooLarge as e:
+        return ApiError(str(e), code=413)
+    except f_exc.BadArgs as e:
+        return ApiError(str(e))
+
+    if s is None:
+        return ApiError("failed to start the upload", code=500)
+
+    return ApiSuccess(uuid=f_utils.hexstr(s.uuid), chunk_size=s.chunk_size, num_chunks=s.num_chunks)
+
+
+@bp.get("/upload/<uuid>")
+def upload_status(uuid: str):
+    s = _get_upload_session(uuid)
+    if s is None:
+        return ApiError("upload doesn't exist", uuid=uuid)
+
+    return ApiSuccess(
+        name=s.name,
+        size=s.size,
+        chunk_size=s.chunk_size,
+        num_chunks=s.num_chunks,
+        chunks=current_app.config["fs"].get_upload_chunks(s),
+    )
+
+
+@bp.put("/upload/<uuid>/<int:idx>")
+def upload_chunk(uuid: str, idx: int):
+    s = _get_upload_session(uuid)
+    if s is None:
+        return ApiError("upload doesn't exist", uuid=uuid)
+
+    chunk_hash = request.headers.get(CHUNK_HASH_HEADER)
+    if not chunk_hash:
+        return ApiError(f"missing the {CHUNK_HASH_HEADER} header", uuid=uuid)
+
+    try:
+        if not current_app.config["fs"].save_upload_chunk(s, idx, request.stream, chunk_hash):
+            return ApiError("failed to save the chunk", code=500, uuid=uuid)
+    except (f_exc.BadArgs, f_exc.BadChecksum, f_exc.FileTooLarge) as e:
+        return ApiError(str(e), uuid=uuid)
+    except f_exc.InvalidState as e:
+        return ApiError(str(e), code=409, uuid=uuid)
+
+    return ApiSuccess(uuid=uuid, idx=idx)
+
+
+@bp.post("/upload/<uuid>/finalize")
+def upload_finalize(uuid: str):
+    s = _get_upload_session(uuid)
+    if s is None:
+        return ApiError("upload doesn't exist", uuid=uuid)
+
+    fs = current_app.config["fs"]
+
+    # lets the client check the whole upload against the chunk hashes it sent
+    tree_hash = fs.get_upload_tree_hash(s)
+
+    try:
+        f: f_models.File | None = fs.finalize_upload(s)
+    except f_exc.InvalidState as e:
+        return ApiError(str(e), code=409, uuid=uuid)
+
+    if f is None:
+        return ApiError("failed to save the file", code=500, uuid=uuid)
+
+    _audit("file.upload", f, message=f"chunked upload {uuid}")
+
+    return ApiSuccess(uuid=f_utils.hexstr(f.uuid), name=f.name, size=f.size, hash=f.file_hash, tree_hash=tree_hash)
+
+
+@bp.delete("/upload/<uuid>")
+def upload_abort(uuid: str):
+    s = _get_upload_session(uuid)
+    if s is None:
+        return ApiError("upload doesn't exist", uuid=uuid)
+
+    try:
+        current_app.config["fs"].abort_upload(s)
+    except f_exc.InvalidState as e:
+        return ApiError(str(e), code=409, uuid=uuid)
+
+    return ApiSuccess(uuid=uuid)
+
+
+@bp.post("/apikey")
+def apikey_new():
+    user = _get_auth_user()
+    if user is None:
+        return ApiError("authentication required", code=401)
+
+    key = current_app.config["auth"].new_api_key(user.username)
+    if key is None:
+        return ApiError("failed to create the api key", code=500)
+
+    _audit("apikey.new", username=user.username)
+
+    return ApiSuccess(key=key)
+
+
+@bp.delete("/apikey")
+def apikey_delete():
+    user = _get_auth_user()
+    if user is None:
+        return ApiError("authentication required", code=401)
+
+    if not current_app.config["auth"].delete_api_key(user.username):
+        return ApiError("no api key to delete", code=404)
+
+    _audit("apikey.delete", username=user.username)
+
+    return ApiSuccess()
@@ -0,0 +1,104 @@
+# pylint: disable=missing-function-docstring
+
+import threading
+import time
+import typing
+
+from flask import Blueprint, Response, g, request
+
+import filedrop.lib.metrics as f_metrics
+
+bp = Blueprint("metrics", __name__)
+
+REQUEST_SECONDS = f_metrics.REGISTRY.histogram(
+    "filedrop_http_request_seconds", "Time to handle a request, including streaming the response body"
+)
+RECEIVED_BYTES = f_metrics.REGISTRY.counter("filedrop_http_received_bytes_total", "Request body bytes received")
+# files are handed to the server whole (so it can use sendfile), so their Content-Length is counted up front
+SENT_BYTES = f_metrics.REGISTRY.counter(
+    "filedrop_http_sent_bytes_total",
+    "Response body bytes the server was given to send, including the rest of a file the client stopped reading",
+)
+
+
+class _CountingBody:
+    """A response body that counts the bytes sent from it, for responses with no Content-Length (e.g. streamed)."""
+
+    def __init__(self, body: typing.Iterable[bytes], route: str):
+        self._body = body
+        self._route = route
+        self._sent = 0
+        self._closed = False
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        for chunk in self._body:
+            self._sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            if hasattr(self._body, "close"):
+                self._body.close()
+        finally:
+            SENT_BYTES.inc(self._sent, route=self._route)
+
+
+@bp.before_app_request
+def start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request(resp: Response) -> Response:
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return resp
+
+    # the blueprint endpoint (e.g. apiv1.file_download), so the labels don't grow with the urls requested
+    route = request.endpoint or "unmatched"
+    method = request.method
+    status = str(resp.status_code)
+
+    if request.content_length:
+        RECEIVED_BYTES.inc(request.content_length, route=route)
+
+    if method != "HEAD":
+        if resp.content_length is not None:
+            SENT_BYTES.inc(resp.content_length, route=route)
+        else:
+            # the size isn't known up front, so the bytes are counted as the server sends them
+            resp.response = _CountingBody(resp.response, route)
+
+    # downloads are streamed after the view returns, so time until the server is done sending the body
+    observed = threading.Event()
+
+    def observe():
+        if not observed.is_set():
+            observed.set()
+            REQUEST_SECONDS.observe(time.perf_counter() - start, route=route, method=method, status=status)
+
+    resp.call_on_close(observe)
+
+    # werkzeug hands file responses straight to the server (so it can use sendfile), without calling the
+    # close callbacks. hook the file wrapper's close instead, which the server calls once it's sent
+    if resp.direct_passthrough and hasattr(resp.response, "close"):
+        close = resp.response.close
+
+        def close_and_observe():
+            try:
+                close()
+            finally:
+                observe()
+
+        resp.response.close = close_and_observe  # type: ignore
+
+    return resp
+
+
+@bp.get("/metrics")
+def metrics():
+    return Response(f_metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
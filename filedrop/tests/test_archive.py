@@ -0,0 +1,71 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import filedrop.lib.archive as f_archive
+import filedrop.lib.exc as f_exc
+import filedrop.lib.models as f_models
+import filedrop.tests.utils as f_tests
+
+
+class ArchiveTests(f_tests.FiledropTest):
+    def test_entry_names(self):
+        files = [f_models.File.new(n, "/x", 1, "h", "anonymous") for n in ["a.txt", "a.txt", "../b", "..", "a.txt"]]
+        names = f_archive.entry_names(files)
+        self.assertEqual(names[:3], ["a.txt", "a (2).txt", ".._b"])
+        self.assertEqual(len(names[3]), 32)
+        self.assertEqual(names[4], "a (3).txt")
+
+    def test_archives(self):
+        big = os.urandom(3 * f_archive.READ_SIZE + 10)
+        with self.getTestFilestore(codec="gzip") as fs:
+            files = [
+                fs.save_file("big.bin", big, anon_upload=True),
+                fs.save_file("text.txt", b"compressible text " * 1000, anon_upload=True),
+                fs.save_file("text.txt", b"another", anon_upload=True),
+                fs.save_file("empty", b"", anon_upload=True),
+            ]
+            self.assertEqual(files[1].codec, "gzip")  # type: ignore
+            expected = {
+                "big.bin": big,
+                "text.txt": b"compressible text " * 1000,
+                "text (2).txt": b"another",
+                "empty": b"",
+            }
+
+            chunks = list(f_archive.stream_archive(fs, files, "zip"))  # type: ignore
+            self.assertGreater(len(chunks), 3)
+            with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as zf:
+                self.assertIsNone(zf.testzip())
+                self.assertEqual({n: zf.read(n) for n in zf.namelist()}, expected)
+
+            data = b"".join(f_archive.stream_archive(fs, files, "tar"))  # type: ignore
+            self.assertEqual(len(data) % tarfile.RECORDSIZE, 0)
+            with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+                got = {m.name: tf.extractfile(m).read() for m in tf.getmembers()}  # type: ignore
+            self.assertEqual(got, expected)
+
+            with self.assertRaises(f_exc.BadArgs):
+                f_archive.stream_archive(fs, files, "rar")  # type: ignore
+
+            # an archive that's sent all the way through has nothing unsent
+            unsent: list[list[f_models.File]] = []
+            for fmt in f_archive.FORMATS:
+                list(f_archive.stream_archive(fs, files, fmt, on_unsent=unsent.append))  # type: ignore
+            self.assertEqual(unsent, [])
+
+            # but one that's closed part way through has the files it didn't get past
+            for fmt in f_archive.FORMATS:
+                it = f_archive.stream_archive(fs, files, fmt, on_unsent=unsent.append)  # type: ignore
+                next(it)
+                it.close()  # type: ignore
+                self.assertEqual(unsent.pop(), files)
+
+            # a file that's gone fails the archive part way through
+            os.unlink(files[2].path)  # type: ignore
+            with self.assertRaises(OSError):
+                list(f_archive.stream_archive(fs, files, "tar"))  # type: ignore
+            with self.assertRaises(OSError):
+                list(f_archive.stream_archive(fs, files, "zip", on_unsent=unsent.append))  # type: ignore
+            self.assertEqual(unsent.pop(), files[2:])
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+
+from werkzeug.test import EnvironBuilder
+
+import filedrop.lib.utils as f_utils
+import filedrop.srv.asgi as f_asgi
+import filedrop.tests.utils as f_tests
+
+
+class _Client:
+    """Drives an ASGI request, optionally stalling the response like a slow client."""
+
+    def __init__(self, method: str, path: str, headers: dict[str, str] | None = None, body: bytes = b""):
+        self.scope = {
+            "type": "http",
+            "http_version": "1.1",
+            "method": method,
+            "path": path,
+            "query_string": b"",
+            "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        }
+
+        # the body arrives in pieces, like it would from the server
+        self._msgs = [
+            {"type": "http.request", "body": body[i : i + 65536], "more_body": True} for i in range(0, len(body), 65536)
+        ]
+        self._msgs.append({"type": "http.request", "body": b"", "more_body": False})
+
+        self.disconnected = asyncio.Event()
+        self.unstalled = asyncio.Event()
+        self.unstalled.set()
+
+        self.status = 0
+        self.headers: dict[str, str] = {}
+        self.chunks: list[bytes] = []
+
+    async def receive(self):
+        if self._msgs:
+            return self._msgs.pop(0)
+
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, msg):
+        if msg["type"] == "http.response.start":
+            self.status = msg["status"]
+            self.headers = {k.decode(): v.decode() for k, v in msg["headers"]}
+        elif msg.get("body"):
+            self.chunks.append(msg["body"])
+            await self.unstalled.wait()
+
+    @property
+    def body(self) -> bytes:
+        return b"".join(self.chunks)
+
+
+class AsgiTests(f_tests.ServerTest):
+    asgi: f_asgi.AsgiApp
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.asgi = f_asgi.create_app(testing=True, db=cls.db, fs=cls.fs, threads=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.asgi.close()
+        super().tearDownClass()
+
+    def request(self, c: _Client, app: f_asgi.AsgiApp | None = None) -> _Client:
+        asyncio.run((app or self.asgi)(c.scope, c.receive, c.send))
+        return c
+
+    def test_routes(self):
+        c = self.request(_Client("GET", "/healthcheck"))
+        self.assertEqual(c.status, 200)
+        self.assertEqual(json.loads(c.body), {"status": "good"})
+
+        d = os.urandom(3 * f_asgi.READ_SIZE + 10)
+        f = self.fs.save_file("big.bin", d, anon_upload=True)
+        url = f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download"  # type: ignore
+
+        c = self.request(_Client("GET", url))
+        self.assertEqual(c.status, 200)
+        self.assertEqual(c.headers["content-length"], str(len(d)))
+        self.assertEqual(c.body, d)
+        self.assertEqual(len(c.chunks), 4)
+        claim = c.headers["x-filedrop-download-claim"]
+
+        c = self.request(_Client("GET", url, headers={"Range": "bytes=10-19", "X-Filedrop-Download-Claim": claim}))
+        self.assertEqual(c.status, 206)
+        self.assertEqual(c.body, d[10:20])
+
+        c = self.request(_Client("HEAD", url))
+        self.assertEqual(c.status, 200)
+        self.assertEqual(c.body, b"")
+
+        c = self.request(_Client("GET", "/api/v1/file/asdf/download"))
+        self.assertEqual(c.status, 400)
+
+    def test_upload(self):
+        # big enough to be spooled to disk
+        d = os.urandom(f_asgi.SPOOL_MAX_MEMORY + 1000)
+
+        environ = EnvironBuilder(method="POST", data={"file": (io.BytesIO(d), "up.bin")}).get_environ()
+        headers = {"Content-Type": environ["CONTENT_TYPE"]}
+        body = environ["wsgi.input"].read()
+        c = self.request(_Client("POST", "/api/v1/file/new", headers=headers, body=body))
+        self.assertEqual(c.status, 200)
+        self.assertEqual(json.loads(c.body)["data"]["hash"], hashlib.sha256(d).hexdigest())
+
+        # bodies past the max size are rejected as they arrive
+        app = f_asgi.AsgiApp(self.app, threads=1, max_body=100)
+        c = self.request(_Client("POST", "/api/v1/file/new", headers=headers, body=body), app)
+        self.assertEqual(c.status, 413)
+        app.close()
+
+    def test_slow_clients(self):
+        d = os.urandom(3 * f_asgi.READ_SIZE)
+        f = self.fs.save_file("slow.bin", d, anon_upload=True)
+        url = f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download"  # type: ignore
+
+        async def run():
+            # more stalled downloads than threads
+            slow = [_Client("GET", url) for _ in range(4)]
+            for c in slow:
+                c.unstalled.clear()
+            tasks = [asyncio.create_task(self.asgi(c.scope, c.receive, c.send)) for c in slow]
+            while not all(c.chunks for c in slow):
+                await asyncio.sleep(0.01)
+
+            # other requests still get handled
+            c = _Client("GET", "/healthcheck")
+            await asyncio.wait_for(self.asgi(c.scope, c.receive, c.send), 5)
+            self.assertEqual(c.status, 200)
+
+            # a client that goes away stops being sent the file
+            slow[0].disconnected.set()
+            for c in slow:
+                c.unstalled.set()
+            await asyncio.wait_for(asyncio.gather(*tasks), 5)
+
+            self.assertLess(len(slow[0].chunks), 3)
+            for c in slow[1:]:
+                self.assertEqual(c.body, d)
+
+        asyncio.run(run())
@@ -0,0 +1,131 @@
+import os
+import tempfile
+import time
+
+import filedrop.lib.audit as f_audit
+import filedrop.lib.database as f_db
+import filedrop.lib.exc as f_exc
+import filedrop.lib.metrics as f_metrics
+import filedrop.lib.utils as f_utils
+import filedrop.tests.utils as f_tests
+
+
+def _events(result: str) -> float:
+    return f_metrics.REGISTRY.values("filedrop_audit_events_total").get(f_metrics.label_set(result=result), 0)
+
+
+class AuditTests(f_tests.FiledropTest):
+    def test_batching(self):
+        with self.getTestDatabase() as db:
+            audit = f_audit.AuditLog(db, batch_size=3)
+            with self.getTestFilestore(db=db, audit=audit) as fs:
+                f = fs.save_file("audited.txt", b"audit me", anon_upload=True)
+
+                written = _events("written")
+                for i in range(7):
+                    self.assertTrue(
+                        audit.record(
+                            "file.download",
+                            username=f_db.ANONYMOUS_USERNAME,
+                            file_uuid=f.uuid,  # type: ignore
+                            src_ip="127.0.0.1",
+                            message=str(i),
+                        )
+                    )
+
+                # nothing is written until it's flushed
+                self.assertEqual(db.get_audit_events(10), [])
+                self.assertEqual(audit.flush(), 7)
+                self.assertEqual(_events("written") - written, 7)
+
+                events = db.get_audit_events(10)
+                self.assertEqual([e.message for e in events], [str(i) for i in reversed(range(7))])
+                self.assertEqual(events[0].action, "file.download")
+                self.assertEqual(events[0].username, f_db.ANONYMOUS_USERNAME)
+                self.assertEqual(events[0].file_uuid, f.uuid)  # type: ignore
+                self.assertEqual(events[0].src_ip, "127.0.0.1")
+                self.assertIsNotNone(events[0].ts)
+
+                # deleted files are recorded by the filestore
+                self.assertTrue(fs.delete_file(f.uuid))  # type: ignore
+                self.assertEqual(audit.flush(), 1)
+                e = db.get_audit_events(1)[0]
+                self.assertEqual(e.action, "file.delete")
+                self.assertEqual(e.message, f_utils.hexstr(f.uuid))  # type: ignore
+
+            with self.assertRaises(f_exc.BadArgs):
+                f_audit.AuditLog(db, batch_size=0)
+
+    def test_background(self):
+        with self.getTestDatabase() as db:
+            audit = f_audit.AuditLog(db, interval=0.05)
+            audit.start()
+            with self.assertRaises(f_exc.InvalidState):
+                audit.start()
+
+            audit.record("test.one")
+            for _ in range(100):
+                if db.get_audit_events(1):
+                    break
+                time.sleep(0.05)
+            self.assertEqual([e.action for e in db.get_audit_events(10)], ["test.one"])
+
+            # stopping writes whatever is still queued
+            audit.record("test.two")
+            audit.stop()
+            self.assertEqual([e.action for e in db.get_audit_events(10)], ["test.two", "test.one"])
+
+            with self.assertRaises(f_exc.InvalidState):
+                audit.stop()
+
+            # stopping doesn't wait for the interval to be up
+            audit = f_audit.AuditLog(db, interval=60)
+            audit.start()
+            audit.record("test.three")
+            start = time.monotonic()
+            audit.stop()
+            self.assertLess(time.monotonic() - start, 10)
+            self.assertEqual(db.get_audit_events(1)[0].action, "test.three")
+
+    def test_overflow(self):
+        with self.getTestDatabase() as db, tempfile.TemporaryDirectory() as tmpdir:
+            # without a spill dir, events that don't fit are dropped
+            audit = f_audit.AuditLog(db, queue_size=2, block_timeout=0)
+            dropped = _events("dropped")
+            self.assertTrue(audit.record("a"))
+            self.assertTrue(audit.record("b"))
+            self.assertFalse(audit.record("c"))
+            self.assertEqual(_events("dropped") - dropped, 1)
+            self.assertEqual(audit.flush(), 2)
+
+            # with one, they're written to disk
+            audit = f_audit.AuditLog(db, queue_size=1, block_timeout=0.01, spill_dir=tmpdir)
+            spilled = _events("spilled")
+            self.assertTrue(audit.record("d"))
+            self.assertFalse(audit.record("e", file_uuid=b"\x01" * 16, message="spilled"))
+            self.assertFalse(audit.record("f"))
+            self.assertEqual(_events("spilled") - spilled, 2)
+            self.assertTrue(os.path.exists(audit.spill_path))  # type: ignore
+
+            # and so are the ones that fail to be written
+            with self.getTestDatabase() as closed:
+                pass
+            broken = f_audit.AuditLog(closed, spill_dir=tmpdir)
+            broken.record("g")
+            self.assertEqual(broken.flush(), 0)
+            self.assertEqual(_events("spilled") - spilled, 3)
+
+            # spill files are left alone while their process is running
+            self.assertEqual(audit.replay_spilled(), 0)
+
+            # and written once it's gone
+            dead = os.path.join(tmpdir, f"{f_audit.SPILL_PREFIX}999999999{f_audit.SPILL_SUFFIX}")
+            os.rename(audit.spill_path, dead)  # type: ignore
+            self.assertEqual(audit.replay_spilled(), 3)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+            self.assertEqual(audit.flush(), 1)
+            events = db.get_audit_events(10)
+            self.assertEqual([e.action for e in events], ["d", "g", "f", "e", "b", "a"])
+            self.assertEqual(events[3].message, "spilled")
+            self.assertEqual(events[3].file_uuid, None)
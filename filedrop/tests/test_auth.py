@@ -0,0 +1,132 @@
+import threading
+import time
+
+import filedrop.lib.auth as f_auth
+import filedrop.lib.database as f_db
+import filedrop.lib.exc as f_exc
+import filedrop.lib.models as f_models
+import filedrop.tests.utils as f_tests
+
+
+class AuthTests(f_tests.FiledropTest):
+    def test_passwords(self):
+        with self.getTestDatabase() as db:
+            db.add_user(f_models.User.new("user1", "hunter2"))
+            auth = f_auth.Authenticator(db)
+
+            u = auth.check_password("user1", "hunter2")
+            self.assertEqual(u.username, "user1")  # type: ignore
+            self.assertIsNone(auth.check_password("user1", "hunter3"))
+            self.assertIsNone(auth.check_password("nobody", "hunter2"))
+
+            # the anonymous user can't be logged in as
+            self.assertIsNone(auth.check_password("anonymous", "anything"))
+
+            # verified passwords are cached, so scrypt only runs once
+            self.assertEqual(auth.cache.hits, 0)
+            self.assertEqual(auth.check_password("user1", "hunter2"), u)
+            self.assertEqual(auth.cache.hits, 1)
+
+            # changing the password drops the cached one
+            self.assertTrue(auth.update_password(u, "correct horse"))  # type: ignore
+            self.assertIsNone(auth.check_password("user1", "hunter2"))
+            self.assertIsNotNone(auth.check_password("user1", "correct horse"))
+
+            # disabled users can't log in
+            with db.cursor() as c:
+                c.execute("UPDATE users SET enabled = FALSE WHERE username = 'user1';")
+            auth.cache.clear()
+            self.assertIsNone(auth.check_password("user1", "correct horse"))
+
+            # but nothing is cached without a cache
+            auth = f_auth.Authenticator(db, cache_size=0)
+            self.assertIsNone(auth.check_password("user1", "hunter2"))
+            self.assertEqual(len(auth.cache), 0)
+
+            # or with a ttl of 0
+            with db.cursor() as c:
+                c.execute("UPDATE users SET enabled = TRUE WHERE username = 'user1';")
+            auth = f_auth.Authenticator(db, cache_ttl=0)
+            self.assertIsNotNone(auth.check_password("user1", "correct horse"))
+            self.assertEqual(len(auth.cache), 0)
+
+    def test_rehash(self):
+        with self.getTestDatabase() as db:
+            old = f_models.ScryptParams(n=2**10, r=4, p=1)
+            new = f_models.ScryptParams(n=2**11, r=8, p=1)
+            db.add_user(f_models.User.new("user1", "hunter2", params=old))
+            auth = f_auth.Authenticator(db, scrypt_params=new)
+
+            # a wrong password doesn't upgrade the hash
+            self.assertIsNone(auth.check_password("user1", "hunter3"))
+            self.assertEqual(db.get_user("user1").scrypt_params, old)  # type: ignore
+
+            self.assertIsNotNone(auth.check_password("user1", "hunter2"))
+            u = db.get_user("user1")
+            self.assertEqual(u.scrypt_params, new)  # type: ignore
+            self.assertTrue(u.check_password("hunter2"))  # type: ignore
+
+            self.assertEqual(auth.new_user("user2", "asdf").scrypt_params, new)
+
+            with self.assertRaises(f_exc.BadArgs):
+                f_auth.Authenticator(db, scrypt_params=f_models.ScryptParams(n=1000))
+
+    def test_overloaded(self):
+        with self.getTestDatabase() as db:
+            db.add_user(f_models.User.new("user1", "hunter2"))
+            auth = f_auth.Authenticator(db, hash_workers=1, hash_queue=1)
+
+            # tie up the worker and the queue
+            release = threading.Event()
+            busy = [threading.Thread(target=auth._hash, args=(release.wait,)) for _ in range(2)]
+            for t in busy:
+                t.start()
+            while auth._slots._value > 0:  # type: ignore
+                time.sleep(0.01)
+
+            with self.assertRaises(f_exc.Overloaded):
+                auth.check_password("user1", "hunter2")
+
+            release.set()
+            for t in busy:
+                t.join()
+
+            self.assertIsNotNone(auth.check_password("user1", "hunter2"))
+            auth.close()
+
+    def test_api_keys(self):
+        with self.getTestDatabase() as db:
+            db.add_user(f_models.User.new("user1", "hunter2"))
+            auth = f_auth.Authenticator(db, secret="s3cret")
+
+            self.assertIsNone(auth.new_api_key("nobody"))
+
+            key = auth.new_api_key("user1")
+            self.assertTrue(key.startswith(f_auth.API_KEY_PREFIX))  # type: ignore
+            self.assertEqual(auth.check_api_key(key).username, "user1")  # type: ignore
+            self.assertIsNone(auth.check_api_key(key[:-1]))  # type: ignore
+            self.assertIsNone(auth.check_api_key("hunter2"))
+
+            # only the hash is stored, keyed by the secret
+            with db.read_cursor() as c:
+                self.assertEqual(c.execute("SELECT key FROM apikeys;").fetchone()[0], auth.hash_api_key(key))  # type: ignore
+            self.assertIsNone(f_auth.Authenticator(db, secret="other").check_api_key(key))  # type: ignore
+
+            # a new key replaces the old one
+            key2 = auth.new_api_key("user1")
+            self.assertNotEqual(key, key2)
+            self.assertIsNone(auth.check_api_key(key))  # type: ignore
+            self.assertIsNotNone(auth.check_api_key(key2))  # type: ignore
+
+            self.assertTrue(auth.delete_api_key("user1"))
+            self.assertFalse(auth.delete_api_key("user1"))
+            self.assertIsNone(auth.check_api_key(key2))  # type: ignore
+
+    def test_is_admin(self):
+        with self.getTestDatabase() as db:
+            auth = f_auth.Authenticator(db, admins=["user1", f_db.ANONYMOUS_USERNAME])
+
+            self.assertTrue(auth.is_admin(f_models.User.new("user1", "hunter2")))
+            self.assertFalse(auth.is_admin(f_models.User.new("user2", "hunter2")))
+            self.assertFalse(auth.is_admin(db.get_user(f_db.ANONYMOUS_USERNAME)))  # type: ignore
+            self.assertFalse(f_auth.Authenticator(db).is_admin(f_models.User.new("user1", "hunter2")))
@@ -0,0 +1,71 @@
+import time
+
+import filedrop.lib.cache as f_cache
+import filedrop.lib.exc as f_exc
+import filedrop.tests.utils as f_tests
+
+
+class CacheTests(f_tests.FiledropTest):
+    def test_lru(self):
+        c: f_cache.LRUCache[str, int] = f_cache.LRUCache(2)
+
+        c.put("a", 1)
+        c.put("b", 2)
+        self.assertEqual(c.get("a"), 1)
+
+        # b is the least recently used, so it gets evicted
+        c.put("c", 3)
+        self.assertEqual(len(c), 2)
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.get("c"), 3)
+
+        self.assertEqual(c.hits, 3)
+        self.assertEqual(c.misses, 1)
+
+        c.invalidate("a")
+        c.invalidate("zzz")
+        self.assertIsNone(c.get("a"))
+
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+        # a size of 0 disables the cache
+        c = f_cache.LRUCache(0)
+        c.put("a", 1)
+        self.assertIsNone(c.get("a"))
+
+        self.assertRaises(f_exc.BadArgs, f_cache.LRUCache, -1)
+        self.assertRaises(f_exc.BadArgs, f_cache.LRUCache, 5, ttl=-1)
+
+        # and so does a ttl of 0
+        c = f_cache.LRUCache(5, ttl=0)
+        c.put("a", 1)
+        self.assertIsNone(c.get("a"))
+
+    def test_generation(self):
+        c: f_cache.LRUCache[str, int] = f_cache.LRUCache(2)
+
+        # a value looked up before an invalidation isn't cached after it
+        g = c.generation
+        c.invalidate("a")
+        c.put("a", 1, g)
+        self.assertIsNone(c.get("a"))
+
+        g = c.generation
+        c.put("a", 2, g)
+        self.assertEqual(c.get("a"), 2)
+
+        g = c.generation
+        c.clear()
+        c.put("b", 3, g)
+        self.assertIsNone(c.get("b"))
+
+    def test_ttl(self):
+        c: f_cache.LRUCache[str, int] = f_cache.LRUCache(2, ttl=0.1)
+
+        c.put("a", 1)
+        self.assertEqual(c.get("a"), 1)
+        time.sleep(0.2)
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(len(c), 0)
@@ -0,0 +1,90 @@
+import gzip
+import io
+import os
+import tempfile
+import zlib
+
+import filedrop.lib.compression as f_compression
+import filedrop.lib.exc as f_exc
+import filedrop.lib.hashing as f_hashing
+import filedrop.tests.utils as f_tests
+
+
+class CompressionTests(f_tests.FiledropTest):
+    def test_codecs(self):
+        d = b"the quick brown fox jumps over the lazy dog\n" * 10000
+
+        self.assertEqual(sorted(f_compression.get_codec_names()), ["bz2", "gzip", "lzma"])
+        for name in f_compression.get_codec_names():
+            c = f_compression.get_codec(name)
+
+            # compressed in pieces like an upload, and decompressed as a file
+            out = io.BytesIO()
+            self.assertEqual(f_hashing.hash_and_write([d[:1000], d[1000:]], out, compressor=c.compressor())[1], len(d))
+            self.assertLess(len(out.getvalue()), len(d) // 10)
+
+            out.seek(0)
+            with c.open(out) as f:
+                self.assertEqual(f.read(), d)
+
+        self.assertRaises(f_exc.BadArgs, f_compression.get_codec, "asdf")
+        self.assertRaises(f_exc.BadArgs, f_compression.get_codec, f_compression.NO_CODEC)
+
+    def test_register(self):
+        class NamelessCodec(f_compression.GzipCodec):
+            name = f_compression.NO_CODEC
+
+        self.assertRaises(f_exc.BadArgs, f_compression.register_codec, NamelessCodec())
+
+    def test_entropy(self):
+        self.assertEqual(f_compression.entropy(b""), 0.0)
+        self.assertEqual(f_compression.entropy(b"a" * 100), 0.0)
+        self.assertAlmostEqual(f_compression.entropy(bytes(range(256)) * 10), 8.0)
+
+        text = b"hello there. general kenobi!\n" * 1000
+        self.assertTrue(f_compression.is_compressible(text, True))
+        self.assertFalse(f_compression.is_compressible(os.urandom(f_compression.SAMPLE_SIZE), False))
+
+        # tiny files aren't worth it, but the start of a bigger one is
+        self.assertFalse(f_compression.is_compressible(text[:100], True))
+        self.assertTrue(f_compression.is_compressible(text[:100], False))
+
+    def test_transfer_encodings(self):
+        d = b"hello there. general kenobi!\n" * 100000
+
+        r = f_compression.CompressingReader(io.BytesIO(d), f_compression.transfer_compressor("gzip"), read_size=10000)
+        self.assertEqual(gzip.decompress(io.BufferedReader(r).read()), d)  # type: ignore
+
+        r = f_compression.CompressingReader(io.BytesIO(d), f_compression.transfer_compressor("deflate"))
+        self.assertEqual(zlib.decompress(r.read()), d)  # type: ignore
+
+        self.assertRaises(f_exc.BadArgs, f_compression.transfer_compressor, "br")
+
+        for t in ["text/plain", "application/json", "image/svg+xml"]:
+            self.assertTrue(f_compression.is_text_type(t))
+        for t in ["image/png", "application/zip", "application/octet-stream"]:
+            self.assertFalse(f_compression.is_text_type(t))
+
+    def test_copying_reader(self):
+        d = b"hello there. general kenobi!\n" * 100000
+        saved: list[str] = []
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # the copy is saved once the whole file has been read
+            p = os.path.join(tmpdir, "copy")
+            with f_compression.CopyingReader(
+                io.BytesIO(d), f_compression.transfer_compressor("gzip"), open(p, "wb"), p, saved.append
+            ) as r:
+                out = r.read()
+            self.assertEqual(saved, [p])
+            with open(p, "rb") as f:
+                self.assertEqual(f.read(), out)
+
+            # and removed if it's closed before then
+            p = os.path.join(tmpdir, "partial")
+            with f_compression.CopyingReader(
+                io.BytesIO(d), f_compression.transfer_compressor("gzip"), open(p, "wb"), p, saved.append
+            ) as r:
+                r.read(10)
+            self.assertEqual(len(saved), 1)
+            self.assertFalse(os.path.exists(p))
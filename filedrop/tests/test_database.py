@@ -1,10 +1,14 @@
 import os
+import sqlite3
 import tempfile
+import threading
 from datetime import timedelta
 
 import filedrop.lib.database as f_db
+import filedrop.lib.exc as f_exc
 import filedrop.lib.models as f_models
 import filedrop.lib.time as f_time
+import filedrop.lib.utils as f_utils
 import filedrop.tests.utils as f_tests
 
 
@@ -32,6 +36,113 @@ class DatabaseTests(f_tests.FiledropTest):
                     x = c.execute("select count(*) from users where username = 'anonymous' and is_anon = True;")
                     self.assertEqual(x.fetchone()[0], 1)
 
+    def test_migration_runner(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            migrations = os.path.join(tmpdir, "migrations")
+            os.mkdir(migrations)
+            for _, p in f_db.Database.list_migrations():
+                with open(p, encoding="utf-8") as src, open(os.path.join(migrations, os.path.basename(p)), "w") as dst:
+                    dst.write(src.read())
+
+            class TestDatabase(f_db.Database):
+                @classmethod
+                def get_migrations_folder(cls):
+                    return migrations
+
+            def add_migration(name: str, sql: str):
+                with open(os.path.join(migrations, name), "w", encoding="utf-8") as f:
+                    f.write(sql)
+
+            fn = os.path.join(tmpdir, "filedrop.db")
+            with TestDatabase(path=fn) as db:
+                for i in range(5):
+                    db.add_new_file(f_models.File.new(f"f{i}", "/asdf", i, "aaaa", "anonymous"))
+
+            # a migration that can't run twice, and a backfill of the new column in batches of 2
+            add_migration("900_add_column.sql", "ALTER TABLE `files` ADD COLUMN test_col INTEGER;")
+            add_migration(
+                "901_backfill.sql",
+                f"{f_db.BACKFILL_MARKER}\nUPDATE `files` SET test_col = size * 10 WHERE id IN (SELECT id FROM `files` WHERE test_col IS NULL LIMIT 2);",
+            )
+            with TestDatabase(path=fn) as db:
+                with db.read_cursor() as c:
+                    self.assertEqual([r[0] for r in c.execute("SELECT test_col FROM files;")], [0, 10, 20, 30, 40])
+                    self.assertEqual(c.execute("SELECT max(migration_number) FROM migrations;").fetchone()[0], 901)
+
+            # a script that records itself would end a backfill after its first batch, so it isn't run at all
+            add_migration(
+                "902_self_recording.sql",
+                f"{f_db.BACKFILL_MARKER}\nUPDATE `files` SET test_col = NULL WHERE id IN (SELECT id FROM `files` WHERE test_col IS NOT NULL LIMIT 2);\n\nINSERT OR IGNORE INTO `migrations` (migration_number) VALUES (902);",
+            )
+            with self.assertRaises(f_exc.MigrationFailure):
+                TestDatabase(path=fn)
+            os.unlink(os.path.join(migrations, "902_self_recording.sql"))
+            with TestDatabase(path=fn) as db:
+                with db.read_cursor() as c:
+                    self.assertEqual([r[0] for r in c.execute("SELECT test_col FROM files;")], [0, 10, 20, 30, 40])
+                    self.assertEqual(c.execute("SELECT max(migration_number) FROM migrations;").fetchone()[0], 901)
+
+            # a failed migration is rolled back entirely, and isn't recorded
+            add_migration(
+                "902_broken.sql", "CREATE TABLE `test_table` (id INTEGER);\nINSERT INTO `nonexistent` VALUES (1);"
+            )
+            with self.assertRaises(f_exc.MigrationFailure):
+                TestDatabase(path=fn)
+            os.unlink(os.path.join(migrations, "902_broken.sql"))
+
+            # several processes starting at once apply a new migration once
+            add_migration("903_table.sql", "CREATE TABLE `test_table` (id INTEGER);")
+            errors = []
+
+            def open_db():
+                try:
+                    TestDatabase(path=fn).close()
+                except f_exc.FiledropException as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=open_db) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+
+            with TestDatabase(path=fn) as db, db.read_cursor() as c:
+                self.assertEqual(
+                    c.execute("SELECT count(*) FROM migrations WHERE migration_number >= 900;").fetchone()[0], 3
+                )
+
+            add_migration("bad.sql", "")
+            with self.assertRaises(f_exc.MigrationFailure):
+                TestDatabase.list_migrations()
+            os.rename(os.path.join(migrations, "bad.sql"), os.path.join(migrations, "903_dup.sql"))
+            with self.assertRaises(f_exc.MigrationFailure):
+                TestDatabase.list_migrations()
+
+    def test_fork(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.getTestDatabase(path=os.path.join(tmpdir, "filedrop.db")) as db:
+                db.add_user(f_models.User.new("parent", "hunter2"))
+
+                # the connections are reopened when they're needed again
+                db.disconnect()
+                self.assertIsNotNone(db.get_user("parent"))
+
+                # a forked child opens its own connections, and the parent's keep working
+                pid = os.fork()
+                if pid == 0:
+                    ok = False
+                    try:
+                        ok = db.get_user("parent") is not None and db.add_user(f_models.User.new("child", "hunter2"))
+                        db.close()
+                    finally:
+                        os._exit(0 if ok else 1)
+
+                (_, status) = os.waitpid(pid, 0)
+                self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+                self.assertIsNotNone(db.get_user("child"))
+                self.assertTrue(db.add_user(f_models.User.new("parent2", "hunter2")))
+
     def test_users(self):
         with self.getTestDatabase() as db:
             u = db.get_user("anonymous")
@@ -55,6 +166,19 @@ class DatabaseTests(f_tests.FiledropTest):
 
             u3 = db.get_user("hello")
             self.assertNotEqual(u2, u3)
+            self.assertEqual(u2p, u3)
+            self.assertTrue(u3.check_password("asdf"))  # type: ignore
+
+            # api keys are looked up by their hash
+            self.assertTrue(db.set_api_key("hello", b"\x01" * 16, "hash1"))
+            self.assertEqual(db.get_api_key_user("hash1"), u3)
+            self.assertTrue(db.set_api_key("hello", b"\x02" * 16, "hash2"))
+            self.assertIsNone(db.get_api_key_user("hash1"))
+            self.assertEqual(db.get_api_key_user("hash2"), u3)
+            self.assertFalse(db.set_api_key("zzxxxcvc", b"\x03" * 16, "hash3"))
+            self.assertTrue(db.delete_api_key("hello"))
+            self.assertFalse(db.delete_api_key("hello"))
+            self.assertIsNone(db.get_api_key_user("hash2"))
 
             self.assertIsNotNone(db.get_user_id("anonymous"))
             self.assertIsNone(db.get_user_id("zzxxxcvc"))
@@ -85,3 +209,308 @@ class DatabaseTests(f_tests.FiledropTest):
             self.assertTrue(db.inc_download_count(f4.uuid))
             self.assertTrue(db.inc_download_count(f4.uuid))
             self.assertTrue(db.inc_download_count(f4.uuid))
+
+            # a download that didn't happen can be given back
+            self.assertTrue(db.dec_download_count(f3.uuid))
+            self.assertTrue(db.inc_download_count(f3.uuid))
+            self.assertFalse(db.inc_download_count(f3.uuid))
+
+            # expired files aren't counted
+            self.assertFalse(db.inc_download_count(f.uuid, now + timedelta(seconds=1)))
+            self.assertTrue(db.inc_download_count(f.uuid, now - timedelta(seconds=1)))
+            self.assertTrue(db.inc_download_count(f4.uuid, now))
+            self.assertFalse(db.dec_download_count(f_models.File.new("x", "/x", 1, "x", "user1").uuid))
+
+    def test_batch_files(self):
+        with self.getTestDatabase() as db:
+            files = [f_models.File.new(f"f{i}", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "anonymous") for i in range(5)]
+            ts = db.add_new_files([(f, None) for f in files])
+            self.assertEqual(len(ts), 5)  # type: ignore
+            self.assertEqual(db.get_blob("aaaaaaaaaaaaaaaaa").refcount, 5)  # type: ignore
+
+            # a bad file rolls back the whole batch
+            bad = f_models.File.new("bad", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "zzxxxcvc")
+            self.assertIsNone(
+                db.add_new_files([(f_models.File.new("ok", "/asdf", 8, "bbbb", "anonymous"), None), (bad, None)])
+            )
+            self.assertIsNone(db.get_blob("bbbb"))
+
+            # some lookups come from the cache, and the rest from one query
+            self.assertIsNotNone(db.get_file(files[0].uuid))
+            uuids = [f.uuid for f in files] + [b"\x00" * 16]
+            got = db.get_files(uuids + uuids)
+            self.assertEqual(sorted(got), sorted(f.uuid for f in files))
+            for f in files:
+                self.assertEqual(got[f.uuid], f)
+                self.assertIsNotNone(got[f.uuid].uploaded_at)
+            self.assertEqual(db.file_cache.hits, 1)
+
+            # more than fit in one query
+            self.assertEqual(len(db.get_files([f_utils.gen_uuid() for _ in range(f_db.MAX_QUERY_PARAMS + 10)])), 0)
+
+    def test_list_files(self):
+        with self.getTestDatabase() as db:
+            db.add_user(f_models.User.new("user1", "pass2"))
+            mine = [f_models.File.new(f"f{i}", "/asdf", i % 3, "aaaa", "user1") for i in range(7)]
+            db.add_new_files([(f, None) for f in mine])
+            db.add_new_file(f_models.File.new("other", "/asdf", 100, "aaaa", "anonymous"))
+
+            # pages pick up where the last one left off, even with ties in the sort column
+            for sort, expected in [
+                ("created", [f.name for f in reversed(mine)]),
+                ("size", ["f5", "f2", "f4", "f1", "f6", "f3", "f0"]),
+            ]:
+                names = []
+                key = None
+                for _ in range(3):
+                    (files, key) = db.list_files("user1", sort=sort, limit=3, after=key)
+                    names += [f.name for f in files]
+                    if key is None:
+                        break
+                self.assertEqual(names, expected)
+                self.assertIsNone(key)
+
+            (files, key) = db.list_files(None, sort="size", descending=False, limit=10)
+            self.assertEqual([f.size for f in files], [0, 0, 0, 1, 1, 2, 2, 100])
+            self.assertEqual(files[-1].username, "anonymous")
+            self.assertIsNotNone(files[0].uploaded_at)
+            self.assertIsNone(key)
+
+            self.assertEqual(db.list_files("zzxxxcvc"), ([], None))
+            with self.assertRaises(f_exc.BadArgs):
+                db.list_files("user1", sort="name")
+            with self.assertRaises(f_exc.BadArgs):
+                db.list_files("user1", limit=f_db.MAX_LIST_LIMIT + 1)
+
+            # every page is read from a covering index
+            with db.read_cursor() as c:
+                plan = c.execute(
+                    "EXPLAIN QUERY PLAN SELECT files.uuid, name, files.size, files.created_at, files.id FROM files WHERE files.user = 1 AND (files.size, files.id) < (1, 5) ORDER BY files.size DESC, files.id DESC LIMIT 3;"
+                ).fetchall()
+                self.assertIn("COVERING INDEX files_user_size", str(plan))
+
+    def test_download_claims(self):
+        with self.getTestDatabase() as db:
+            f = f_models.File.new("hi", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "anonymous", max_downloads=1)
+            db.add_new_file(f)
+            f2 = f_models.File.new("hi", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "anonymous", max_downloads=1)
+            db.add_new_file(f2)
+
+            self.assertTrue(db.add_download_claim(f.uuid, b"token1"))
+            self.assertFalse(db.add_download_claim(b"\x00" * 16, b"token2"))
+
+            self.assertTrue(db.check_download_claim(f.uuid, b"token1"))
+            self.assertFalse(db.check_download_claim(f2.uuid, b"token1"))
+            self.assertFalse(db.check_download_claim(f.uuid, b"token2"))
+
+            self.assertTrue(db.add_download_claim(f.uuid, b"token3"))
+            self.assertFalse(db.delete_download_claim(f2.uuid, b"token3"))
+            self.assertTrue(db.delete_download_claim(f.uuid, b"token3"))
+            self.assertFalse(db.check_download_claim(f.uuid, b"token3"))
+
+            # ranges sent with a claim have to continue from the last one, and the end of the file uses it up
+            self.assertTrue(db.add_download_claim(f.uuid, b"token4", 10))
+            self.assertFalse(db.continue_download_claim(f.uuid, b"token4", 5, 20))
+            self.assertFalse(db.continue_download_claim(f2.uuid, b"token4", 10, 20))
+            self.assertTrue(db.continue_download_claim(f.uuid, b"token4", 10, 20))
+            self.assertFalse(db.continue_download_claim(f.uuid, b"token4", 15, 30))
+            self.assertTrue(db.continue_download_claim(f.uuid, b"token4", 25, None))
+            self.assertFalse(db.check_download_claim(f.uuid, b"token4"))
+
+            # old claims expire
+            with db.cursor() as c:
+                c.execute("UPDATE download_claims SET created_at = datetime('now', '-2 days');")
+            self.assertFalse(db.check_download_claim(f.uuid, b"token1"))
+            self.assertEqual(db.delete_old_download_claims(10), 1)
+            self.assertEqual(db.delete_old_download_claims(10), 0)
+
+    def test_variant_last_used(self):
+        with self.getTestDatabase() as db:
+            self.assertEqual(db.add_variant("aaaa", "gzip", "/blob.gzip", 10, 1000), [])
+            self.assertIsNone(db.get_variant("aaaa", "br"))
+
+            def last_used() -> float:
+                with db.read_cursor() as c:
+                    return c.execute("SELECT last_used FROM variants;").fetchone()[0]
+
+            # a recent use isn't recorded again, so a hit doesn't need to write
+            with db.cursor() as c:
+                c.execute("UPDATE variants SET last_used = julianday('now') - 1.0 / 86400;")
+            used = last_used()
+            self.assertEqual(db.get_variant("aaaa", "gzip"), "/blob.gzip")
+            self.assertEqual(last_used(), used)
+
+            # but an old one is
+            with db.cursor() as c:
+                c.execute("UPDATE variants SET last_used = julianday('now') - 1;")
+            used = last_used()
+            self.assertEqual(db.get_variant("aaaa", "gzip"), "/blob.gzip")
+            self.assertGreater(last_used(), used + 0.5)
+
+    def test_blobs(self):
+        with self.getTestDatabase() as db:
+            f1 = f_models.File.new("hi", "/blob", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+            f2 = f_models.File.new("hi", "/blob", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+            db.add_new_file(f1)
+            db.add_new_file(f2)
+            self.assertIsNone(db.get_blob("bbbbbbbbbbbbbbbbb"))
+            self.assertEqual(db.get_blob("aaaaaaaaaaaaaaaaa"), f_models.Blob("aaaaaaaaaaaaaaaaa", "/blob", 8, 2))
+
+            # the blob is only orphaned once the last reference is gone
+            self.assertEqual(db.delete_file(f1.uuid), [])
+            self.assertIsNone(db.delete_file(f1.uuid))
+            self.assertIsNone(db.get_file(f1.uuid))
+            self.assertEqual(db.delete_file(f2.uuid), [("aaaaaaaaaaaaaaaaa", "/blob")])
+            self.assertIsNone(db.get_blob("aaaaaaaaaaaaaaaaa"))
+
+            # legacy per-user copies of a blob are cleaned up too
+            f3 = f_models.File.new("hi", "/blob", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+            db.add_new_file(f3)
+            with db.cursor() as c:
+                c.execute(
+                    "INSERT INTO files (uuid, name, size, hash, path, user) VALUES (?, 'hi', 8, 'aaaaaaaaaaaaaaaaa', '/legacy', 1);",
+                    (b"legacy",),
+                )
+                c.execute("UPDATE blobs SET refcount = refcount + 1;")
+            self.assertEqual(db.delete_file(b"legacy"), [("aaaaaaaaaaaaaaaaa", "/legacy")])
+            self.assertEqual(db.delete_file(f3.uuid), [("aaaaaaaaaaaaaaaaa", "/blob")])
+
+            # moving a blob moves the files stored in it
+            f4 = f_models.File.new("hi", "/blob", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+            f5 = f_models.File.new("hi", "/other", 4, "ccccccccccccccccc", "anonymous")
+            db.add_new_file(f4)
+            db.add_new_file(f5)
+            self.assertEqual(db.get_file(f4.uuid).path, "/blob")  # type: ignore
+            self.assertTrue(db.move_blob("aaaaaaaaaaaaaaaaa", "/blob", "/moved"))
+            self.assertFalse(db.move_blob("aaaaaaaaaaaaaaaaa", "/blob", "/moved"))
+            self.assertEqual(db.get_blob("aaaaaaaaaaaaaaaaa").path, "/moved")  # type: ignore
+            self.assertEqual(db.get_file(f4.uuid).path, "/moved")  # type: ignore
+
+            blobs = db.get_blobs(0, 1)
+            self.assertEqual([b.path for (_, b) in blobs], ["/moved"])
+            self.assertEqual([b.path for (_, b) in db.get_blobs(blobs[0][0], 10)], ["/other"])
+            self.assertEqual(db.get_blobs(blobs[0][0] + 1000, 10), [])
+
+    def test_pool(self):
+        # in-memory databases can't be shared between connections
+        with self.getTestDatabase() as db:
+            self.assertEqual(db.pool_size, 1)
+
+        self.assertRaises(f_exc.BadArgs, f_db.Database, pool_size=0)
+        self.assertRaises(f_exc.BadArgs, f_db.Database, pragmas={"cache_size; drop table users": 1})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, "filedrop.db")
+
+            with f_db.Database(path=fn, pool_size=3, pragmas={"cache_size": -1000}) as db:
+                f = f_models.File.new("hi", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+                db.add_new_file(f)
+
+                # hold a cursor open in every thread at once, so they each need their own connection
+                barrier = threading.Barrier(3)
+                results = []
+
+                def reader():
+                    with db.read_cursor() as c:
+                        barrier.wait(timeout=5)
+                        results.append(c.execute("PRAGMA cache_size;").fetchone()[0])
+                    results.append(db.get_file(f.uuid))
+
+                threads = [threading.Thread(target=reader) for _ in range(3)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+
+                self.assertEqual(results.count(-1000), 3)
+                self.assertEqual(results.count(f), 3)
+                self.assertEqual(len(db._conns), 3)
+
+    def test_pragmas(self):
+        self.assertRaises(f_exc.BadArgs, f_db.gen_pragmas, journal_mode="asdf")
+        self.assertRaises(f_exc.BadArgs, f_db.gen_pragmas, synchronous="asdf")
+        self.assertRaises(f_exc.BadArgs, f_db.gen_pragmas, mmap_size=-1)
+        self.assertRaises(f_exc.BadArgs, f_db.gen_pragmas, busy_timeout=-1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fn = os.path.join(tmpdir, "filedrop.db")
+
+            pragmas = f_db.gen_pragmas(synchronous="FULL", cache_size=-4000, mmap_size=1024 * 1024, busy_timeout=1234)
+            with f_db.Database(path=fn, pragmas=pragmas) as db:
+                self.assertEqual(
+                    db.get_pragmas(),
+                    {
+                        "busy_timeout": 1234,
+                        "journal_mode": "wal",
+                        "synchronous": 2,
+                        "cache_size": -4000,
+                        "mmap_size": 1024 * 1024,
+                    },
+                )
+
+            # the journal mode sticks to the database file
+            with f_db.Database(path=fn, pragmas={"synchronous": "off"}) as db:
+                with db.cursor() as c:
+                    self.assertEqual(c.execute("PRAGMA journal_mode;").fetchone()[0], "wal")
+                self.assertEqual(db.get_pragmas(), {"synchronous": 0})
+
+    def test_transactions(self):
+        with self.getTestDatabase() as db:
+            # writes are rolled back if anything in the transaction fails
+            with self.assertRaises(ValueError):
+                with db.cursor() as c:
+                    c.execute("UPDATE users SET enabled = FALSE;")
+                    raise ValueError()
+            self.assertTrue(db.get_anon_user().enabled)
+
+            # a file for a missing user doesn't leave a dangling blob reference behind
+            f = f_models.File.new("hi", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "nobody")
+            self.assertRaises(sqlite3.IntegrityError, db.add_new_file, f)
+            self.assertIsNone(db.get_blob(f.file_hash))
+
+            # reads don't leave a transaction open
+            with db.read_cursor() as c:
+                c.execute("SELECT * FROM files;")
+                self.assertFalse(c.connection.in_transaction)
+
+    def test_file_cache(self):
+        with self.getTestDatabase() as db:
+            f = f_models.File.new("hi", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+            db.add_new_file(f)
+
+            f1 = db.get_file(f.uuid)
+            f2 = db.get_file(f.uuid)
+            self.assertEqual(f1, f)
+            self.assertEqual(f2, f)
+            self.assertEqual((db.file_cache.hits, db.file_cache.misses), (1, 1))
+
+            # changing a returned file doesn't change the cached one
+            f2.name = "changed"
+            self.assertEqual(db.get_file(f.uuid).name, "hi")
+
+            # deleting the file invalidates it
+            db.delete_file(f.uuid)
+            self.assertIsNone(db.get_file(f.uuid))
+
+            # including when it's deleted while another lookup is reading it
+            f = f_models.File.new("hi", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+            db.add_new_file(f)
+            get_file = db._get_file  # pylint: disable=protected-access
+
+            def racing_get_file(uuid: bytes):
+                found = get_file(uuid)
+                db.delete_file(uuid)
+                return found
+
+            db._get_file = racing_get_file  # type: ignore # pylint: disable=protected-access
+            self.assertEqual(db.get_file(f.uuid), f)
+            del db._get_file  # pylint: disable=protected-access
+            self.assertIsNone(db.get_file(f.uuid))
+
+        for kwargs in [{"file_cache_size": 0}, {"file_cache_ttl": 0}]:
+            with f_db.Database(**kwargs) as db:  # type: ignore
+                f = f_models.File.new("hi", "/asdf", 8, "aaaaaaaaaaaaaaaaa", "anonymous")
+                db.add_new_file(f)
+                self.assertEqual(db.get_file(f.uuid), f)
+                self.assertEqual(db.get_file(f.uuid), f)
+                self.assertEqual(db.file_cache.hits, 0, kwargs)
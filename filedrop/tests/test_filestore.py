@@ -1,10 +1,18 @@
+import concurrent.futures
+import gzip
 import hashlib
+import io
 import os
+import tempfile
 import time
 from datetime import datetime
 
+import filedrop.lib.compression as f_compression
 import filedrop.lib.exc as f_exc
+import filedrop.lib.filestore as f_fs
+import filedrop.lib.hashing as f_hashing
 import filedrop.lib.models as f_models
+import filedrop.lib.storage as f_storage
 import filedrop.lib.time as f_time
 import filedrop.tests.utils as f_utils
 
@@ -62,6 +70,75 @@ class FilestoreTests(f_utils.FiledropTest):
                     x = c.execute("SELECT COUNT(*) from FILES;")
                     self.assertEqual(x.fetchone()[0], 0)
 
+    def test_streaming(self):
+        bytz = b"hello there. general kenobi!" * 100
+        fhash = hashlib.sha256(bytz).hexdigest()
+        name = "script.txt"
+
+        with self.getTestDatabase() as db:
+            u1 = f_models.User.new("user1", "hunter2")
+            db.add_user(u1)
+
+            with self.getTestFilestore(db=db) as fs:
+                # file-like objects are read in chunk_size pieces
+                f1 = fs.save_stream(name, io.BytesIO(bytz), username="user1", chunk_size=7)
+                self.assertIsNotNone(f1)
+                self.assertEqual(f1.file_hash, fhash)
+                self.assertEqual(f1.size, len(bytz))
+                self.assertEqual(fs.get_file_bytes(f1.uuid), bytz)
+
+                # iterables of chunks are consumed as-is
+                f2 = fs.save_stream(name, (bytz[i : i + 13] for i in range(0, len(bytz), 13)), anon_upload=True)
+                self.assertIsNotNone(f2)
+                self.assertEqual(f2.file_hash, fhash)
+                self.assertEqual(fs.get_file_bytes(f2.uuid), bytz)
+
+                # no temp files are left behind
+                self.assertFalse(any(x.startswith(f_fs.TEMP_PREFIX) for x in os.listdir(fs.root_path)))
+
+                # make sure the arg validation works before the stream is consumed
+                stream = io.BytesIO(bytz)
+                self.assertRaises(f_exc.BadArgs, fs.save_stream, name, stream)
+                self.assertRaises(f_exc.InvalidUser, fs.save_stream, name, stream, username="user2")
+                self.assertEqual(stream.tell(), 0)
+
+            # make sure the max size is enforced while the stream arrives and nothing hits disk
+            max_size = 8
+            with self.getTestFilestore(db=db, max_size=max_size) as fs:
+                chunks_read = []
+
+                def gen():
+                    for i in range(0, len(bytz), 4):
+                        chunks_read.append(i)
+                        yield bytz[i : i + 4]
+
+                self.assertRaises(f_exc.FileTooLarge, fs.save_stream, name, gen(), anon_upload=True)
+                self.assertEqual(len(chunks_read), 3)
+                self.assertEqual(len(os.listdir(fs.root_path)), 0)
+
+                with db.cursor() as c:
+                    x = c.execute("SELECT COUNT(*) from FILES;")
+                    self.assertEqual(x.fetchone()[0], 2)
+
+    def test_pipelined_save_file(self):
+        # big enough to be hashed while it's written
+        bytz = os.urandom(f_fs.PIPELINE_MIN_SIZE + 12345)
+        fhash = hashlib.sha256(bytz).hexdigest()
+
+        with self.getTestFilestore() as fs:
+            f1 = fs.save_file("big.bin", bytz, anon_upload=True)
+            self.assertIsNotNone(f1)
+            self.assertEqual(f1.file_hash, fhash)
+            self.assertEqual(f1.size, len(bytz))
+            self.assertEqual(fs.get_file_bytes(f1), bytz)
+
+            # still deduplicated, and the temp file is cleaned up
+            f2 = fs.save_file("big2.bin", bytz, anon_upload=True)
+            self.assertEqual(f2.path, f1.path)
+            self.assertFalse(any(x.startswith(f_fs.TEMP_PREFIX) for x in os.listdir(fs.root_path)))
+
+            self.assertRaises(f_exc.BadArgs, fs.save_file, "big.bin", bytz)
+
     def test_getting(self):
         bytz = b"hello there. general kenobi!"
         name = "script.txt"
@@ -93,3 +170,426 @@ class FilestoreTests(f_utils.FiledropTest):
                 # make sure we can bypass the limits if needed
                 self.assertIsNotNone(fs.get_file_bytes(f2.uuid, validate_conditions=False))
                 self.assertIsNotNone(fs.get_file_bytes(f3.uuid, validate_conditions=False))
+
+    def test_getting_path(self):
+        bytz = b"hello there. general kenobi!"
+        name = "script.txt"
+
+        with self.getTestFilestore() as fs:
+            f1 = fs.save_file(name, bytz, anon_upload=True, max_downloads=1)
+            self.assertIsNotNone(f1)
+
+            p = fs.get_file_path(f1.uuid)
+            self.assertEqual(p, f1.path)
+            with open(p, "rb") as f:
+                self.assertEqual(f.read(), bytz)
+
+            # the download count is shared with get_file_bytes
+            self.assertIsNone(fs.get_file_path(f1.uuid))
+            self.assertIsNone(fs.get_file_bytes(f1.uuid))
+            self.assertEqual(fs.get_file_path(f1.uuid, validate_conditions=False), f1.path)
+
+            # make sure a truncated file on disk isn't handed out
+            f2 = fs.save_file("other.txt", b"something else", anon_upload=True)
+            self.assertIsNotNone(f2)
+            with open(f2.path, "wb") as f:
+                f.write(b"short")
+            self.assertIsNone(fs.get_file_path(f2.uuid))
+
+            self.assertIsNone(fs.get_file_path(b"\x00" * 16))
+
+            # an already loaded file can be passed instead of the uuid
+            f3 = fs.save_file("third.txt", bytz, anon_upload=True, max_downloads=1)
+            self.assertIsNotNone(f3)
+            self.assertEqual(fs.get_file_path(f3), f3.path)
+            self.assertIsNone(fs.get_file_bytes(f3))
+
+    def test_download_quota(self):
+        bytz = b"hello there. general kenobi!"
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with self.getTestDatabase(path=os.path.join(tmpdir, "filedrop.db")) as db:
+                with self.getTestFilestore(db=db) as fs:
+                    # concurrent downloads can't go past the quota
+                    f1 = fs.save_file("a.txt", bytz, anon_upload=True, max_downloads=3)
+                    self.assertIsNotNone(f1)
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+                        paths = list(pool.map(lambda _: fs.get_file_path(f1), range(16)))
+                    self.assertEqual(len([p for p in paths if p is not None]), 3)
+
+                    # a download that can't be read is given back
+                    f2 = fs.save_file("b.txt", bytz * 2, anon_upload=True, max_downloads=1)
+                    self.assertIsNotNone(f2)
+                    os.rename(f2.path, f2.path + ".bak")
+                    self.assertIsNone(fs.get_file_bytes(f2))
+                    self.assertIsNone(fs.get_file_path(f2))
+                    os.rename(f2.path + ".bak", f2.path)
+                    self.assertEqual(fs.get_file_bytes(f2), bytz * 2)
+                    self.assertIsNone(fs.get_file_bytes(f2))
+
+                    # and so is one that was released by the caller
+                    self.assertTrue(fs.release_download(f2))
+                    self.assertEqual(fs.get_file_path(f2), f2.path)
+
+    def test_dedup(self):
+        bytz = b"hello there. general kenobi!"
+        name = "script.txt"
+
+        with self.getTestDatabase() as db:
+            u1 = f_models.User.new("user1", "hunter2")
+            db.add_user(u1)
+
+            with self.getTestFilestore(db=db) as fs:
+                f1 = fs.save_file(name, bytz, username="user1")
+                f2 = fs.save_file("other.txt", bytz, anon_upload=True)
+                f3 = fs.save_stream(name, io.BytesIO(bytz), anon_upload=True)
+                self.assertIsNotNone(f1)
+                self.assertIsNotNone(f2)
+                self.assertIsNotNone(f3)
+
+                # every upload shares the same blob
+                self.assertEqual(f1.path, f2.path)
+                self.assertEqual(f1.path, f3.path)
+                self.assertEqual(db.get_blob(f1.file_hash).refcount, 3)
+
+                # the blob stays around until the last reference is deleted
+                self.assertTrue(fs.delete_file(f1.uuid))
+                self.assertFalse(fs.delete_file(f1.uuid))
+                self.assertIsNone(fs.get_file_bytes(f1.uuid))
+                self.assertEqual(fs.get_file_bytes(f2.uuid), bytz)
+
+                self.assertTrue(fs.delete_file(f2.uuid))
+                self.assertEqual(fs.get_file_bytes(f3.uuid), bytz)
+
+                self.assertTrue(fs.delete_file(f3.uuid))
+                self.assertFalse(os.path.exists(f1.path))
+                self.assertIsNone(db.get_blob(f1.file_hash))
+
+                # a blob that went missing from disk gets written again
+                f4 = fs.save_file(name, bytz, anon_upload=True)
+                os.unlink(f4.path)
+                f5 = fs.save_file(name, bytz, anon_upload=True)
+                self.assertEqual(fs.get_file_bytes(f4.uuid), bytz)
+                self.assertEqual(fs.get_file_bytes(f5.uuid), bytz)
+                self.assertEqual(db.get_blob(f1.file_hash).refcount, 2)
+
+    def test_dedup_races(self):
+        bytz = b"hello there. general kenobi!"
+
+        with self.getTestDatabase() as db:
+            with self.getTestFilestore(db=db) as fs:
+                # the last reference is deleted after an upload found the blob, but before it referenced it
+                f1 = fs.save_file("a.txt", bytz, anon_upload=True)
+                found = db.get_blob(f1.file_hash)  # type: ignore
+                self.assertTrue(fs.delete_file(f1.uuid))  # type: ignore
+                self.assertFalse(os.path.exists(f1.path))  # type: ignore
+
+                fs._find_blob = lambda h: found  # type: ignore # pylint: disable=protected-access
+                f2 = fs.save_file("b.txt", bytz, anon_upload=True)
+                f3 = fs.save_stream("c.txt", io.BytesIO(bytz), anon_upload=True)
+                del fs._find_blob  # pylint: disable=protected-access
+                self.assertEqual(fs.get_file_bytes(f2.uuid), bytz)  # type: ignore
+                self.assertEqual(fs.get_file_bytes(f3.uuid), bytz)  # type: ignore
+                self.assertEqual(db.get_blob(f1.file_hash).refcount, 2)  # type: ignore
+
+                # the blob is written again at the same path before the deleted copy is removed
+                for f in (f2, f3):
+                    orphaned = db.delete_file(f.uuid)  # type: ignore
+                f4 = fs.save_file("d.txt", bytz, anon_upload=True)
+                self.assertEqual(orphaned, [(f4.file_hash, f4.path)])  # type: ignore
+                fs._remove_orphans(orphaned)  # type: ignore # pylint: disable=protected-access
+                self.assertEqual(fs.get_file_bytes(f4.uuid), bytz)  # type: ignore
+
+                # no temp files are left behind
+                self.assertEqual([p for p in os.listdir(fs.root_path) if p.startswith(f_fs.TEMP_PREFIX)], [])
+
+    def test_dedup_codecs(self):
+        text = b"hello there. general kenobi!\n" * 1000
+
+        with self.getTestDatabase() as db:
+            with self.getTestFilestore(db=db) as fs:
+                # two first uploads with different codecs: the one recorded second uses the stored blob as it is
+                f1 = fs.save_stream("a.txt", io.BytesIO(text), anon_upload=True, codec="gzip")
+                fs._find_blob = lambda h: None  # type: ignore # pylint: disable=protected-access
+                f2 = fs.save_stream("b.txt", io.BytesIO(text), anon_upload=True, codec=f_compression.NO_CODEC)
+                del fs._find_blob  # pylint: disable=protected-access
+                self.assertEqual(f2.codec, "gzip")  # type: ignore
+                self.assertEqual(db.get_file(f2.uuid).codec, "gzip")  # type: ignore
+                self.assertEqual(fs.get_file_bytes(f2.uuid), text)  # type: ignore
+
+                # a missing blob written again with another codec applies to every file stored in it
+                os.unlink(f1.path)  # type: ignore
+                f3 = fs.save_file("c.txt", text, anon_upload=True, codec=f_compression.NO_CODEC)
+                self.assertIsNone(f3.codec)  # type: ignore
+                self.assertIsNone(db.get_blob(f3.file_hash).codec)  # type: ignore
+                for f in (f1, f2, f3):
+                    self.assertIsNone(db.get_file(f.uuid).codec)  # type: ignore
+                    self.assertEqual(fs.get_file_bytes(f.uuid), text)  # type: ignore
+
+    def test_rebalance(self):
+        with self.getTestDatabase() as db, tempfile.TemporaryDirectory() as tmpdir:
+            roots = [os.path.join(tmpdir, d) for d in ("a", "b", "c")]
+            fs = f_fs.Filestore(db, root_path=tmpdir, backend=f_storage.LocalBackend(roots[:2]))
+            files = [fs.save_file(f"f{i}.txt", f"file {i}".encode(), anon_upload=True) for i in range(30)]
+            for f in files:
+                self.assertEqual(f.path, fs.backend.locate(f.file_hash))  # type: ignore
+
+            # nothing to do until a root is added
+            self.assertEqual(fs.rebalance(), 0)
+
+            fs = f_fs.Filestore(db, root_path=tmpdir, backend=f_storage.LocalBackend(roots))
+            moved = fs.rebalance(batch_size=7)
+            self.assertGreater(moved, 0)
+            self.assertLess(moved, len(files))
+
+            for i, f in enumerate(files):
+                path = fs.backend.locate(f.file_hash)  # type: ignore
+                self.assertEqual(db.get_blob(f.file_hash).path, path)  # type: ignore
+                self.assertEqual(db.get_file(f.uuid).path, path)  # type: ignore
+                self.assertEqual(fs.get_file_bytes(f.uuid), f"file {i}".encode())  # type: ignore
+                if path != f.path:  # type: ignore
+                    self.assertFalse(os.path.exists(f.path))  # type: ignore
+
+            self.assertEqual(fs.rebalance(), 0)
+
+            with self.assertRaises(f_exc.BadArgs):
+                fs.rebalance(batch_size=0)
+
+    def test_save_streams(self):
+        with self.getTestDatabase() as db:
+            with self.getTestFilestore(db=db) as fs:
+                uploads = [(f"f{i}.txt", io.BytesIO(f"file {i}".encode())) for i in range(3)]
+                uploads.append(("dup.txt", io.BytesIO(b"file 0")))
+                files = fs.save_streams(uploads, anon_upload=True, max_downloads=2)
+                self.assertEqual([f.name for f in files], ["f0.txt", "f1.txt", "f2.txt", "dup.txt"])  # type: ignore
+                for f in files:  # type: ignore
+                    self.assertEqual(db.get_file(f.uuid), f)
+                    self.assertIsNotNone(f.uploaded_at)
+                self.assertEqual(fs.get_file_bytes(files[3].uuid), b"file 0")  # type: ignore
+                self.assertEqual(db.get_blob(files[0].file_hash).refcount, 2)  # type: ignore
+
+                # nothing is recorded if one of them is too big
+                with self.getTestFilestore(db=db, max_size=10) as small:
+                    with self.assertRaises(f_exc.FileTooLarge):
+                        small.save_streams([("a", io.BytesIO(b"ok")), ("b", io.BytesIO(b"x" * 11))], anon_upload=True)
+                self.assertEqual(db.get_blob_usage()[0], 3)
+
+    def test_compression(self):
+        text = b"hello there. general kenobi!\n" * 10000
+        rand = os.urandom(100000)
+
+        with self.getTestDatabase() as db:
+            with self.getTestFilestore(db=db, codec="gzip") as fs:
+                self.assertEqual(fs.codec, "gzip")
+
+                # compressible files are stored compressed, however they're uploaded
+                f1 = fs.save_file("a.txt", text[:5000], anon_upload=True)
+                f2 = fs.save_stream("b.txt", io.BytesIO(text), anon_upload=True, chunk_size=1000)
+                for f, d in [(f1, text[:5000]), (f2, text)]:
+                    self.assertEqual(f.codec, "gzip")
+                    self.assertEqual(f.size, len(d))
+                    self.assertEqual(f.file_hash, hashlib.sha256(d).hexdigest())
+                    self.assertLess(os.path.getsize(f.path), len(d) // 10)
+                    self.assertEqual(db.get_file(f.uuid), f)
+                    self.assertEqual(fs.get_file_bytes(f.uuid), d)
+                    self.assertEqual(fs.get_file_path(f.uuid), f.path)
+                    with fs.open_file(f) as fh:
+                        self.assertEqual(fh.read(), d)
+
+                self.assertEqual(db.get_blob(f2.file_hash).stored_size, os.path.getsize(f2.path))
+                self.assertEqual(db.get_blob_usage(), (2, os.path.getsize(f1.path) + os.path.getsize(f2.path)))
+
+                # the tree hash is of the uncompressed contents
+                leaves = [hashlib.sha256(text[i : i + 100000]).hexdigest() for i in range(0, len(text), 100000)]
+                self.assertEqual(fs.get_tree_hash(f2, leaf_size=100000), (f_hashing.tree_root(leaves), leaves))
+
+                # random-looking and tiny files aren't
+                self.assertIsNone(fs.save_file("r.bin", rand, anon_upload=True).codec)
+                self.assertIsNone(fs.save_stream("r2.bin", io.BytesIO(rand[:50000]), anon_upload=True).codec)
+                self.assertIsNone(fs.save_file("t.txt", text[:100], anon_upload=True).codec)
+
+                # the codec can be picked per file
+                f3 = fs.save_file("c.txt", text[:6000], anon_upload=True, codec="lzma")
+                self.assertEqual(f3.codec, "lzma")
+                self.assertEqual(fs.get_file_bytes(f3.uuid), text[:6000])
+                f4 = fs.save_file("d.txt", text[:7000], anon_upload=True, codec=f_compression.NO_CODEC)
+                self.assertIsNone(f4.codec)
+                self.assertRaises(f_exc.BadArgs, fs.save_file, "e.txt", text[:8000], anon_upload=True, codec="asdf")
+
+                # a duplicate uses the stored blob as-is
+                f5 = fs.save_stream("f.txt", io.BytesIO(text), anon_upload=True, codec=f_compression.NO_CODEC)
+                self.assertEqual((f5.path, f5.codec), (f2.path, "gzip"))
+                f6 = fs.save_file("g.txt", text[:7000], anon_upload=True, codec="bz2")
+                self.assertEqual((f6.path, f6.codec), (f4.path, None))
+
+                # corrupt blobs can't be read
+                with open(f1.path, "r+b") as fh:
+                    fh.seek(20)
+                    fh.write(b"\xff" * 20)
+                self.assertIsNone(fs.get_file_bytes(f1.uuid))
+
+        self.assertRaises(f_exc.BadArgs, f_fs.Filestore, None, "/tmp", codec="asdf")
+
+    def test_variants(self):
+        text = b"hello there. general kenobi!\n" * 10000
+
+        with self.getTestDatabase() as db:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fs = f_fs.Filestore(db, tmpdir, variant_cache_size=1000, variant_min_hits=2)
+
+                def should_encode(name: str, d: bytes, codec: str | None = None) -> bool:
+                    return fs.should_encode(fs.save_file(name, d, anon_upload=True, codec=codec))  # type: ignore
+
+                # text (by name or by contents) is, anything else isn't
+                self.assertTrue(should_encode("a.txt", text[:2000]))
+                self.assertTrue(should_encode("b.dat", text[:3000]))
+                self.assertFalse(should_encode("c.txt", text[:100]))
+                self.assertFalse(should_encode("d.png", text[:5000]))
+                self.assertFalse(should_encode("e.dat", os.urandom(5000)))
+                self.assertFalse(should_encode("f.txt", text[:6000], codec="gzip"))
+
+                f1: f_models.File = fs.save_file("a.txt", text, anon_upload=True)  # type: ignore
+                f2: f_models.File = fs.save_file("b.dat", text.upper(), anon_upload=True)  # type: ignore
+
+                # the compressed copy is only cached once the file is popular, and read all the way through
+                for _ in range(2):
+                    self.assertIsNone(fs.get_variant_path(f1, "gzip"))
+                    with fs.open_encoded(f1, "gzip") as f:
+                        f.read(10)
+                self.assertIsNone(fs.get_variant_path(f1, "gzip"))
+                with fs.open_encoded(f1, "gzip") as f:
+                    gz = f.read()
+                self.assertEqual(gzip.decompress(gz), text)
+
+                p1 = f1.path + ".gzip"
+                self.assertEqual(fs.get_variant_path(f1, "gzip"), p1)
+                with open(p1, "rb") as f:
+                    self.assertEqual(f.read(), gz)
+                self.assertEqual((fs.variant_hits, fs.variant_misses), (1, 3))
+                self.assertEqual(db.get_variant_usage(), (1, len(gz)))
+
+                # past the cache size, the least recently used copy is evicted
+                for _ in range(2):
+                    with fs.open_encoded(f2, "deflate") as f:
+                        f.read()
+                p2 = f2.path + ".deflate"
+                self.assertEqual(fs.get_variant_path(f2, "deflate"), p2)
+                self.assertIsNone(fs.get_variant_path(f1, "gzip"))
+                self.assertFalse(os.path.exists(p1))
+
+                # and copies are removed along with their blob
+                self.assertTrue(fs.delete_file(f2.uuid))
+                self.assertFalse(os.path.exists(p2))
+                self.assertEqual(db.get_variant_usage(), (0, 0))
+
+                # nothing is left behind in the filestore root
+                self.assertEqual([x for x in os.listdir(tmpdir) if x.startswith(f_fs.TEMP_PREFIX)], [])
+
+        self.assertRaises(f_exc.BadArgs, f_fs.Filestore, None, "/tmp", variant_cache_size=-1)
+        self.assertRaises(f_exc.BadArgs, f_fs.Filestore, None, "/tmp", variant_min_hits=0)
+
+    def test_upload_sessions(self):
+        bytz = b"hello there. general kenobi!"
+
+        with self.getTestFilestore() as fs:
+            s = fs.new_upload_session("chunky.txt", len(bytz), chunk_size=10, anon_upload=True, max_downloads=3)
+            self.assertEqual(s.num_chunks, 3)
+            self.assertEqual([s.chunk_length(i) for i in range(3)], [10, 10, 8])
+            self.assertEqual(fs.get_upload_session(s.uuid), s)
+
+            for idx in [1, 2]:
+                chunk = bytz[idx * 10 : (idx + 1) * 10]
+                self.assertTrue(fs.save_upload_chunk(s, idx, io.BytesIO(chunk), hashlib.sha256(chunk).hexdigest()))
+            self.assertEqual(fs.get_upload_chunks(s), [1, 2])
+            self.assertRaises(f_exc.InvalidState, fs.finalize_upload, s)
+            self.assertIsNone(fs.get_upload_tree_hash(s))
+
+            # make sure the chunk validation works
+            chunk = bytz[:10]
+            self.assertRaises(f_exc.BadChecksum, fs.save_upload_chunk, s, 0, io.BytesIO(chunk), "00" * 32)
+            self.assertRaises(
+                f_exc.BadArgs, fs.save_upload_chunk, s, 0, io.BytesIO(chunk[:5]), hashlib.sha256(chunk[:5]).hexdigest()
+            )
+            self.assertRaises(
+                f_exc.FileTooLarge, fs.save_upload_chunk, s, 0, io.BytesIO(bytz), hashlib.sha256(bytz).hexdigest()
+            )
+            self.assertRaises(
+                f_exc.BadArgs, fs.save_upload_chunk, s, 3, io.BytesIO(chunk), hashlib.sha256(chunk).hexdigest()
+            )
+            self.assertEqual(fs.get_upload_chunks(s), [1, 2])
+
+            self.assertTrue(fs.save_upload_chunk(s, 0, io.BytesIO(chunk), hashlib.sha256(chunk).hexdigest()))
+            leaves = [hashlib.sha256(bytz[i : i + 10]).digest() for i in range(0, len(bytz), 10)]
+            tree_hash = hashlib.sha256(b"".join(leaves)).hexdigest()
+            self.assertEqual(fs.get_upload_tree_hash(s), tree_hash)
+
+            f = fs.finalize_upload(s)
+            self.assertIsNotNone(f)
+            self.assertEqual(f.max_downloads, 3)
+            self.assertEqual(fs.get_file_bytes(f.uuid), bytz)
+
+            # the stored file has the same tree hash, with the chunk size as the leaf size
+            self.assertEqual(fs.get_tree_hash(f, leaf_size=10), (tree_hash, [x.hex() for x in leaves]))
+            self.assertRaises(f_exc.BadArgs, fs.get_tree_hash, f, leaf_size=0)
+            self.assertIsNone(fs.get_tree_hash(b"\x00" * 16))
+
+            # the session and its chunks are cleaned up
+            self.assertIsNone(fs.get_upload_session(s.uuid))
+            self.assertEqual(os.listdir(os.path.join(fs.root_path, f_fs.UPLOADS_DIR)), [])
+
+            # empty files are a single empty chunk
+            s = fs.new_upload_session("empty.txt", 0, anon_upload=True)
+            self.assertEqual(s.num_chunks, 1)
+            self.assertTrue(fs.save_upload_chunk(s, 0, io.BytesIO(b""), hashlib.sha256(b"").hexdigest()))
+            self.assertEqual(fs.get_file_bytes(fs.finalize_upload(s).uuid), b"")
+
+            # aborting removes the chunks
+            s = fs.new_upload_session("chunky.txt", len(bytz), chunk_size=10, anon_upload=True)
+            self.assertTrue(fs.save_upload_chunk(s, 0, io.BytesIO(chunk), hashlib.sha256(chunk).hexdigest()))
+            self.assertTrue(fs.abort_upload(s))
+            self.assertIsNone(fs.get_upload_session(s.uuid))
+            self.assertEqual(os.listdir(os.path.join(fs.root_path, f_fs.UPLOADS_DIR)), [])
+
+            # and a chunk that arrives after that doesn't stay behind
+            self.assertFalse(fs.save_upload_chunk(s, 1, io.BytesIO(chunk), hashlib.sha256(chunk).hexdigest()))
+            self.assertEqual(os.listdir(os.path.join(fs.root_path, f_fs.UPLOADS_DIR)), [])
+
+    def test_upload_finalize_once(self):
+        bytz = b"hello there. general kenobi!"
+
+        with self.getTestDatabase() as db, self.getTestFilestore(db=db) as fs:
+            s = fs.new_upload_session("chunky.txt", len(bytz), chunk_size=10, anon_upload=True)
+            for idx in range(3):
+                chunk = bytz[idx * 10 : (idx + 1) * 10]
+                self.assertTrue(fs.save_upload_chunk(s, idx, io.BytesIO(chunk), hashlib.sha256(chunk).hexdigest()))
+
+            # while another request is finalizing the upload, it can't be finalized again, aborted or changed
+            self.assertTrue(db.set_upload_finalizing(s.uuid, True))
+            self.assertRaises(f_exc.InvalidState, fs.finalize_upload, s)
+            self.assertRaises(f_exc.InvalidState, fs.abort_upload, s)
+            other = b"0123456789"
+            self.assertRaises(
+                f_exc.InvalidState, fs.save_upload_chunk, s, 0, io.BytesIO(other), hashlib.sha256(other).hexdigest()
+            )
+            self.assertTrue(db.set_upload_finalizing(s.uuid, False))
+
+            # the chunk that was rejected isn't the one that's used
+            f = fs.finalize_upload(s)
+            self.assertIsNotNone(f)
+            self.assertEqual(fs.get_file_bytes(f.uuid), bytz)  # type: ignore
+            self.assertRaises(f_exc.InvalidState, fs.finalize_upload, s)
+            with db.read_cursor() as c:
+                self.assertEqual(c.execute("SELECT COUNT(*) FROM files;").fetchone()[0], 1)
+            self.assertEqual(os.listdir(os.path.join(fs.root_path, f_fs.UPLOADS_DIR)), [])
+
+            # a failed finalize can be retried
+            s = fs.new_upload_session("chunky.txt", len(bytz), chunk_size=10, anon_upload=True)
+            self.assertRaises(f_exc.InvalidState, fs.finalize_upload, s)
+            for idx in range(3):
+                chunk = bytz[idx * 10 : (idx + 1) * 10]
+                self.assertTrue(fs.save_upload_chunk(s, idx, io.BytesIO(chunk), hashlib.sha256(chunk).hexdigest()))
+            self.assertIsNotNone(fs.finalize_upload(s))
+
+        with self.getTestFilestore(max_size=8) as fs:
+            self.assertRaises(f_exc.FileTooLarge, fs.new_upload_session, "big.txt", 9, anon_upload=True)
+            self.assertRaises(f_exc.BadArgs, fs.new_upload_session, "big.txt", 8, chunk_size=0, anon_upload=True)
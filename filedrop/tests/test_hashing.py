@@ -0,0 +1,65 @@
+import hashlib
+import io
+import os
+import tempfile
+
+import filedrop.lib.hashing as f_hashing
+import filedrop.tests.utils as f_tests
+
+
+class HashingTests(f_tests.FiledropTest):
+    def test_hash_and_write(self):
+        chunks = [os.urandom(1000) for _ in range(50)]
+        d = b"".join(chunks)
+
+        out = io.BytesIO()
+        self.assertEqual(f_hashing.hash_and_write(chunks, out, depth=2), (hashlib.sha256(d).hexdigest(), len(d)))
+        self.assertEqual(out.getvalue(), d)
+
+        # no threads for zero/one chunk
+        cases: list[list[bytes]] = [[], [b"abc"]]
+        for c in cases:
+            out = io.BytesIO()
+            self.assertEqual(
+                f_hashing.hash_and_write(c, out), (hashlib.sha256(b"".join(c)).hexdigest(), len(out.getvalue()))
+            )
+
+    def test_pipeline_errors(self):
+        # errors from the reader stop the pipeline and are raised
+        def reader():
+            yield b"a" * 100
+            yield b"b" * 100
+            raise ValueError("upload broke")
+
+        self.assertRaises(ValueError, f_hashing.hash_and_write, reader(), io.BytesIO())
+
+        # and so are errors from the writer
+        class BadWriter(io.BytesIO):
+            def write(self, b):
+                raise OSError("disk full")
+
+        self.assertRaises(OSError, f_hashing.hash_and_write, [b"x" * 100] * 20, BadWriter())
+
+    def test_tree_hash(self):
+        d = os.urandom(10000)
+        leaf_size = 4096
+        leaves = [hashlib.sha256(d[i : i + leaf_size]).hexdigest() for i in range(0, len(d), leaf_size)]
+        root = hashlib.sha256(b"".join(bytes.fromhex(x) for x in leaves)).hexdigest()
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(d)
+            f.flush()
+
+            self.assertEqual(f_hashing.tree_hash(f.name, leaf_size, workers=3), (root, leaves))
+            self.assertEqual(f_hashing.tree_root(leaves), root)
+            self.assertEqual(f_hashing.verify_leaves(f.name, leaves, leaf_size), [])
+
+            # a corrupted leaf is pinpointed
+            bad = list(leaves)
+            bad[1] = "00" * 32
+            self.assertEqual(f_hashing.verify_leaves(f.name, bad, leaf_size), [1])
+            self.assertEqual(f_hashing.verify_leaves(f.name, leaves[:2], leaf_size), [0, 1, 2])
+
+        # an empty file is one empty leaf
+        with tempfile.NamedTemporaryFile() as f:
+            self.assertEqual(f_hashing.leaf_hashes(f.name, leaf_size), [hashlib.sha256(b"").hexdigest()])
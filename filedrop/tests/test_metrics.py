@@ -0,0 +1,91 @@
+import glob
+import multiprocessing
+import os
+import tempfile
+
+import filedrop.lib.exc as f_exc
+import filedrop.lib.metrics as f_metrics
+import filedrop.tests.utils as f_tests
+
+
+class MetricsTests(f_tests.FiledropTest):
+    def test_render(self):
+        r = f_metrics.Registry()
+        c = r.counter("test_total", "A counter")
+        h = r.histogram("test_seconds", "A histogram", buckets=(0.1, 1.0))
+
+        c.inc(route="a")
+        c.inc(2, route="a")
+        c.inc(route='b"')
+        h.observe(0.05, op="x")
+        h.observe(0.5, op="x")
+        h.observe(5, op="x")
+
+        out = r.render()
+        self.assertIn("# TYPE test_total counter", out)
+        self.assertIn('test_total{route="a"} 3', out)
+        self.assertIn('test_total{route="b\\""} 1', out)
+        self.assertIn("# TYPE test_seconds histogram", out)
+        self.assertIn('test_seconds_bucket{op="x",le="0.1"} 1', out)
+        self.assertIn('test_seconds_bucket{op="x",le="1"} 2', out)
+        self.assertIn('test_seconds_bucket{op="x",le="+Inf"} 3', out)
+        self.assertIn('test_seconds_sum{op="x"} 5.55', out)
+        self.assertIn('test_seconds_count{op="x"} 3', out)
+
+        self.assertRaises(f_exc.BadArgs, c.inc, -1)
+        self.assertRaises(f_exc.BadArgs, r.histogram, "test_total", "Not a counter")
+        self.assertRaises(f_exc.BadArgs, r.histogram, "bad_seconds", "Unsorted", buckets=(1.0, 0.1))
+
+    def test_funcs(self):
+        r = f_metrics.Registry()
+        r.counter_func("hits_total", "Hits", lambda: {f_metrics.label_set(cache="x"): 4})
+        r.gauge_func("usage_bytes", "Usage", lambda: {f_metrics.label_set(): 10})
+
+        out = r.render()
+        self.assertIn('hits_total{cache="x"} 4', out)
+        self.assertIn("# TYPE usage_bytes gauge", out)
+        self.assertIn("usage_bytes 10", out)
+
+        # a failing func doesn't break the rest of the metrics
+        r.gauge_func("usage_bytes", "Usage", lambda: {f_metrics.label_set(): 1 / 0})
+        self.assertIn('hits_total{cache="x"} 4', r.render())
+
+    def test_timer(self):
+        r = f_metrics.Registry()
+        h = r.histogram("calls_seconds", "Calls")
+
+        @h.time("method")
+        def _do_thing(x):
+            return x + 1
+
+        self.assertEqual(_do_thing(1), 2)
+        self.assertIn('calls_seconds_count{method="do_thing"} 1', r.render())
+
+    def test_shared_dir(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            r = f_metrics.Registry()
+            r.set_dir(tmpdir)
+            c = r.counter("req_total", "Requests")
+            h = r.histogram("req_seconds", "Latency", buckets=(1.0,))
+
+            c.inc(route="a")
+            h.observe(2)
+
+            # a forked worker starts from zero, and its counts are added to the other processes'
+            def worker():
+                c.inc(2, route="a")
+                h.observe(0.5)
+                r.flush()
+
+            p = multiprocessing.get_context("fork").Process(target=worker)
+            p.start()
+            p.join()
+            self.assertEqual(p.exitcode, 0)
+
+            out = r.render()
+            self.assertIn('req_total{route="a"} 3', out)
+            self.assertIn('req_seconds_bucket{le="1"} 1', out)
+            self.assertIn("req_seconds_count 2", out)
+            self.assertEqual(len(glob.glob(os.path.join(tmpdir, "metrics-*.json"))), 2)
+
+            r.set_dir(None)
@@ -1,5 +1,7 @@
+import hashlib
 from datetime import datetime
 
+import filedrop.lib.exc as f_exc
 import filedrop.lib.models as f_models
 import filedrop.lib.time as f_time
 import filedrop.tests.utils as f_tests
@@ -32,6 +34,33 @@ class ModelTests(f_tests.FiledropTest):
         self.assertFalse(u2.check_password("asdf"))
         self.assertTrue(u2.check_password("zxcv"))
 
+    def test_scrypt_params(self):
+        cheap = f_models.ScryptParams(n=2**10, r=4, p=1)
+        u = f_models.User.new("user1", "hunter2", params=cheap)
+        self.assertEqual(u.scrypt_params, cheap)
+        self.assertTrue(u.check_password("hunter2"))
+        self.assertFalse(u.check_password("hunter3"))
+
+        u.update_password("hunter2")
+        self.assertEqual(u.scrypt_params, f_models.DEFAULT_SCRYPT_PARAMS)
+        self.assertTrue(u.check_password("hunter2"))
+
+        # hashes from before the parameters were recorded are still checked
+        legacy = f_models.LEGACY_SCRYPT_PARAMS
+        raw = hashlib.scrypt(b"hunter2", salt=u.salt, n=legacy.n, r=legacy.r, p=legacy.p)  # type: ignore
+        u.password_hash = raw
+        self.assertEqual(u.scrypt_params, legacy)
+        self.assertTrue(u.check_password("hunter2"))
+        self.assertFalse(u.check_password("hunter3"))
+
+        # more than hashlib's default memory limit
+        big = f_models.ScryptParams(n=2**15, r=8, p=1)
+        self.assertTrue(f_models.User.new("user2", "x", params=big).check_password("x"))
+
+        for bad in [f_models.ScryptParams(n=1000), f_models.ScryptParams(r=0), f_models.ScryptParams(p=0)]:
+            with self.assertRaises(f_exc.BadArgs):
+                bad.validate()
+
     def test_file(self):
         ts = f_time.now()
 
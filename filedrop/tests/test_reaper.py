@@ -0,0 +1,138 @@
+import hashlib
+import io
+import os
+import tempfile
+import time
+from datetime import timedelta
+
+import filedrop.lib.exc as f_exc
+import filedrop.lib.filestore as f_fs
+import filedrop.lib.reaper as f_reaper
+import filedrop.lib.time as f_time
+import filedrop.tests.utils as f_tests
+
+
+class ReaperTests(f_tests.FiledropTest):
+    def test_reaping(self):
+        with self.getTestFilestore() as fs:
+            past = f_time.now() - timedelta(hours=1)
+            future = f_time.now() + timedelta(hours=1)
+
+            expired = [
+                fs.save_file(f"exp{i}.txt", f"expired {i}".encode(), anon_upload=True, expiration_time=past)
+                for i in range(5)
+            ]
+            alive = fs.save_file("alive.txt", b"still here", anon_upload=True, expiration_time=future)
+            forever = fs.save_file("forever.txt", b"forever", anon_upload=True)
+            used_up = fs.save_file("used.txt", b"used up", anon_upload=True, max_downloads=1)
+            resumable = fs.save_file("resumable.txt", b"resumable", anon_upload=True, max_downloads=1)
+
+            # a blob shared with a live file has to stay on disk
+            shared = fs.save_file("shared.txt", b"forever", anon_upload=True, expiration_time=past)
+
+            self.assertIsNotNone(fs.get_file_bytes(used_up.uuid))
+            self.assertIsNotNone(fs.get_file_path(resumable.uuid))
+            self.assertIsNotNone(fs.claim_download(resumable.uuid))
+
+            r = f_reaper.Reaper(fs, batch_size=2, rate=1000)
+            self.assertEqual(r.run_once(), 7)
+            self.assertEqual(r.run_once(), 0)
+
+            for f in expired + [used_up, shared]:
+                self.assertIsNone(fs.get_file_bytes(f.uuid, validate_conditions=False))
+            for f in expired + [used_up]:
+                self.assertFalse(os.path.exists(f.path))
+
+            # the files that can still be downloaded (or resumed) are left alone
+            self.assertEqual(fs.get_file_bytes(alive.uuid), b"still here")
+            self.assertEqual(fs.get_file_bytes(forever.uuid), b"forever")
+            self.assertEqual(fs.get_file_path(resumable.uuid, count_download=False), resumable.path)
+
+            # empty hash shard directories are pruned
+            blobs = []
+            for dirpath, dirnames, filenames in os.walk(os.path.join(fs.root_path, f_fs.BLOBS_DIR)):
+                self.assertTrue(dirnames or filenames, dirpath)
+                blobs += [os.path.join(dirpath, x) for x in filenames]
+            self.assertEqual(sorted(blobs), sorted([alive.path, forever.path, resumable.path]))
+
+    def test_stale_uploads(self):
+        with self.getTestFilestore() as fs:
+            s1 = fs.new_upload_session("old.txt", 5, anon_upload=True)
+            s2 = fs.new_upload_session("new.txt", 5, anon_upload=True)
+            self.assertTrue(fs.save_upload_chunk(s1, 0, io.BytesIO(b"hello"), hashlib.sha256(b"hello").hexdigest()))
+
+            with fs._db.cursor() as c:
+                c.execute(
+                    "UPDATE upload_sessions SET created_at = datetime('now', '-2 days') WHERE uuid = ?;", (s1.uuid,)
+                )
+
+            f_reaper.Reaper(fs).run_once()
+            self.assertIsNone(fs.get_upload_session(s1.uuid))
+            self.assertEqual(fs.get_upload_session(s2.uuid), s2)
+            self.assertEqual(os.listdir(os.path.join(fs.root_path, f_fs.UPLOADS_DIR)), [])
+
+    def test_old_claims(self):
+        with self.getTestFilestore() as fs:
+            f = fs.save_file("popular.txt", b"downloaded a lot", anon_upload=True)
+            old = [fs.claim_download(f.uuid) for _ in range(5)]  # type: ignore
+            with fs._db.cursor() as c:
+                c.execute("UPDATE download_claims SET created_at = datetime('now', '-2 days');")
+            new = fs.claim_download(f.uuid)  # type: ignore
+
+            # the file stays, but the claims that can't be used anymore don't pile up
+            self.assertEqual(f_reaper.Reaper(fs, batch_size=2).run_once(), 0)
+            with fs._db.cursor() as c:
+                self.assertEqual(c.execute("SELECT COUNT(*) FROM download_claims;").fetchone()[0], 1)
+            self.assertTrue(fs.check_download_claim(f.uuid, new))  # type: ignore
+            self.assertFalse(fs.check_download_claim(f.uuid, old[0]))  # type: ignore
+
+    def test_background(self):
+        self.assertRaises(f_exc.BadArgs, f_reaper.Reaper, None, rate=0)
+
+        with self.getTestFilestore() as fs:
+            r = f_reaper.Reaper(fs, interval=1, rate=1)
+            r.start()
+            self.assertRaises(f_exc.InvalidState, r.start)
+
+            f = fs.save_file("exp.txt", b"expired", anon_upload=True, expiration_time=f_time.now())
+            for _ in range(30):
+                if not os.path.exists(f.path):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(os.path.exists(f.path))
+
+            r.stop()
+            self.assertRaises(f_exc.InvalidState, r.stop)
+
+    def test_elect(self):
+        with self.getTestFilestore() as fs, tempfile.TemporaryDirectory() as tmpdir:
+            lock = os.path.join(tmpdir, "reaper.lock")
+            first = f_reaper.Reaper(fs, interval=1, lock_path=lock)
+            second = f_reaper.Reaper(fs, interval=1, lock_path=lock)
+
+            # only one of them reaps at a time
+            self.assertTrue(first.elect())
+            self.assertFalse(second.elect())
+
+            first.start()
+            second.start()
+            f = fs.save_file("exp.txt", b"expired", anon_upload=True, expiration_time=f_time.now())
+            for _ in range(30):
+                if not os.path.exists(f.path):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(os.path.exists(f.path))
+
+            # the other one takes over once the first one stops
+            first.stop()
+            f = fs.save_file("exp2.txt", b"expired too", anon_upload=True, expiration_time=f_time.now())
+            for _ in range(30):
+                if not os.path.exists(f.path):
+                    break
+                time.sleep(0.1)
+            self.assertFalse(os.path.exists(f.path))
+            self.assertFalse(first.elect())
+
+            second.stop()
+            self.assertTrue(first.elect())
+            first._release()  # pylint: disable=protected-access
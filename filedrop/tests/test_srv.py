@@ -1,5 +1,13 @@
+import base64
+import gzip
+import hashlib
+import io
+import zipfile
+import zlib
 from datetime import datetime, timedelta
 
+import filedrop.lib.auth as f_auth
+import filedrop.lib.metrics as f_metrics
 import filedrop.lib.time as f_time
 import filedrop.lib.utils as f_utils
 import filedrop.tests.utils as f_tests
@@ -10,6 +18,30 @@ class ServerTests(f_tests.ServerTest):
         r = self.client.get("/healthcheck")
         self.assertEqual(r.json, {"status": "good"})
 
+    def test_metrics(self):
+        f = self.fs.save_file("test.txt", b"metrics test file", anon_upload=True)
+        self.assertIsNotNone(f)
+
+        r = self.client.get(f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download")  # type: ignore
+        self.assertEqual(r.status_code, 200)
+        r.close()
+
+        r = self.client.get("/metrics")
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.content_type.startswith("text/plain"))
+
+        out = r.get_data(as_text=True)
+        self.assertIn('filedrop_http_request_seconds_count{method="GET",route="apiv1.file_download",status="200"}', out)
+        self.assertIn('filedrop_http_sent_bytes_total{route="apiv1.file_download"}', out)
+        self.assertIn('filedrop_db_query_seconds_count{method="get_file"}', out)
+        self.assertIn('filedrop_filestore_seconds_count{op="get_file_path"}', out)
+        self.assertIn('filedrop_cache_hits_total{cache="files"}', out)
+        self.assertIn('filedrop_cache_misses_total{cache="variants"}', out)
+        self.assertIn("filedrop_filestore_variant_bytes ", out)
+        self.assertIn("filedrop_filestore_blobs ", out)
+        self.assertIn('filedrop_filestore_disk_bytes{kind="free"}', out)
+        self.assertIn('filedrop_filestore_blob_disk_bytes{kind="free",path=', out)
+
     def test_file_info(self):
         n = "test.txt"
         d = b"this is a good test file"
@@ -29,6 +61,22 @@ class ServerTests(f_tests.ServerTest):
         self.assertEqual(r.headers.get("Content-Disposition"), f"attachment; filename={n}")
         self.assertEqual(r.data, d)
 
+        # make sure downloads past the quota are rejected
+        f = self.fs.save_file(n, d, anon_upload=True, max_downloads=1)
+        self.assertIsNotNone(f)
+        r = self.client.get(f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download")  # type: ignore
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, d)
+        r = self.client.get(f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download")  # type: ignore
+        self.assertEqual(r.status_code, 400)
+
+        # both are in the audit log
+        self.app.config["audit"].flush()
+        events = self.db.get_audit_events(2)
+        self.assertEqual([e.action for e in events], ["file.download.denied", "file.download"])
+        self.assertEqual(events[0].file_uuid, f.uuid)  # type: ignore
+        self.assertEqual(events[0].src_ip, "127.0.0.1")
+
         r = self.client.get("/api/v1/file/asdf/download")
         self.assertEqual(r.status_code, 400)
         self.assertEqual(r.json, {"status": "error", "msg": "file doesn't exist", "data": {"uuid": "asdf"}})
@@ -36,3 +84,400 @@ class ServerTests(f_tests.ServerTest):
         r = self.client.get("/api/v1/file/aabbccdd/download")
         self.assertEqual(r.status_code, 400)
         self.assertEqual(r.json, {"status": "error", "msg": "file doesn't exist", "data": {"uuid": "aabbccdd"}})
+
+    def test_file_download_ranges(self):
+        n = "test.txt"
+        d = b"0123456789abcdefghijklmnopqrstuvwxyz"
+        f = self.fs.save_file(n, d, anon_upload=True, max_downloads=1)
+        self.assertIsNotNone(f)
+        url = f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download"  # type: ignore
+
+        # a range request counts as the download and hands out a claim
+        r = self.client.get(url, headers={"Range": "bytes=0-9"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, d[:10])
+        self.assertEqual(r.headers.get("ETag"), f'"{f.file_hash}"')  # type: ignore
+        self.assertEqual(r.headers.get("Content-Range"), f"bytes 0-9/{len(d)}")
+        claim = r.headers.get("X-Filedrop-Download-Claim")
+        self.assertIsNotNone(claim)
+
+        # the quota is used up without the claim
+        r = self.client.get(url, headers={"Range": "bytes=10-"})
+        self.assertEqual(r.status_code, 400)
+
+        # resuming with the claim doesn't use more quota, but only continues from where the last range ended
+        hdrs = {"If-Range": f'"{f.file_hash}"', "X-Filedrop-Download-Claim": claim}  # type: ignore
+        r = self.client.get(url, headers={"Range": "bytes=10-19", **hdrs})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, d[10:20])
+        self.assertEqual(r.headers.get("X-Filedrop-Download-Claim"), claim)
+        r = self.client.get(url, headers={"Range": "bytes=10-19", **hdrs})
+        self.assertEqual(r.status_code, 400)
+
+        # a mismatched If-Range would get the whole file, so it isn't a resume
+        r = self.client.get(url, headers={"Range": "bytes=20-", "If-Range": '"nope"', "X-Filedrop-Download-Claim": claim})  # type: ignore
+        self.assertEqual(r.status_code, 400)
+
+        # and neither is getting the whole file again
+        r = self.client.get(url, headers={"X-Filedrop-Download-Claim": claim})  # type: ignore
+        self.assertEqual(r.status_code, 400)
+
+        # sending the end of the file uses up the claim
+        r = self.client.get(url, headers={"Range": "bytes=20-", **hdrs})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, d[20:])
+        self.assertIsNone(r.headers.get("X-Filedrop-Download-Claim"))
+        r = self.client.get(url, headers={"Range": "bytes=30-", **hdrs})
+        self.assertEqual(r.status_code, 400)
+
+        # fetching the file in halves with the claim of a full download doesn't get it again after that
+        f5 = self.fs.save_file("halves.txt", d, anon_upload=True, max_downloads=1)
+        url5 = f"/api/v1/file/{f_utils.hexstr(f5.uuid)}/download"  # type: ignore
+        r = self.client.get(url5)
+        self.assertEqual(r.status_code, 200)
+        hdrs = {"If-Range": f'"{f5.file_hash}"', "X-Filedrop-Download-Claim": r.headers["X-Filedrop-Download-Claim"]}  # type: ignore
+        r = self.client.get(url5, headers={"Range": "bytes=0-17", **hdrs})
+        self.assertEqual(r.status_code, 206)
+        r = self.client.get(url5, headers={"Range": "bytes=18-", **hdrs})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, d[18:])
+        for rng in ("bytes=0-17", "bytes=18-", "bytes=-5"):
+            r = self.client.get(url5, headers={"Range": rng, **hdrs})
+            self.assertEqual(r.status_code, 400)
+
+        # repeated full downloads with a claim are counted
+        f4 = self.fs.save_file("full.txt", d, anon_upload=True, max_downloads=1)
+        url4 = f"/api/v1/file/{f_utils.hexstr(f4.uuid)}/download"  # type: ignore
+        r = self.client.get(url4)
+        self.assertEqual(r.status_code, 200)
+        claim4 = r.headers.get("X-Filedrop-Download-Claim")
+        self.assertIsNotNone(claim4)
+        for _ in range(3):
+            r = self.client.get(url4, headers={"X-Filedrop-Download-Claim": claim4})  # type: ignore
+            self.assertEqual(r.status_code, 400)
+        r = self.client.get(url4, headers={"Range": "bytes=5-", "X-Filedrop-Download-Claim": claim4})  # type: ignore
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, d[5:])
+
+        # conditional requests that don't send the file don't use up quota
+        f3 = self.fs.save_file("other.txt", d.upper(), anon_upload=True, max_downloads=1)
+        url3 = f"/api/v1/file/{f_utils.hexstr(f3.uuid)}/download"  # type: ignore
+        r = self.client.get(url3, headers={"If-None-Match": f'"{f3.file_hash}"'})  # type: ignore
+        self.assertEqual(r.status_code, 304)
+        self.assertIsNone(r.headers.get("X-Filedrop-Download-Claim"))
+        r = self.client.get(url3, headers={"Range": "bytes=1000-"})
+        self.assertEqual(r.status_code, 416)
+        r = self.client.get(url3)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, d.upper())
+
+        # claims are per-file
+        f2 = self.fs.save_file(n, d, anon_upload=True, max_downloads=0)
+        self.assertIsNotNone(f2)
+        r = self.client.get(f"/api/v1/file/{f_utils.hexstr(f2.uuid)}/download", headers={"X-Filedrop-Download-Claim": claim})  # type: ignore
+        self.assertEqual(r.status_code, 400)
+
+    def test_file_download_compressed(self):
+        n = "test.txt"
+        d = b"this is a compressible test file\n" * 1000
+        f = self.fs.save_file(n, d, anon_upload=True, codec="gzip")
+        self.assertEqual(f.codec, "gzip")  # type: ignore
+        url = f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download"  # type: ignore
+
+        # clients that accept gzip get the stored blob
+        r = self.client.get(url, headers={"Accept-Encoding": "br, gzip"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get("Content-Encoding"), "gzip")
+        self.assertEqual(r.headers.get("ETag"), f'"{f.file_hash}.gzip"')  # type: ignore
+        self.assertIn("Accept-Encoding", r.headers.get("Vary", ""))
+        self.assertLess(len(r.data), len(d))
+        self.assertEqual(gzip.decompress(r.data), d)
+
+        # everyone else gets it decompressed
+        for h in [{}, {"Accept-Encoding": "gzip;q=0, deflate"}]:
+            r = self.client.get(url, headers=h)
+            self.assertEqual(r.status_code, 200)
+            self.assertIsNone(r.headers.get("Content-Encoding"))
+            self.assertEqual(r.headers.get("Content-Length"), str(len(d)))
+            self.assertEqual(r.headers.get("ETag"), f'"{f.file_hash}"')  # type: ignore
+            self.assertEqual(r.data, d)
+
+        r = self.client.get(url, headers={"If-None-Match": f'"{f.file_hash}"'})  # type: ignore
+        self.assertEqual(r.status_code, 304)
+
+        # codecs without a content-coding are decompressed
+        d = d.upper()
+        f = self.fs.save_file(n, d, anon_upload=True, codec="bz2")
+        self.assertEqual(f.codec, "bz2")  # type: ignore
+        r = self.client.get(f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download", headers={"Accept-Encoding": "identity"})  # type: ignore
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNone(r.headers.get("Content-Encoding"))
+        self.assertEqual(r.data, d)
+
+    def test_file_download_encoded(self):
+        d = b"2024-01-01 12:00:00 INFO something happened\n" * 5000
+        f = self.fs.save_file("server.log", d, anon_upload=True)
+        self.assertIsNone(f.codec)  # type: ignore
+        url = f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download"  # type: ignore
+
+        # text is compressed on the fly for clients that accept it
+        r = self.client.get(url, headers={"Accept-Encoding": "deflate"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers.get("Content-Encoding"), "deflate")
+        self.assertEqual(r.headers.get("ETag"), f'"{f.file_hash}.deflate"')  # type: ignore
+        self.assertEqual(zlib.decompress(r.data), d)
+
+        # and cached once it's popular, after which ranges work too
+        for _ in range(2):
+            r = self.client.get(url, headers={"Accept-Encoding": "gzip, deflate"})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.headers.get("Content-Encoding"), "gzip")
+            self.assertIsNone(r.headers.get("Content-Length"))
+            self.assertEqual(gzip.decompress(r.data), d)
+            r.close()
+        gz = r.data
+
+        p = self.fs.get_variant_path(f, "gzip")  # type: ignore
+        self.assertIsNotNone(p)
+        r = self.client.get(url, headers={"Accept-Encoding": "gzip", "Range": "bytes=0-9"})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.data, gz[:10])
+        r = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(r.headers.get("Content-Length"), str(len(gz)))
+        self.assertEqual(r.data, gz)
+
+        # clients that don't accept it still get the raw file, with ranges
+        r = self.client.get(url, headers={"Range": "bytes=0-9"})
+        self.assertEqual(r.status_code, 206)
+        self.assertIsNone(r.headers.get("Content-Encoding"))
+        self.assertEqual(r.data, d[:10])
+
+        # files that don't compress well aren't compressed
+        f = self.fs.save_file("photo.jpg", d + b"!", anon_upload=True)
+        r = self.client.get(f"/api/v1/file/{f_utils.hexstr(f.uuid)}/download", headers={"Accept-Encoding": "gzip"})  # type: ignore
+        self.assertIsNone(r.headers.get("Content-Encoding"))
+        self.assertEqual(r.data, d + b"!")
+
+    def test_file_new(self):
+        d = b"this is a good uploaded file"
+
+        r = self.client.post("/api/v1/file/new", data={"file": (io.BytesIO(d), "up.txt"), "max_downloads": "1"})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json["data"]["size"], len(d))  # type: ignore
+        self.assertEqual(r.json["data"]["hash"], hashlib.sha256(d).hexdigest())  # type: ignore
+
+        url = f"/api/v1/file/{r.json['data']['uuid']}/download"  # type: ignore
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.data, d)
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 400)
+
+        r = self.client.post("/api/v1/file/new", data={})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post("/api/v1/file/new", data={"file": (io.BytesIO(d), "up.txt"), "max_downloads": "x"})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post("/api/v1/file/new", data={"file": (io.BytesIO(d), "up.txt"), "codec": "asdf"})
+        self.assertEqual(r.status_code, 400)
+
+    def test_auth(self):
+        basic = {"Authorization": "Basic " + base64.b64encode(b"user1:hunter2").decode()}
+        wrong = {"Authorization": "Basic " + base64.b64encode(b"user1:hunter3").decode()}
+
+        r = self.client.post("/api/v1/apikey")
+        self.assertEqual(r.status_code, 401)
+        r = self.client.post("/api/v1/apikey", headers=wrong)
+        self.assertEqual(r.status_code, 401)
+
+        r = self.client.post("/api/v1/apikey", headers=basic)
+        self.assertEqual(r.status_code, 200)
+        bearer = {"Authorization": f"Bearer {r.json['data']['key']}"}  # type: ignore
+        key = {"X-Filedrop-Key": r.json["data"]["key"]}  # type: ignore
+
+        # uploads are owned by the authenticated user
+        for h in [basic, bearer, key]:
+            r = self.client.post("/api/v1/file/new", data={"file": (io.BytesIO(b"mine"), "mine.txt")}, headers=h)
+            self.assertEqual(r.status_code, 200)
+            f = self.db.get_file(f_utils.unhexstr(r.json["data"]["uuid"]))  # type: ignore
+            self.assertEqual(f.username, "user1")  # type: ignore
+
+        r = self.client.post("/api/v1/file/new", data={"file": (io.BytesIO(b"mine"), "mine.txt")}, headers=wrong)
+        self.assertEqual(r.status_code, 401)
+        r = self.client.post("/api/v1/upload", json={"name": "mine.txt", "size": 4}, headers=wrong)
+        self.assertEqual(r.status_code, 401)
+
+        r = self.client.delete("/api/v1/apikey", headers=bearer)
+        self.assertEqual(r.status_code, 200)
+        r = self.client.post("/api/v1/file/new", data={"file": (io.BytesIO(b"mine"), "mine.txt")}, headers=key)
+        self.assertEqual(r.status_code, 401)
+        r = self.client.delete("/api/v1/apikey", headers=basic)
+        self.assertEqual(r.status_code, 404)
+
+    def test_batch(self):
+        r = self.client.post(
+            "/api/v1/files/new",
+            data={"file": [(io.BytesIO(b"first"), "a.txt"), (io.BytesIO(b"second"), "b.txt")], "max_downloads": "1"},
+        )
+        self.assertEqual(r.status_code, 200)
+        uploaded = r.json["data"]["files"]  # type: ignore
+        self.assertEqual([f["name"] for f in uploaded], ["a.txt", "b.txt"])
+        uuids = [f["uuid"] for f in uploaded]
+
+        r = self.client.post("/api/v1/files", json={"uuids": uuids + ["asdf", "00" * 16]})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json["data"]["files"], {uuids[0]: {"name": "a.txt", "size": 5}, uuids[1]: {"name": "b.txt", "size": 6}})  # type: ignore
+        r = self.client.post("/api/v1/files", json={"uuids": "asdf"})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post("/api/v1/files", json={"uuids": ["00"] * 1001})
+        self.assertEqual(r.status_code, 400)
+
+        # a missing file fails the whole archive, without using up the others' downloads
+        r = self.client.post("/api/v1/files/download", json={"uuids": uuids + ["00" * 16]})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post("/api/v1/files/download", json={"uuids": uuids, "format": "rar"})
+        self.assertEqual(r.status_code, 400)
+
+        sent = f_metrics.REGISTRY.values("filedrop_http_sent_bytes_total")
+        label = f_metrics.label_set(route="apiv1.files_download")
+        before = sent.get(label, 0)
+        r = self.client.post("/api/v1/files/download", json={"uuids": uuids})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.mimetype, "application/zip")
+        self.assertIsNone(r.content_length)
+        data = r.data
+        r.close()
+        # the archive is streamed without a length, so its bytes are counted as they're sent
+        self.assertEqual(sent.get(label, 0) - before, len(data))
+        with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+            self.assertEqual(zf.read("a.txt"), b"first")
+            self.assertEqual(zf.read("b.txt"), b"second")
+
+        # both were counted
+        r = self.client.post("/api/v1/files/download", json={"uuids": uuids[:1], "format": "tar"})
+        self.assertEqual(r.status_code, 400)
+
+        # an archive that stops part way gives back the downloads of the files it didn't send
+        files = [self.fs.save_file(n, b"x" * 100, anon_upload=True, max_downloads=1) for n in ["c.txt", "d.txt"]]
+        once = [f_utils.hexstr(f.uuid) for f in files]  # type: ignore
+        r = self.client.post("/api/v1/files/download", json={"uuids": once}, buffered=False)
+        self.assertEqual(r.status_code, 200)
+        next(iter(r.response))
+        r.close()
+        r = self.client.post("/api/v1/files/download", json={"uuids": once})
+        self.assertEqual(r.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(r.data)) as zf:
+            self.assertEqual(zf.namelist(), ["c.txt", "d.txt"])
+        r = self.client.post("/api/v1/files/download", json={"uuids": once[:1]})
+        self.assertEqual(r.status_code, 400)
+
+        r = self.client.post("/api/v1/files/new", data={})
+        self.assertEqual(r.status_code, 400)
+
+    def test_list_files(self):
+        basic = {"Authorization": "Basic " + base64.b64encode(b"user1:hunter2").decode()}
+        for i in range(5):
+            r = self.client.post(
+                "/api/v1/file/new", data={"file": (io.BytesIO(b"x" * i), f"list{i}.txt")}, headers=basic
+            )
+            self.assertEqual(r.status_code, 200)
+
+        r = self.client.get("/api/v1/files")
+        self.assertEqual(r.status_code, 401)
+
+        names = []
+        url = "/api/v1/files?sort=size&order=asc&limit=2"
+        while True:
+            r = self.client.get(url, headers=basic)
+            self.assertEqual(r.status_code, 200)
+            names += [f["name"] for f in r.json["data"]["files"] if f["name"].startswith("list")]  # type: ignore
+            if r.json["data"]["cursor"] is None:  # type: ignore
+                break
+            url = f"/api/v1/files?sort=size&order=asc&limit=2&cursor={r.json['data']['cursor']}"  # type: ignore
+        self.assertEqual(names, [f"list{i}.txt" for i in range(5)])
+
+        # a cursor only works with the sort order it came from
+        r = self.client.get("/api/v1/files?sort=size&limit=1", headers=basic)
+        r = self.client.get(f"/api/v1/files?cursor={r.json['data']['cursor']}", headers=basic)  # type: ignore
+        self.assertEqual(r.status_code, 400)
+        for q in ["cursor=asdf", "limit=0", "limit=x", "order=up", "sort=name"]:
+            r = self.client.get(f"/api/v1/files?{q}", headers=basic)
+            self.assertEqual(r.status_code, 400, q)
+
+        # cursors that are valid json, but not a key
+        for key in [b"5", b"null", b'{"a": 1}', b'["created", "desc", 1]']:
+            r = self.client.get(f"/api/v1/files?cursor={base64.urlsafe_b64encode(key).decode()}", headers=basic)
+            self.assertEqual(r.status_code, 400, key)
+
+        # only admins can list everyone's files
+        r = self.client.get("/api/v1/admin/files", headers=basic)
+        self.assertEqual(r.status_code, 403)
+
+        auth = self.app.config["auth"]
+        self.app.config["auth"] = f_auth.Authenticator(self.db, admins=["user1"])
+        try:
+            r = self.client.get("/api/v1/admin/files?user=user1&limit=1", headers=basic)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.json["data"]["files"][0]["username"], "user1")  # type: ignore
+            r = self.client.get("/api/v1/admin/files?limit=1000", headers=basic)
+            self.assertEqual(r.status_code, 200)
+            self.assertIn("anonymous", [f["username"] for f in r.json["data"]["files"]])  # type: ignore
+        finally:
+            self.app.config["auth"] = auth
+
+    def test_chunked_upload(self):
+        d = bytes(range(256)) * 10
+        chunks = [d[i : i + 1000] for i in range(0, len(d), 1000)]
+
+        r = self.client.post("/api/v1/upload", json={"name": "chunky.bin", "size": len(d), "chunk_size": 1000})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json["data"]["num_chunks"], 3)  # type: ignore
+        url = f"/api/v1/upload/{r.json['data']['uuid']}"  # type: ignore
+
+        # chunks can arrive in any order
+        for idx in [2, 0]:
+            h = hashlib.sha256(chunks[idx]).hexdigest()
+            r = self.client.put(f"{url}/{idx}", data=chunks[idx], headers={"X-Filedrop-Chunk-Hash": h})
+            self.assertEqual(r.status_code, 200)
+
+        r = self.client.get(url)
+        self.assertEqual(r.json["data"]["chunks"], [0, 2])  # type: ignore
+
+        # can't finalize with missing chunks
+        r = self.client.post(f"{url}/finalize")
+        self.assertEqual(r.status_code, 409)
+
+        # bad checksums, sizes and indexes are rejected
+        r = self.client.put(f"{url}/1", data=chunks[1], headers={"X-Filedrop-Chunk-Hash": "ab" * 32})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.put(
+            f"{url}/1",
+            data=chunks[1][:10],
+            headers={"X-Filedrop-Chunk-Hash": hashlib.sha256(chunks[1][:10]).hexdigest()},
+        )
+        self.assertEqual(r.status_code, 400)
+        r = self.client.put(f"{url}/3", data=b"", headers={"X-Filedrop-Chunk-Hash": hashlib.sha256(b"").hexdigest()})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.put(f"{url}/1", data=chunks[1])
+        self.assertEqual(r.status_code, 400)
+
+        h = hashlib.sha256(chunks[1]).hexdigest()
+        r = self.client.put(f"{url}/1", data=chunks[1], headers={"X-Filedrop-Chunk-Hash": h})
+        self.assertEqual(r.status_code, 200)
+
+        r = self.client.post(f"{url}/finalize")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json["data"]["hash"], hashlib.sha256(d).hexdigest())  # type: ignore
+        tree_hash = hashlib.sha256(b"".join(hashlib.sha256(c).digest() for c in chunks)).hexdigest()
+        self.assertEqual(r.json["data"]["tree_hash"], tree_hash)  # type: ignore
+
+        r2 = self.client.get(f"/api/v1/file/{r.json['data']['uuid']}/download")  # type: ignore
+        self.assertEqual(r2.data, d)
+
+        # the session is gone after finalizing
+        r = self.client.get(url)
+        self.assertEqual(r.status_code, 400)
+
+        r = self.client.post("/api/v1/upload", json={"name": "chunky.bin"})
+        self.assertEqual(r.status_code, 400)
+        r = self.client.post("/api/v1/upload", json={"name": "chunky.bin", "size": 10, "chunk_size": 0})
+        self.assertEqual(r.status_code, 400)
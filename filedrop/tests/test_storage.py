@@ -0,0 +1,119 @@
+import hashlib
+import os
+import tempfile
+import unittest
+
+import filedrop.lib.exc as f_exc
+import filedrop.lib.storage as f_storage
+import filedrop.tests.utils as f_tests
+
+
+def _hashes(n: int) -> list[str]:
+    return [hashlib.sha256(str(i).encode()).hexdigest() for i in range(n)]
+
+
+class StorageTests(f_tests.FiledropTest):
+    def test_layout(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backend = f_storage.LocalBackend([tmpdir + "/"])
+            h = hashlib.sha256(b"hello").hexdigest()
+
+            # a single root has the same layout the filestore always had
+            self.assertEqual(
+                backend.locate(h), os.path.join(tmpdir, f_storage.BLOBS_DIR, h[0:2], h[2:4], h[4:6], h[6:])
+            )
+
+            for bad in ["", "../../etc/passwd", h.upper(), h[:-1]]:
+                with self.assertRaises(f_exc.BadArgs):
+                    backend.locate(bad)
+
+            with self.assertRaises(f_exc.BadArgs):
+                f_storage.LocalBackend([])
+            with self.assertRaises(f_exc.BadArgs):
+                f_storage.LocalBackend([tmpdir, tmpdir + "/"])
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backend = f_storage.LocalBackend([tmpdir])
+            h = hashlib.sha256(b"hello").hexdigest()
+            p = backend.locate(h)
+
+            self.assertFalse(backend.exists(p))
+            self.assertIsNone(backend.stat(p))
+
+            self.assertTrue(backend.put_bytes(p, b"hello", h))
+            self.assertTrue(backend.exists(p))
+            self.assertEqual(backend.stat(p), 5)
+            with backend.open(p) as f:
+                self.assertEqual(f.read(), b"hello")
+
+            fd, tmp_path = backend.temp_file()
+            os.write(fd, b"world")
+            os.close(fd)
+            self.assertTrue(os.path.basename(tmp_path).startswith(f_storage.TEMP_PREFIX))
+            self.assertTrue(backend.put(tmp_path, p))
+            self.assertFalse(os.path.exists(tmp_path))
+            with backend.open(p) as f:
+                self.assertEqual(f.read(), b"world")
+
+            # the empty hash dirs are removed along with the blob
+            self.assertTrue(backend.delete(p))
+            self.assertFalse(backend.exists(p))
+            self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_sharding(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            roots = [os.path.join(tmpdir, f"disk{i}") for i in range(4)]
+            hashes = _hashes(2000)
+
+            three = f_storage.LocalBackend(roots[:3])
+            placed = {h: three.locate(h) for h in hashes}
+
+            # every root gets a fair share, regardless of the order they're listed in
+            for r in roots[:3]:
+                n = sum(p.startswith(r + "/") for p in placed.values())
+                self.assertGreater(n, len(hashes) / 3 * 0.75, r)
+            reordered = f_storage.LocalBackend(roots[2::-1])
+            self.assertEqual(placed, {h: reordered.locate(h) for h in hashes})
+
+            # temp files for a known hash go where the blob does
+            h = hashes[0]
+            fd, tmp_path = three.temp_file(h)
+            os.close(fd)
+            self.assertEqual(os.path.dirname(tmp_path), next(r for r in roots if placed[h].startswith(r + "/")))
+            os.unlink(tmp_path)
+
+            # adding a root only moves blobs to it, about a quarter of them
+            four = f_storage.LocalBackend(roots)
+            moved = [h for h in hashes if four.locate(h) != placed[h]]
+            self.assertTrue(all(four.locate(h).startswith(roots[3] + "/") for h in moved))
+            self.assertGreater(len(moved), len(hashes) / 4 * 0.75)
+            self.assertLess(len(moved), len(hashes) / 4 * 1.25)
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm"), "needs a second filesystem")
+    def test_cross_device(self):
+        with tempfile.TemporaryDirectory() as tmpdir, tempfile.TemporaryDirectory(dir="/dev/shm") as other:
+            if os.stat(tmpdir).st_dev == os.stat(other).st_dev:
+                self.skipTest("/dev/shm is on the same filesystem")
+
+            backend = f_storage.LocalBackend([tmpdir])
+            h = hashlib.sha256(b"hello").hexdigest()
+
+            tmp_path = os.path.join(other, "upload")
+            with open(tmp_path, "wb") as f:
+                f.write(b"hello")
+
+            self.assertTrue(backend.put(tmp_path, backend.locate(h)))
+            self.assertFalse(os.path.exists(tmp_path))
+            with backend.open(backend.locate(h)) as f:
+                self.assertEqual(f.read(), b"hello")
+            self.assertEqual(os.listdir(tmpdir), [f_storage.BLOBS_DIR])
+
+            # staging copies it next to where the blob goes, so putting it in place is a rename
+            with open(tmp_path, "wb") as f:
+                f.write(b"staged")
+            staged = backend.stage(tmp_path, h)
+            self.assertEqual(os.path.dirname(staged), tmpdir)  # type: ignore
+            self.assertFalse(os.path.exists(tmp_path))
+            self.assertEqual(backend.stage(staged, h), staged)  # type: ignore
+            os.unlink(staged)  # type: ignore
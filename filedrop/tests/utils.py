@@ -7,6 +7,7 @@ import unittest
 import flask
 import flask.testing
 
+import filedrop.lib.audit as f_audit
 import filedrop.lib.database as f_db
 import filedrop.lib.filestore as f_fs
 import filedrop.lib.models as f_models
@@ -29,17 +30,23 @@ class FiledropTest(unittest.TestCase):
 
     @classmethod
     @contextlib.contextmanager
-    def getTestFilestore(cls, db: f_db.Database | None = None, max_size=f_fs.DEFAULT_MAX_SIZE):
+    def getTestFilestore(
+        cls,
+        db: f_db.Database | None = None,
+        max_size=f_fs.DEFAULT_MAX_SIZE,
+        codec=None,
+        audit: f_audit.AuditLog | None = None,
+    ):
         """Get a disposable filestore instance in a tempdir."""
 
         try:
             with tempfile.TemporaryDirectory() as tmpdir:
                 if db is None:
                     with cls.getTestDatabase() as db:
-                        fs = f_fs.Filestore(db, root_path=tmpdir, max_size=max_size)
+                        fs = f_fs.Filestore(db, root_path=tmpdir, max_size=max_size, codec=codec, audit=audit)
                         yield fs
                 else:
-                    fs = f_fs.Filestore(db, root_path=tmpdir, max_size=max_size)
+                    fs = f_fs.Filestore(db, root_path=tmpdir, max_size=max_size, codec=codec, audit=audit)
                     yield fs
 
                 # TODO: cleanup via with block once that is implemented